@@ -1,6 +1,7 @@
 import warnings
 from abc import ABC, abstractmethod
 from collections import namedtuple
+from typing import Sequence
 
 import numpy as np
 import torch
@@ -189,42 +190,152 @@ class GreedyHungarianMatching(EmitterMatcher):
 
         return tp_ix, tp_match_ix, tp_ix_bool, tp_match_ix_bool
 
-    def forward(self, output: emitter.EmitterSet, target: emitter.EmitterSet):
+    def _match_batch(self, output: emitter.EmitterSet, target: emitter.EmitterSet) -> tuple:
+        """
+        Greedy matching of all frames at once. The pairs (see _sorted_pairs) are assigned greedily in their order in a
+        single pass.
+
+        Returns:
+            out_ix: index of the matched outputs in order of the matches
+            tar_ix: index of the matched targets
+
+        """
+        out_ix, tar_ix = self._sorted_pairs(output, target)
+        is_match = _greedy_assignment(out_ix, tar_ix, len(output), len(target))
+
+        return out_ix[is_match], tar_ix[is_match]
+
+    def count_subsets(self, output: emitter.EmitterSet, target: emitter.EmitterSet,
+                      subsets: Sequence[torch.BoolTensor]) -> list:
+        """
+        Number of true positives, false positives and false negatives of subsets of the output, e.g. the outputs above
+        several thresholds. The pairs and their order are computed once for the whole output, each subset is then
+        assigned in a single pass over its pairs. Same counts as forward on each subset, since the pairs of a subset
+        and their order are the ones of the whole output restricted to the subset.
+
+        Args:
+            output: output
+            target: target
+            subsets: boolean masks of the outputs
+
+        Returns:
+            list of (tp, fp, fn) per subset
+
+        """
+        out_ix, tar_ix = self._sorted_pairs(output, target)
+
+        counts = []
+        for is_sub in subsets:
+            is_pair = is_sub[out_ix]
+            n_tp = int(_greedy_assignment(out_ix[is_pair], tar_ix[is_pair], len(output), len(target)).sum())
+            n_sub = int(is_sub.sum())
+
+            counts.append((n_tp, n_sub - n_tp, len(target) - n_tp))
+
+        return counts
+
+    def _sorted_pairs(self, output: emitter.EmitterSet, target: emitter.EmitterSet) -> tuple:
+        """
+        Pairs of outputs and targets that pass the filter, in the order of the greedy assignment. The candidate pairs
+        (same frame, within the match radius) are found by sorting the targets into a grid of cells of the size of the
+        match radius and looking up the 3x3 cells around each output. The pairs are sorted by (frame, distance, output
+        index, target index), which is the order in which the frame-wise greedy kernel (_rule_out_kernel) picks them.
+
+        Returns:
+            out_ix: output index of the pairs
+            tar_ix: target index of the pairs
+
+        """
+        xyz_out, xyz_tar = output.xyz_nm, target.xyz_nm
+        out_ix, tar_ix = self._candidate_pairs(xyz_out, output.frame_ix, xyz_tar, target.frame_ix)
+
+        """Filter and distance of the candidates"""
+        dxyz = xyz_out[out_ix] - xyz_tar[tar_ix]
+        is_valid = torch.ones(len(out_ix), dtype=torch.bool)
+
+        if self.dist_lat is not None:
+            is_valid *= dxyz[:, :2].norm(dim=1) <= self.dist_lat
+        if self.dist_ax is not None:
+            is_valid *= dxyz[:, 2].abs() <= self.dist_ax
+        if self.dist_vol is not None:
+            is_valid *= dxyz.norm(dim=1) <= self.dist_vol
+
+        out_ix, tar_ix = out_ix[is_valid], tar_ix[is_valid]
+        dist = dxyz[is_valid, :self.match_dims].norm(dim=1)
+
+        """Order of the greedy kernel (lexicographic, the last key is the most significant)"""
+        order = np.lexsort([k.cpu().numpy() for k in (tar_ix, out_ix, dist, output.frame_ix[out_ix])])
+        order = torch.from_numpy(order).to(out_ix.device)
 
-        """Setup split in frames. Determine the frame range automatically so as to cover everything."""
-        if len(output) >= 1 and len(target) >= 1:
-            frame_low = output.frame_ix.min() if output.frame_ix.min() < target.frame_ix.min() else target.frame_ix.min()
-            frame_high = output.frame_ix.max() if output.frame_ix.max() > target.frame_ix.max() else target.frame_ix.max()
-        elif len(output) >= 1:
-            frame_low = output.frame_ix.min()
-            frame_high = output.frame_ix.max()
-        elif len(target) >= 1:
-            frame_low = target.frame_ix.min()
-            frame_high = target.frame_ix.max()
+        return out_ix[order], tar_ix[order]
+
+    def _candidate_pairs(self, xyz_out, frame_out, xyz_tar, frame_tar) -> tuple:
+        """
+        Pairs of outputs and targets in the same frame and in neighbouring grid cells, i.e. a superset of the pairs
+        within the lateral match radius.
+
+        """
+        radius = [r for r in (self.dist_lat, self.dist_vol) if r is not None]
+        radius = min(radius) if len(radius) >= 1 and min(radius) > 0 else None  # None: all pairs of a frame
+
+        if len(xyz_out) == 0 or len(xyz_tar) == 0:
+            return torch.zeros(0, dtype=torch.long), torch.zeros(0, dtype=torch.long)
+
+        if radius is not None:
+            cell_out = torch.floor(xyz_out[:, :2] / radius).long()
+            cell_tar = torch.floor(xyz_tar[:, :2] / radius).long()
+            offsets = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
         else:
-            return (emitter.EmptyEmitterSet(xy_unit=target.xyz, px_size=target.px_size),) * 4
+            cell_out = torch.zeros(len(xyz_out), 2, dtype=torch.long)
+            cell_tar = torch.zeros(len(xyz_tar), 2, dtype=torch.long)
+            offsets = [(0, 0)]
+
+        """Unique key of (frame, cell), with a margin of one cell for the neighbours"""
+        frame_low = min(frame_out.min(), frame_tar.min())
+        cell_low = torch.min(cell_out.min(0)[0], cell_tar.min(0)[0]) - 1
+        n_cell = torch.max(cell_out.max(0)[0], cell_tar.max(0)[0]) - cell_low + 2
+
+        def key(frame, cell):
+            cell = cell - cell_low
+            return ((frame - frame_low) * n_cell[0] + cell[:, 0]) * n_cell[1] + cell[:, 1]
+
+        key_tar = key(frame_tar, cell_tar)
+        tar_sorted = _argsort_stable(key_tar)
+        key_tar = key_tar[tar_sorted]
+
+        out_ix, tar_ix = [], []
+        for offset in offsets:
+            key_out = key(frame_out, cell_out + torch.tensor(offset))
+            low = torch.searchsorted(key_tar, key_out, right=False)
+            n = torch.searchsorted(key_tar, key_out, right=True) - low
+
+            out_rep = torch.repeat_interleave(torch.arange(len(xyz_out)), n)
+            pos = torch.arange(len(out_rep)) - torch.repeat_interleave(torch.cumsum(n, 0) - n, n)
+
+            out_ix.append(out_rep)
+            tar_ix.append(tar_sorted[low[out_rep] + pos])
+
+        return torch.cat(out_ix), torch.cat(tar_ix)
+
+    def forward(self, output: emitter.EmitterSet, target: emitter.EmitterSet):
 
-        out_pframe = output.split_in_frames(frame_low.item(), frame_high.item())
-        tar_pframe = target.split_in_frames(frame_low.item(), frame_high.item())
+        if len(output) == 0 and len(target) == 0:
+            return (emitter.EmptyEmitterSet(xy_unit=target.xyz, px_size=target.px_size),) * 4
 
-        tpl, fpl, fnl, tpml = [], [], [], []  # true positive list, false positive list, false neg. ...
+        """Match all frames at once"""
+        out_ix, tar_ix = self._match_batch(output, target)
 
-        """Match the emitters framewise"""
-        for out_f, tar_f in zip(out_pframe, tar_pframe):
-            filter_mask = self.filter(out_f.xyz_nm, tar_f.xyz_nm)  # batch implemented
-            tp_ix, tp_match_ix, tp_ix_bool, tp_match_ix_bool = self._match_kernel(out_f.xyz_nm, tar_f.xyz_nm,
-                                                                                  filter_mask)  # non batch impl.
+        tp = output[out_ix]
+        tp_match = target[tar_ix]
 
-            tpl.append(out_f[tp_ix])
-            tpml.append(tar_f[tp_match_ix])
-            fpl.append(out_f[~tp_ix_bool])
-            fnl.append(tar_f[~tp_match_ix_bool])
+        """False positives and negatives in order of their frames (stable), as the frame-wise matching would give."""
+        is_fp = torch.ones(len(output), dtype=torch.bool)
+        is_fp[out_ix] = False
+        is_fn = torch.ones(len(target), dtype=torch.bool)
+        is_fn[tar_ix] = False
 
-        """Concat them back"""
-        tp = emitter.EmitterSet.cat(tpl)
-        fp = emitter.EmitterSet.cat(fpl)
-        fn = emitter.EmitterSet.cat(fnl)
-        tp_match = emitter.EmitterSet.cat(tpml)
+        fp = output[_sort_frames(output.frame_ix, is_fp)]
+        fn = target[_sort_frames(target.frame_ix, is_fn)]
 
         """Let tp and tp_match share the same id's. IDs of ground truth are copied to true positives."""
         if (tp_match.id == -1).all().item():
@@ -233,3 +344,39 @@ class GreedyHungarianMatching(EmitterMatcher):
         tp.id = tp_match.id.type(tp.id.dtype)
 
         return self._return_match(tp=tp, fp=fp, fn=fn, tp_match=tp_match)
+
+
+def _greedy_assignment(out_ix: torch.Tensor, tar_ix: torch.Tensor, n_out: int, n_tar: int) -> torch.BoolTensor:
+    """
+    Greedy assignment of pairs in their order in a single pass, i.e. a pair is assigned if neither its output nor its
+    target has been assigned by a preceding pair.
+
+    Args:
+        out_ix: output index of the pairs
+        tar_ix: target index of the pairs
+        n_out: number of outputs
+        n_tar: number of targets
+
+    Returns:
+        boolean of the assigned pairs
+
+    """
+    out_done, tar_done = bytearray(n_out), bytearray(n_tar)
+    is_match = bytearray(len(out_ix))
+
+    for i, (o, t) in enumerate(zip(out_ix.tolist(), tar_ix.tolist())):
+        if not out_done[o] and not tar_done[t]:
+            out_done[o], tar_done[t], is_match[i] = 1, 1, 1
+
+    return torch.from_numpy(np.frombuffer(is_match, dtype=bool).copy())
+
+
+def _sort_frames(frame_ix: torch.Tensor, mask: torch.BoolTensor) -> torch.Tensor:
+    """Index of the masked elements in order of their frame index (stable)."""
+    ix = mask.nonzero().squeeze(1)
+    return ix[_argsort_stable(frame_ix[ix])]
+
+
+def _argsort_stable(x: torch.Tensor) -> torch.LongTensor:
+    """Stable argsort (torch.sort has a stable option only from torch 1.9 on)."""
+    return torch.from_numpy(np.argsort(x.cpu().numpy(), kind='stable')).to(x.device)
@@ -6,7 +6,7 @@ import numpy as np
 import torch
 from pathlib import Path
 
-from . import slicing as gutil, test_utils as tutil
+from . import test_utils as tutil
 
 
 class EmitterSet:
@@ -23,13 +23,24 @@ class EmitterSet:
             xyz_cr: size N x 3. Cramer-Rao estimate of the emitters position.
             phot_cr: size N. Cramer-Rao estimate of the emitters photon count.
             bg_cr: size N. Cramer-Rao estimate of the emitters background value.
+            xyz_sig: size N x 3. Error estimate of the emitters position.
+            phot_sig: size N. Error estimate of the photon count.
+            bg_sig: size N. Error estimate of the background value.
             sanity_check: performs a sanity check if true.
             xy_unit: Unit of the x and y coordinate.
             px_size: Pixel size for unit conversion. If not specified, derived attributes (xyz_px and xyz_nm)
                 can not be accessed
+
+    Note:
+        The Cramer-Rao and error estimates (``*_cr``, ``*_sig``) are optional. They are not allocated unless they are
+        specified or accessed; when accessed without being specified they are filled with nan.
     """
     _eq_precision = 1E-8
     _xy_units = ('px', 'nm')
+    _h5_suffix = ('.h5', '.hdf5')
+    _data_holders = ('xyz', 'phot', 'frame_ix', 'id', 'prob', 'bg',
+                     'xyz_cr', 'phot_cr', 'bg_cr', 'xyz_sig', 'phot_sig', 'bg_sig')
+    _optional_holders = ('xyz_cr', 'phot_cr', 'bg_cr', 'xyz_sig', 'phot_sig', 'bg_sig')  # not allocated if not set
 
     def __init__(self, xyz: torch.Tensor, phot: torch.Tensor, frame_ix: torch.LongTensor,
                  id: torch.LongTensor = None, prob: torch.Tensor = None, bg: torch.Tensor = None,
@@ -65,31 +76,19 @@ class EmitterSet:
         self.prob = None
         self.bg = None
 
-        # Cramer-Rao values
-        self.xyz_cr = None
-        self.phot_cr = None
-        self.bg_cr = None
-
-        # Error estimates
-        self.xyz_sig = None
-        self.phot_sig = None
-        self.bg_sig = None
+        # Cramer-Rao values and error estimates are optional and only set if specified, i.e. remove previous ones
+        # in case of inplace replacement
+        for k in self._optional_holders + ('_view',):
+            self.__dict__.pop(k, None)
 
         self._set_typed(xyz=xyz, phot=phot, frame_ix=frame_ix, id=id, prob=prob, bg=bg,
                         xyz_cr=xyz_cr, phot_cr=phot_cr, bg_cr=bg_cr,
                         xyz_sig=xyz_sig, phot_sig=phot_sig, bg_sig=bg_sig)
 
         self._sorted = False
+        self._frame_index = None  # lazily built by _get_frame_index, invalidated when frame_ix changes
         # get at least one_dim tensors
-        at_least_one_dim(self.xyz,
-                         self.phot,
-                         self.frame_ix,
-                         self.id,
-                         self.prob,
-                         self.bg,
-                         self.xyz_cr,
-                         self.phot_cr,
-                         self.bg_cr)
+        at_least_one_dim(*self._get_data().values())
 
         self.xy_unit = xy_unit
         self.px_size = px_size
@@ -100,6 +99,27 @@ class EmitterSet:
         if sanity_check:
             self._sanity_check()
 
+    def __getattr__(self, item):
+        """
+        Materialises the data attributes of a view (see view) and optional attributes that have not been set
+        on first access. Only called if regular attribute lookup fails.
+        """
+        view = self.__dict__.get('_view')
+
+        if view is not None and item in view[0]:
+            columns, start, stop = view
+            value = columns[item][start:stop]
+
+        elif item in self._optional_holders and ('xyz' in self.__dict__ or view is not None):
+            value = float('nan') * torch.ones((len(self), 3) if item[:3] == 'xyz' else (len(self),),
+                                              dtype=self.xyz.dtype, device=self.xyz.device)
+
+        else:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{item}'")
+
+        self.__dict__[item] = value
+        return value
+
     @property
     def xyz_px(self) -> torch.Tensor:
         """
@@ -188,30 +208,33 @@ class EmitterSet:
         Returns dictionary representation of this EmitterSet so that the keys and variables correspond to what an
         EmitterSet would be initialised.
 
+        Optional attributes that are not set are None.
+
         Example:
             >>> em_dict = em.to_dict()  # any emitterset instance
             >>> em_clone = EmitterSet(**em_dict)  # returns a clone of the emitterset
 
         """
-        em_dict = {
-            'xyz': self.xyz,
-            'phot': self.phot,
-            'frame_ix': self.frame_ix,
-            'id': self.id,
-            'prob': self.prob,
-            'bg': self.bg,
-            'xyz_cr': self.xyz_cr,
-            'phot_cr': self.phot_cr,
-            'bg_cr': self.bg_cr,
-            'xyz_sig': self.xyz_sig,
-            'phot_sig': self.phot_sig,
-            'bg_sig': self.bg_sig,
+        data = self._get_data()
+
+        em_dict = {k: data.get(k) for k in self._data_holders}
+        em_dict.update({
             'xy_unit': self.xy_unit,
             'px_size': self.px_size
-        }
+        })
 
         return em_dict
 
+    def _get_data(self) -> dict:
+        """
+        Returns the data attributes that are set, i.e. optional attributes that are not set are not returned and not
+        allocated.
+        """
+        view = self.__dict__.get('_view')
+
+        return {k: getattr(self, k) for k in self._data_holders
+                if self.__dict__.get(k) is not None or (k not in self.__dict__ and view is not None and k in view[0])}
+
     # pickle
     def __getstate__(self):
         return self.to_dict()
@@ -223,6 +246,9 @@ class EmitterSet:
         """
         Pickle save's the dictionary of this instance. No legacy guarantees given.
         Should only be used for short-term storage.
+        If the file suffix is .h5 or .hdf5 the columnar, versioned HDF5 format of decode.utils.emitter_io is used.
+        Its frame index requires the emitters in order of their frame, i.e. they are (stably) sorted by frame_ix and
+        load returns them in this order, which differs from the order of this instance if it is not sorted.
 
         Args:
             file: path where to save
@@ -232,6 +258,11 @@ class EmitterSet:
         if not isinstance(file, Path):
             file = Path(file)
 
+        if file.suffix in self._h5_suffix:
+            from decode.utils import emitter_io  # avoid circular import
+            emitter_io.save_h5(file, self)
+            return
+
         em_dict = self.to_dict()
         torch.save(em_dict, file)
 
@@ -248,7 +279,12 @@ class EmitterSet:
 
         """
 
-        em_dict = torch.load(file)
+        if Path(file).suffix in EmitterSet._h5_suffix:
+            from decode.utils import emitter_io  # avoid circular import
+            em_dict = emitter_io.load_h5(file)
+        else:
+            em_dict = torch.load(file)
+
         return EmitterSet(**em_dict)
 
     def _set_typed(self, xyz, phot, frame_ix, id, prob, bg, xyz_cr, phot_cr, bg_cr, xyz_sig, phot_sig, bg_sig):
@@ -284,13 +320,13 @@ class EmitterSet:
             self.prob = prob.type(f_type) if prob is not None else torch.ones_like(frame_ix).type(f_type)
             self.bg = bg.type(f_type) if bg is not None else float('nan') * torch.ones_like(frame_ix).type(f_type)
 
-            self.xyz_cr = xyz_cr.type(f_type) if xyz_cr is not None else float('nan') * torch.ones_like(self.xyz)
-            self.phot_cr = phot_cr.type(f_type) if phot_cr is not None else float('nan') * torch.ones_like(self.phot)
-            self.bg_cr = bg_cr.type(f_type) if bg_cr is not None else float('nan') * torch.ones_like(self.bg)
+            # Cramer-Rao and error estimates are only set if specified (see __getattr__)
+            optionals = {'xyz_cr': xyz_cr, 'phot_cr': phot_cr, 'bg_cr': bg_cr,
+                         'xyz_sig': xyz_sig, 'phot_sig': phot_sig, 'bg_sig': bg_sig}
 
-            self.xyz_sig = xyz_sig.type(f_type) if xyz_sig is not None else float('nan') * torch.ones_like(self.xyz)
-            self.phot_sig = phot_sig.type(f_type) if phot_sig is not None else float('nan') * torch.ones_like(self.phot)
-            self.bg_sig = bg_sig.type(f_type) if bg_sig is not None else float('nan') * torch.ones_like(self.bg)
+            for k, v in optionals.items():
+                if v is not None:
+                    setattr(self, k, v.type(f_type))
 
         else:
             self.xyz = torch.zeros((0, 3)).type(f_type)
@@ -302,14 +338,6 @@ class EmitterSet:
             self.prob = torch.ones((0,)).type(f_type)
             self.bg = float('nan') * torch.ones_like(self.prob)
 
-            self.xyz_cr = float('nan') * torch.ones((0, 3)).type(f_type)
-            self.phot_cr = float('nan') * torch.ones_like(self.prob)
-            self.bg_cr = float('nan') * torch.ones_like(self.bg)
-
-            self.xyz_sig = float('nan') * torch.ones((0, 3)).type(f_type)
-            self.phot_sig = float('nan') * torch.ones_like(self.prob)
-            self.bg_sig = float('nan') * torch.ones_like(self.bg)
-
     def _inplace_replace(self, em):
         """
         Inplace replacement of this self instance. Does not work for inherited methods ...
@@ -318,21 +346,7 @@ class EmitterSet:
 
 
         """
-        self.__init__(xyz=em.xyz,
-                      phot=em.phot,
-                      frame_ix=em.frame_ix,
-                      id=em.id,
-                      prob=em.prob,
-                      bg=em.bg,
-                      xyz_cr=em.xyz_cr,
-                      phot_cr=em.phot_cr,
-                      bg_cr=em.bg_cr,
-                      xyz_sig=em.xyz_sig,
-                      phot_sig=em.phot_sig,
-                      bg_sig=em.bg_sig,
-                      sanity_check=True,
-                      xy_unit=em.xy_unit,
-                      px_size=em.px_size)
+        self.__init__(**em.to_dict(), sanity_check=True)
 
     def _sanity_check(self, check_uniqueness=False):
         """
@@ -344,8 +358,7 @@ class EmitterSet:
         Returns:
             (bool) sane or not sane
         """
-        if not same_shape_tensor(0, self.xyz, self.phot, self.frame_ix, self.id, self.bg,
-                                 self.xyz_cr, self.phot_cr, self.bg_cr):
+        if not same_shape_tensor(0, *self._get_data().values()):
             raise ValueError("Coordinates, photons, frame ix, id and prob are not of equal shape in 0th dimension.")
 
         if not same_dim_tensor(torch.ones(1), self.phot, self.prob, self.frame_ix, self.id):
@@ -409,8 +422,16 @@ class EmitterSet:
         def check_em_dict_equality(em_a: dict, em_b: dict) -> bool:
 
             for k in em_a.keys():
-                 if not tutil.tens_almeq(em_a[k], em_b[k], nan=True):
-                     return False
+                if em_a[k] is None and em_b[k] is None:  # optional attribute not set in both
+                    continue
+
+                elif em_a[k] is None or em_b[k] is None:  # not set is equivalent to nan
+                    set_val = em_a[k] if em_a[k] is not None else em_b[k]
+                    if not torch.isnan(set_val).all():
+                        return False
+
+                elif not tutil.tens_almeq(em_a[k], em_b[k], nan=True):
+                    return False
 
             return True
 
@@ -503,18 +524,7 @@ class EmitterSet:
             EmitterSet
 
         """
-        return EmitterSet(xyz=self.xyz.clone(),
-                          phot=self.phot.clone(),
-                          frame_ix=self.frame_ix.clone(),
-                          id=self.id.clone(),
-                          prob=self.prob.clone(),
-                          bg=self.bg.clone(),
-                          xyz_cr=self.xyz_cr.clone(),
-                          phot_cr=self.phot_cr.clone(),
-                          bg_cr=self.bg_cr.clone(),
-                          xyz_sig=self.xyz_sig.clone(),
-                          phot_sig=self.phot_sig.clone(),
-                          bg_sig=self.bg_sig.clone(),
+        return EmitterSet(**{k: v.clone() for k, v in self._get_data().items()},
                           sanity_check=False,
                           xy_unit=self.xy_unit,
                           px_size=self.px_size)
@@ -535,53 +545,14 @@ class EmitterSet:
             EmitterSet concatenated emitterset
 
         """
-        num_emittersets = len(emittersets)
+        # px_size and xy unit is taken from the first element that is not None (done by the builder)
+        builder = EmitterSetBuilder(capacity=sum([len(em) for em in emittersets]))
+        builder.extend(emittersets, remap_frame_ix=remap_frame_ix, step_frame_ix=step_frame_ix)
 
-        if remap_frame_ix is not None and step_frame_ix is not None:
-            raise ValueError("You cannot specify remap frame ix and step frame ix at the same time.")
-        elif remap_frame_ix is not None:
-            shift = remap_frame_ix.clone()
-        elif step_frame_ix is not None:
-            shift = torch.arange(0, num_emittersets) * step_frame_ix
-        else:
-            shift = torch.zeros(num_emittersets).int()
-
-        total_num_emitter = 0
-        for i in range(num_emittersets):
-            total_num_emitter += len(emittersets[i])
-
-        xyz = torch.cat([emittersets[i].xyz for i in range(num_emittersets)], 0)
-        phot = torch.cat([emittersets[i].phot for i in range(num_emittersets)], 0)
-        frame_ix = torch.cat([emittersets[i].frame_ix + shift[i] for i in range(num_emittersets)], 0)
-        id = torch.cat([emittersets[i].id for i in range(num_emittersets)], 0)
-        prob = torch.cat([emittersets[i].prob for i in range(num_emittersets)], 0)
-        bg = torch.cat([emittersets[i].bg for i in range(num_emittersets)], 0)
-
-        xyz_cr = torch.cat([emittersets[i].xyz_cr for i in range(num_emittersets)], 0)
-        phot_cr = torch.cat([emittersets[i].phot_cr for i in range(num_emittersets)], 0)
-        bg_cr = torch.cat([emittersets[i].bg_cr for i in range(num_emittersets)], 0)
-
-        xyz_sig = torch.cat([emittersets[i].xyz_sig for i in range(num_emittersets)], 0)
-        phot_sig = torch.cat([emittersets[i].phot_sig for i in range(num_emittersets)], 0)
-        bg_sig = torch.cat([emittersets[i].bg_sig for i in range(num_emittersets)], 0)
-
-        # px_size and xy unit is taken from the first element that is not None
-        xy_unit = None
-        px_size = None
-        for i in range(num_emittersets):
-            if emittersets[i].xy_unit is not None:
-                xy_unit = emittersets[i].xy_unit
-                break
-        for i in range(num_emittersets):
-            if emittersets[i].px_size is not None:
-                px_size = emittersets[i].px_size
-                break
-
-        return EmitterSet(xyz, phot, frame_ix, id, prob, bg,
-                          xyz_cr=xyz_cr, phot_cr=phot_cr, bg_cr=bg_cr,
-                          xyz_sig=xyz_sig, phot_sig=phot_sig, bg_sig=bg_sig,
-                          sanity_check=True,
-                          xy_unit=xy_unit, px_size=px_size)
+        em = builder.finalize()
+        em._sanity_check()
+
+        return em
 
     def sort_by_frame_(self):
         """
@@ -625,15 +596,106 @@ class EmitterSet:
         if isinstance(ix, (np.ndarray, np.generic)) and ix.size == 1:  # numpy support
             ix = [int(ix)]
 
-        return EmitterSet(xyz=self.xyz[ix], phot=self.phot[ix], frame_ix=self.frame_ix[ix], id=self.id[ix],
-                          prob=self.prob[ix], bg=self.bg[ix],
-                          xyz_sig=self.xyz_sig[ix], phot_sig=self.phot_sig[ix], bg_sig=self.bg_sig[ix],
-                          xyz_cr=self.xyz_cr[ix], phot_cr=self.phot_cr[ix], bg_cr=self.bg_cr[ix],
+        if isinstance(ix, slice) and ix.step in (None, 1):
+            return self._get_slice(*ix.indices(len(self))[:2])
+
+        return EmitterSet(**{k: v[ix] for k, v in self._get_data().items()},
                           sanity_check=False, xy_unit=self.xy_unit, px_size=self.px_size)
 
+    def _get_slice(self, start: int, stop: int):
+        """
+        Copy of the emitters start ... stop - 1. The attributes are valid already, i.e. the copy is set up without the
+        type conversions and checks of __init__.
+        """
+        em = EmitterSet.__new__(EmitterSet)
+        em.__dict__.update({k: v[start:stop].clone() for k, v in self._get_data().items()})
+        em._sorted = self._sorted
+        em._frame_index = None
+        em.xy_unit = self.xy_unit
+        em.px_size = self.px_size
+
+        return em
+
+    def view(self, start: int, stop: Optional[int], columns: dict = None):
+        """
+        Returns the emitters start ... stop - 1 as EmitterSet that shares memory with this instance (opt-in, e.g. for
+        read-only iteration over a large set). No data is copied, the attributes are sliced on first access. Assigning
+        an attribute of the view leaves this instance untouched, whereas inplace operations on the attributes of the
+        view modify this instance as well (as for numpy views). Indexing (em[start:stop]) returns a copy instead.
+
+        Args:
+            start: first emitter
+            stop: last emitter (excluding), None for all
+            columns: data attributes of this instance, can be given when many views are to be created
+
+        """
+        if columns is None:
+            columns = self._get_data()
+
+        start, stop = slice(start, stop).indices(len(self))[:2]
+
+        em = EmitterSet.__new__(EmitterSet)
+        em._view = (columns, start, max(start, stop))
+        em._sorted = self._sorted
+        em._frame_index = None
+        em.xy_unit = self.xy_unit
+        em.px_size = self.px_size
+
+        return em
+
+    def _get_frame_index(self):
+        """
+        Returns the (cached) frame index of this EmitterSet, i.e. a CSR like structure of start offsets per frame into
+        the emitters sorted by their frame index. The index is built lazily and rebuilt as soon as the frame_ix
+        attribute is replaced or modified inplace.
+
+        Returns:
+            perm (torch.Tensor, None): permutation that sorts the emitters by frame index (stable), None if sorted
+            frame_low (int): frame index the offsets refer to
+            offsets (np.ndarray): start offsets for frames frame_low ... frame_low + len(offsets) - 2 and end offset
+
+        """
+        frame_ix = self.frame_ix
+        cache = self._frame_index
+        if cache is not None and cache[0] is frame_ix and cache[1] == frame_ix._version:
+            return cache[2:]
+
+        frame_ix_np = frame_ix.cpu().numpy()
+        if len(frame_ix_np) >= 2 and (frame_ix_np[1:] < frame_ix_np[:-1]).any():
+            perm = np.argsort(frame_ix_np, kind='stable')
+            frame_ix_np = frame_ix_np[perm]
+            perm = torch.from_numpy(perm).to(frame_ix.device)
+        else:
+            perm = None
+
+        if len(frame_ix_np) == 0:
+            frame_low = 0
+            offsets = np.zeros(1, dtype=np.int64)
+        else:
+            frame_low = int(frame_ix_np[0])
+            offsets = np.searchsorted(frame_ix_np, np.arange(frame_low, int(frame_ix_np[-1]) + 2))
+
+        self._frame_index = (frame_ix, frame_ix._version, perm, frame_low, offsets)
+        return perm, frame_low, offsets
+
+    def _frame_bounds(self, frame_start, frame_end) -> tuple:
+        """
+        Start and end position of the emitters in frame range [frame_start, frame_end] in frame sorted order.
+        Vectorised, i.e. arguments may as well be arrays.
+
+        """
+        perm, frame_low, offsets = self._get_frame_index()
+        n = len(offsets) - 1
+
+        ix_start = offsets[np.clip(np.asarray(frame_start) - frame_low, 0, n)]
+        ix_end = offsets[np.clip(np.asarray(frame_end) + 1 - frame_low, 0, n)]
+
+        return ix_start, np.maximum(ix_start, ix_end)
+
     def get_subset_frame(self, frame_start, frame_end, frame_ix_shift=None):
         """
-        Returns emitters that are in the frame range as specified.
+        Returns emitters that are in the frame range as specified, as a copy (independent of the order of the set).
+        Uses the frame index, i.e. only the emitters of the frame range are copied.
 
         Args:
             frame_start: (int) lower frame index limit
@@ -643,9 +705,13 @@ class EmitterSet:
         Returns:
 
         """
+        ix_start, ix_end = self._frame_bounds(int(frame_start), int(frame_end))
+        perm = self._get_frame_index()[0]
 
-        ix = (self.frame_ix >= frame_start) * (self.frame_ix <= frame_end)
-        em = self[ix]
+        if perm is None:
+            em = self[int(ix_start):int(ix_end)]
+        else:  # sort the selected positions so that the original order is kept
+            em = self[perm[ix_start:ix_end].sort()[0]]
 
         if not frame_ix_shift:
             return em
@@ -697,6 +763,8 @@ class EmitterSet:
         """
         if dim is None:
             is_3d = False if self.dim() == 2 else True
+        else:
+            is_3d = dim == 3
 
         if fraction == 1.:
             return self
@@ -732,6 +800,8 @@ class EmitterSet:
     def split_in_frames(self, ix_low: int = 0, ix_up: int = None) -> list:
         """
         Splits a set of emitters in a list of emittersets based on their respective frame index.
+        The set is copied once (sorted by frame index) and the emittersets are views (see view) into disjoint parts of
+        the copy, i.e. they are independent of this set and of each other.
 
         Args:
             ix_low: (int, 0) lower bound
@@ -746,7 +816,15 @@ class EmitterSet:
         ix_low = ix_low if ix_low is not None else self.frame_ix.min().item()
         ix_up = ix_up if ix_up is not None else self.frame_ix.max().item()
 
-        return gutil.split_sliceable(x=self, x_ix=self.frame_ix, ix_low=ix_low, ix_high=ix_up)
+        frames = np.arange(ix_low, ix_up + 1)
+        ix_start, ix_end = self._frame_bounds(frames, frames)
+
+        """Sort (copy) once, the splits are slices of the sorted copy."""
+        perm = self._get_frame_index()[0]
+        em = self.clone() if perm is None else self[perm]
+        columns = em._get_data()
+
+        return [em.view(int(s), int(e), columns) for s, e in zip(ix_start, ix_end)]
 
     def _pxnm_conversion(self, xyz, in_unit, tar_unit, power: float = 1.):
 
@@ -832,18 +910,7 @@ class RandomEmitterSet(EmitterSet):
                          xy_unit=xy_unit, px_size=px_size)
 
     def _inplace_replace(self, em):
-        super().__init__(xyz=em.xyz,
-                         phot=em.phot,
-                         frame_ix=em.frame_ix,
-                         id=em.id,
-                         prob=em.prob,
-                         bg=em.bg,
-                         xyz_cr=em.xyz_cr,
-                         phot_cr=em.phot_cr,
-                         bg_cr=em.bg_cr,
-                         sanity_check=False,
-                         xy_unit=em.xy_unit,
-                         px_size=em.px_size)
+        EmitterSet.__init__(self, **em.to_dict(), sanity_check=False)
 
 
 class CoordinateOnlyEmitter(EmitterSet):
@@ -861,18 +928,7 @@ class CoordinateOnlyEmitter(EmitterSet):
                          xy_unit=xy_unit, px_size=px_size)
 
     def _inplace_replace(self, em):
-        super().__init__(xyz=em.xyz,
-                         phot=em.phot,
-                         frame_ix=em.frame_ix,
-                         id=em.id,
-                         prob=em.prob,
-                         bg=em.bg,
-                         xyz_cr=em.xyz_cr,
-                         phot_cr=em.phot_cr,
-                         bg_cr=em.bg_cr,
-                         sanity_check=False,
-                         xy_unit=em.xy_unit,
-                         px_size=em.px_size)
+        EmitterSet.__init__(self, **em.to_dict(), sanity_check=False)
 
 
 class EmptyEmitterSet(CoordinateOnlyEmitter):
@@ -882,18 +938,171 @@ class EmptyEmitterSet(CoordinateOnlyEmitter):
         super().__init__(torch.zeros((0, 3)), xy_unit=xy_unit, px_size=px_size)
 
     def _inplace_replace(self, em):
-        super().__init__(xyz=em.xyz,
-                         phot=em.phot,
-                         frame_ix=em.frame_ix,
-                         id=em.id,
-                         prob=em.prob,
-                         bg=em.bg,
-                         xyz_cr=em.xyz_cr,
-                         phot_cr=em.phot_cr,
-                         bg_cr=em.bg_cr,
-                         sanity_check=False,
-                         xy_unit=em.xy_unit,
-                         px_size=em.px_size)
+        EmitterSet.__init__(self, **em.to_dict(), sanity_check=False)
+
+
+class EmitterSetBuilder:
+    """
+    Accumulates emitters incrementally and returns them as a single EmitterSet. The attributes are stored in buffers
+    that grow geometrically, such that appending is amortised linear. Finalising copies only if the buffers are
+    considerably larger than the emitters, such that the EmitterSet does not keep the spare capacity alive.
+    Use this instead of collecting EmitterSets in a list and concatenating them at the end.
+
+    Example:
+        >>> builder = EmitterSetBuilder(xy_unit='px')
+        >>> for i, em in enumerate(emittersets):  # any iterable of emittersets
+        >>>     builder.append(em, frame_ix_shift=i * 64)
+        >>> em_all = builder.finalize()
+
+    """
+    _int_attr = ('frame_ix', 'id')
+    _default_val = {'id': -1, 'prob': 1.}  # everything else defaults to nan
+    _trim_factor = 1.25  # buffers are trimmed by finalize if their capacity exceeds the emitters by this factor
+
+    def __init__(self, xy_unit: str = None, px_size: Union[tuple, torch.Tensor] = None, capacity: int = 0):
+        """
+
+        Args:
+            xy_unit: unit of the coordinates, if None it is taken from the first appended set that specifies it
+            px_size: pixel size, if None it is taken from the first appended set that specifies it
+            capacity: initial number of emitters to allocate memory for (if known)
+
+        """
+        self.xy_unit = xy_unit
+        self.px_size = px_size
+
+        self._n = 0
+        self._capacity = capacity
+        self._buffers = dict()
+        self._f_type = None  # float type of the first appended set, for an empty output
+
+    def __len__(self):
+        return self._n
+
+    def append(self, em: EmitterSet, frame_ix_shift: int = 0):
+        """
+        Append the emitters of a set.
+
+        Args:
+            em: emitters to append
+            frame_ix_shift: shift added to the frame index of the emitters
+
+        """
+        if self.xy_unit is None:
+            self.xy_unit = em.xy_unit
+        if self.px_size is None:
+            self.px_size = em.px_size
+        if self._f_type is None:
+            self._f_type = em.xyz.dtype
+
+        if len(em) == 0:
+            return self
+
+        return self.append_columns(frame_ix_shift=frame_ix_shift, **em._get_data())
+
+    def append_columns(self, frame_ix_shift: int = 0, **columns):
+        """
+        Append emitters as specified by their attributes (as named in the EmitterSet). Attributes that are not
+        specified are filled with their default values.
+
+        Args:
+            frame_ix_shift: shift added to the frame index of the emitters
+            **columns: attributes, must contain at least xyz, phot and frame_ix
+
+        """
+        if self._f_type is None:
+            self._f_type = columns['xyz'].dtype
+
+        n_add = columns['xyz'].size(0)
+        if n_add == 0:
+            return self
+
+        self._reserve(n_add)
+        lo, hi = self._n, self._n + n_add
+
+        for k, v in columns.items():
+            if v is None:
+                continue
+
+            if k not in self._buffers:
+                self._add_buffer(k, v)
+
+            self._buffers[k][lo:hi] = v
+
+        for k, buf in self._buffers.items():
+            if columns.get(k) is None:
+                buf[lo:hi] = self._default_val.get(k, float('nan'))
+
+        if frame_ix_shift:
+            self._buffers['frame_ix'][lo:hi] += frame_ix_shift
+
+        self._n = hi
+        return self
+
+    def extend(self, emittersets, remap_frame_ix: Optional[torch.Tensor] = None, step_frame_ix: int = None):
+        """
+        Append an iterable of EmitterSets. Arguments for modifying the frame index are as in EmitterSet.cat.
+
+        Args:
+            emittersets: iterable of emittersets, may also be a generator
+            remap_frame_ix: optional index of 0th frame to map the corresponding emitterset to
+            step_frame_ix: optional step size of 0th frame between emittersets
+
+        """
+        if remap_frame_ix is not None and step_frame_ix is not None:
+            raise ValueError("You cannot specify remap frame ix and step frame ix at the same time.")
+
+        for i, em in enumerate(emittersets):
+            if remap_frame_ix is not None:
+                shift = int(remap_frame_ix[i])
+            elif step_frame_ix is not None:
+                shift = i * step_frame_ix
+            else:
+                shift = 0
+
+            self.append(em, frame_ix_shift=shift)
+
+        return self
+
+    def finalize(self) -> EmitterSet:
+        """
+        Returns the accumulated emitters. The EmitterSet shares memory with the buffers of this builder, which are
+        trimmed to the number of emitters before if they are considerably larger.
+
+        """
+        if self._n == 0 and 'xyz' not in self._buffers:
+            f_type = self._f_type if self._f_type is not None else torch.float
+            return EmitterSet(xyz=torch.zeros((0, 3), dtype=f_type), phot=torch.zeros((0,), dtype=f_type),
+                              frame_ix=torch.zeros((0,)).long(), sanity_check=False, xy_unit=self.xy_unit,
+                              px_size=self.px_size)
+
+        if self._capacity > self._trim_factor * self._n:
+            self._buffers = {k: buf[:self._n].clone() for k, buf in self._buffers.items()}
+            self._capacity = self._n
+
+        return EmitterSet(**{k: buf[:self._n] for k, buf in self._buffers.items()},
+                          sanity_check=False, xy_unit=self.xy_unit, px_size=self.px_size)
+
+    def _add_buffer(self, attr: str, val: torch.Tensor):
+        dtype = torch.int64 if attr in self._int_attr else val.dtype
+
+        buf = torch.empty((self._capacity, *val.shape[1:]), dtype=dtype, device=val.device)
+        if self._n >= 1:
+            buf[:self._n] = self._default_val.get(attr, float('nan'))
+        self._buffers[attr] = buf
+
+    def _reserve(self, n_add: int):
+        """Make sure there is space for n_add more emitters, grow buffers geometrically if not."""
+
+        n_req = self._n + n_add
+        if n_req <= self._capacity:
+            return
+
+        self._capacity = max(n_req, 2 * self._capacity)
+        for k, buf in self._buffers.items():
+            buf_new = buf.new_empty((self._capacity, *buf.shape[1:]))
+            buf_new[:self._n] = buf[:self._n]
+            self._buffers[k] = buf_new
 
 
 class LooseEmitterSet:
@@ -961,15 +1170,12 @@ class LooseEmitterSet:
     def te(self):  # end time
         return self.t0 + self.ontime
 
-    def _distribute_framewise(self):
+    def _distribute_framewise_builder(self):
         """
-        Distributes the emitters framewise and prepares them for EmitterSet format.
+        Distributes the emitters framewise and writes them into an EmitterSetBuilder.
 
         Returns:
-            xyz_ (torch.Tensor): coordinates
-            phot_ (torch.Tensor): photon count
-            frame_ (torch.Tensor): frame indices (the actual distribution)
-            id_ (torch.Tensor): identities
+            EmitterSetBuilder
 
         """
 
@@ -1008,33 +1214,44 @@ class LooseEmitterSet:
 
         # kick out everything that has no full frame_duration
         ix_full = frame_count_full >= 0
-        xyz_ = self.xyz[ix_full, :]
-        flux_ = self.intensity[ix_full]
-        id_ = self.id[ix_full]
-        frame_start_full = frame_start[ix_full]
         frame_dur_full_clean = frame_count_full[ix_full]
+        ix_with_last = frame_last >= frame_start + 1  # last (only if frame_last != frame_first)
+
+        n_full = int((frame_dur_full_clean + 1).sum())
+        builder = EmitterSetBuilder(xy_unit=self.xy_unit, px_size=self.px_size,
+                                    capacity=n_full + len(self.xyz) + int(ix_with_last.sum()))
 
-        xyz_ = xyz_.repeat_interleave(frame_dur_full_clean + 1, dim=0)
-        phot_ = flux_.repeat_interleave(frame_dur_full_clean + 1, dim=0)  # because intensity * 1 = phot
-        id_ = id_.repeat_interleave(frame_dur_full_clean + 1, dim=0)
+        id_ = self.id[ix_full].repeat_interleave(frame_dur_full_clean + 1, dim=0)
         # because 0 is first occurence
-        frame_ix_ = frame_start_full.repeat_interleave(frame_dur_full_clean + 1, dim=0) + cum_count_per_group(id_) + 1
+        builder.append_columns(
+            xyz=self.xyz[ix_full, :].repeat_interleave(frame_dur_full_clean + 1, dim=0),
+            phot=self.intensity[ix_full].repeat_interleave(frame_dur_full_clean + 1, dim=0),  # intensity * 1 = phot
+            frame_ix=frame_start[ix_full].repeat_interleave(frame_dur_full_clean + 1, dim=0)
+                     + cum_count_per_group(id_) + 1,
+            id=id_)
 
         """First frame"""
-        # first
-        xyz_ = torch.cat((xyz_, self.xyz), 0)
-        phot_ = torch.cat((phot_, self.intensity * ontime_first), 0)
-        id_ = torch.cat((id_, self.id), 0)
-        frame_ix_ = torch.cat((frame_ix_, frame_start), 0)
+        builder.append_columns(xyz=self.xyz, phot=self.intensity * ontime_first, frame_ix=frame_start, id=self.id)
+
+        """Last frame"""
+        builder.append_columns(xyz=self.xyz[ix_with_last], phot=self.intensity[ix_with_last] * ontime_last[ix_with_last],
+                               frame_ix=frame_last[ix_with_last], id=self.id[ix_with_last])
 
-        # last (only if frame_last != frame_first
-        ix_with_last = frame_last >= frame_start + 1
-        xyz_ = torch.cat((xyz_, self.xyz[ix_with_last]))
-        phot_ = torch.cat((phot_, self.intensity[ix_with_last] * ontime_last[ix_with_last]), 0)
-        id_ = torch.cat((id_, self.id[ix_with_last]), 0)
-        frame_ix_ = torch.cat((frame_ix_, frame_last[ix_with_last]))
+        return builder
 
-        return xyz_, phot_, frame_ix_, id_
+    def _distribute_framewise(self):
+        """
+        Distributes the emitters framewise and prepares them for EmitterSet format.
+
+        Returns:
+            xyz_ (torch.Tensor): coordinates
+            phot_ (torch.Tensor): photon count
+            frame_ (torch.Tensor): frame indices (the actual distribution)
+            id_ (torch.Tensor): identities
+
+        """
+        em = self._distribute_framewise_builder().finalize()
+        return em.xyz, em.phot, em.frame_ix, em.id
 
     def return_emitterset(self):
         """
@@ -1045,8 +1262,7 @@ class LooseEmitterSet:
             EmitterSet
         """
 
-        xyz_, phot_, frame_ix_, id_ = self._distribute_framewise()
-        return EmitterSet(xyz_, phot_, frame_ix_.long(), id_.long(), xy_unit=self.xy_unit, px_size=self.px_size)
+        return self._distribute_framewise_builder().finalize()
 
 
 def at_least_one_dim(*args):
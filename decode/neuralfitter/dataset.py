@@ -1,3 +1,4 @@
+import math
 import time
 
 import torch
@@ -195,7 +196,7 @@ class InferenceDataset(SMLMStaticDataset):
         """
 
         Args:
-            frames (torch.Tensor): frames
+            frames (torch.Tensor, FrameStack): frames, lazily loaded frames (FrameStack) are only read per sample
             frame_proc: frame processing function
             frame_window (int): frame window
         """
@@ -206,6 +207,67 @@ class InferenceDataset(SMLMStaticDataset):
         return frame
 
 
+class InferenceBatchDataset(SMLMStaticDataset):
+    """
+    A SMLM dataset without ground truth data whose items are whole batches. The frames of a batch are sliced as one
+    contiguous block (padded by replicating the first / last frame) and the frame windows are formed as strided view
+    of it, i.e. without indexing per sample and collating. Use with batch_size=None in the DataLoader.
+    Frame processing is applied once per block and must therefore be frame-wise.
+    """
+
+    def __init__(self, *, frames, frame_proc, frame_window, batch_size: int, pad: (str, None) = 'same'):
+        """
+
+        Args:
+            frames (torch.Tensor, FrameStack): frames
+            frame_proc: frame processing function
+            frame_window (int): frame window
+            batch_size: number of samples per batch
+            pad: pad mode, 'same' for a sample per frame, None for only the samples with a full frame window
+        """
+        super().__init__(frames=frames, emitter=None, frame_proc=frame_proc, bg_frame_proc=None, em_proc=None,
+                         tar_gen=None, pad=pad, frame_window=frame_window, return_em=False)
+
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return math.ceil(super().__len__() / self.batch_size)
+
+    def __getitem__(self, ix):
+        """
+        Get a batch.
+
+        Args:
+            ix (int): batch index
+
+        Returns:
+            frames (torch.Tensor): processed frames. N x C x H x W
+
+        """
+        if ix < 0 or ix >= len(self):
+            raise IndexError(f"Batch index {ix} out of range.")
+
+        hw = (self.frame_window - 1) // 2
+        n = self._frames.size(0)
+
+        """Frames of the first and last sample (with padded index)"""
+        start = self._pad_index(ix * self.batch_size)
+        stop = self._pad_index(min((ix + 1) * self.batch_size, super().__len__()))
+
+        lower, upper = max(start - hw, 0), min(stop + hw, n)
+        frames = self._frames[lower:upper]
+
+        """Replicate first / last frame at the border"""
+        pad_low, pad_up = hw - (start - lower), hw - (upper - stop)
+        if pad_low != 0 or pad_up != 0:
+            frames = torch.cat([frames[:1].expand(pad_low, -1, -1), frames, frames[-1:].expand(pad_up, -1, -1)], 0)
+
+        if self.frame_proc is not None:
+            frames = self.frame_proc.forward(frames)
+
+        return frames.unfold(0, self.frame_window, 1).permute(0, 3, 1, 2)
+
+
 class SMLMLiveDataset(SMLMStaticDataset):
     """
     A SMLM dataset where new datasets is sampleable via the sample() method of the simulation instance.
@@ -0,0 +1,328 @@
+"""
+Fit frames with a trained model from the command line, i.e. the Fit notebook as a script for batch fitting:
+
+    python -m decode.neuralfitter.fit -m model.pt -p param_run.yaml -f frames.tif -o emitters.h5
+
+At the end, the throughput (frames/s, emitters/s), the time per stage and the peak memory are reported.
+"""
+import argparse
+import json
+import pathlib
+import sys
+import time
+from typing import Optional, Union
+
+import torch
+import yaml
+
+import decode.neuralfitter
+import decode.neuralfitter.utils
+import decode.simulation
+import decode.utils
+from decode.neuralfitter.inference import autotune
+from decode.neuralfitter.inference.inference import Infer
+
+
+def parse_args(args=None):
+    """
+    Parse input arguments
+
+    """
+    parser = argparse.ArgumentParser(description='Fit Args')
+
+    parser.add_argument('-m', '--model', help='Specify the model file (.pt).', required=True)
+
+    parser.add_argument('-p', '--param_file', help='Specify the parameter file the model was trained with.',
+                        required=True)
+
+    parser.add_argument('-f', '--frames', help='Specify the tiff file or folder of tiff files.', required=True)
+
+    parser.add_argument('-o', '--output',
+                        help='Specify the output file (.h5 or .csv), or the output folder if --per_file is set.',
+                        required=True)
+
+    parser.add_argument('--per_file', default=False, action='store_true',
+                        help='Fit the tiff files of the frames folder separately, one output file per tiff file.')
+
+    parser.add_argument('--format', default='h5', choices=['h5', 'csv'],
+                        help='Output format if --per_file is set.')
+
+    parser.add_argument('--camera', default=None,
+                        help='Specify a meta file (.yaml) with the camera parameters of the frames (as in the Fit '
+                             'notebook). Overwrites the camera of the parameter file.')
+
+    parser.add_argument('-d', '--device', default='cuda:0' if torch.cuda.is_available() else 'cpu',
+                        help='Specify the device.')
+
+    parser.add_argument('-b', '--batch_size', default='auto',
+                        help='Specify the batch size (integer or auto).')
+
+    parser.add_argument('-w', '--num_workers', default=0, type=int,
+                        help='Specify the number of workers for frame loading.')
+
+    parser.add_argument('-t', '--threads', default=None, type=int,
+                        help='Specify the number of torch threads.')
+
+    parser.add_argument('-c', '--chunk_size', default=1000, type=int,
+                        help='Specify the number of frames that are fit and written at once.')
+
+    parser.add_argument('--raw_th', default=None, type=float,
+                        help='Overwrite the detection threshold of the post-processing.')
+
+    parser.add_argument('--report_file', default=None,
+                        help='Specify a json file to which the throughput report is written.')
+
+    return parser.parse_args(args)
+
+
+def setup_frame_proc(param):
+    """
+    Frame processing as by the parameters with which the model was trained.
+
+    Args:
+        param: parameters
+
+    """
+    camera = decode.simulation.camera.Photon2Camera.parse(param)
+    camera.device = 'cpu'
+
+    return decode.neuralfitter.utils.processing.TransformSequence([
+        decode.neuralfitter.utils.processing.wrap_callable(camera.backward),
+        decode.neuralfitter.frame_processing.AutoCenterCrop(8),
+        decode.neuralfitter.frame_processing.Mirror2D(dims=-1),
+        decode.neuralfitter.scale_transform.AmplitudeRescale.parse(param)
+    ])
+
+
+def setup_post_proc(param, frame_size: torch.Size, raw_th: Optional[float] = None):
+    """
+    Post-processing as by the parameters: backscaling, relative to absolute coordinates and frame to emitter
+    conversion.
+
+    Args:
+        param: parameters
+        frame_size: frame size after frame processing
+        raw_th: detection threshold, defaults to the one of the parameters
+
+    """
+    frame_extent = ((-0.5, frame_size[-2] - 0.5), (-0.5, frame_size[-1] - 0.5))
+    raw_th = raw_th if raw_th is not None else param.PostProcessingParam.raw_th
+
+    if param.PostProcessing == 'LookUp':
+        em_proc = decode.neuralfitter.post_processing.LookUpPostProcessing(raw_th=raw_th,
+                                                                           pphotxyzbg_mapping=[0, 1, 2, 3, 4, -1],
+                                                                           photxyz_sigma_mapping=[5, 6, 7, 8],
+                                                                           xy_unit='px',
+                                                                           px_size=param.Camera.px_size)
+
+    elif param.PostProcessing == 'NMS':
+        em_proc = decode.neuralfitter.post_processing.NMSPostProcessing(raw_th=raw_th,
+                                                                        xy_unit='px',
+                                                                        px_size=param.Camera.px_size)
+
+    else:
+        raise ValueError(f"Unsupported post-processing {param.PostProcessing} for fitting. "
+                         f"Supported are LookUp and NMS.")
+
+    return decode.neuralfitter.utils.processing.TransformSequence([
+        decode.neuralfitter.scale_transform.InverseParamListRescale.parse(param),
+        decode.neuralfitter.coord_transform.Offset2Coordinate(xextent=frame_extent[0],
+                                                              yextent=frame_extent[1],
+                                                              img_shape=frame_size[-2:]),
+        em_proc
+    ])
+
+
+def fit(model_file: Union[str, pathlib.Path], param_file: Union[str, pathlib.Path],
+        frames: Union[str, pathlib.Path], output: Union[str, pathlib.Path], per_file: bool = False,
+        format: str = 'h5', camera_file: Optional[Union[str, pathlib.Path]] = None, device: str = 'cpu',
+        batch_size: Union[int, str] = 'auto', num_workers: int = 0, threads: Optional[int] = None,
+        chunk_size: int = 1000, raw_th: Optional[float] = None,
+        report_file: Optional[Union[str, pathlib.Path]] = None) -> dict:
+    """
+    Fits the frames with the model and writes the emitters chunk by chunk, i.e. memory is bounded by the chunk size
+    and not by the length of the acquisition.
+
+    Args:
+        model_file: model weights
+        param_file: parameters the model was trained with
+        frames: tiff file or folder of tiff files (concatenated in sorted order unless per_file)
+        output: output file (.h5 or .csv), or output folder if per_file
+        per_file: fit the tiff files of the frames folder separately (prefetched by a BatchFileLoader), one output
+            file per tiff file
+        format: output format if per_file ('h5' or 'csv')
+        camera_file: meta file (.yaml) with the camera parameters of the frames
+        device: device
+        batch_size: batch size or 'auto', which picks the fastest batch size by a calibration run on the first
+            frames (see InferAutotuner, the result is cached per machine and model)
+        num_workers: number of workers for frame loading
+        threads: number of torch threads
+        chunk_size: number of frames per chunk
+        raw_th: detection threshold, defaults to the one of the parameters
+        report_file: json file to which the report is written
+
+    Returns:
+        report (see report)
+
+    """
+    t0 = time.perf_counter()
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    """Load parameters, overwrite camera and load model"""
+    param = decode.utils.param_io.load_params(param_file)
+
+    if camera_file is not None:
+        with pathlib.Path(camera_file).open('r') as f:
+            meta = yaml.safe_load(f)
+
+        param = decode.utils.param_io.autofill_dict(meta['Camera'], param.to_dict(), mode_missing='include')
+        param = decode.utils.param_io.RecursiveNamespace(**param)
+
+    model = decode.neuralfitter.models.SigmaMUNet.parse(param)
+    model = decode.utils.model_io.LoadSaveModel(model, input_file=model_file, output_file=None).load_init(device=device)
+
+    """Setup processing (the post-processing depends on the frame size after frame processing)"""
+    if per_file:
+        source = decode.utils.frames_io.BatchFileLoader(frames, prefetch=1)
+        if len(source) == 0:
+            raise ValueError(f"No tif files found in {str(frames)}.")
+        frames_calib = decode.utils.frames_io.FrameStack(source.files[0])
+    else:
+        source = decode.utils.frames_io.FrameStack(frames)
+        frames_calib = source
+    frame_size = frames_calib[:1].size()
+
+    frame_proc = setup_frame_proc(param)
+    size_procced = decode.neuralfitter.frame_processing.get_frame_extent(frame_size[:1] + (1,) + frame_size[1:],
+                                                                       frame_proc.forward)
+    post_proc = setup_post_proc(param, size_procced, raw_th=raw_th)
+
+    infer = Infer(model=model, ch_in=param.HyperParameter.channels_in, frame_proc=frame_proc, post_proc=post_proc,
+                  device=device, batch_size=64 if batch_size == 'auto' else int(batch_size), num_workers=num_workers)
+
+    """Resolve automatic batch size by a calibration run on the first frames (threads and workers as specified)"""
+    if batch_size == 'auto':
+        tuner = autotune.InferAutotuner(threads=(torch.get_num_threads(),), workers=(num_workers,))
+        tuner.tune(infer, frames_calib)
+        infer.reset_metrics()
+
+    """Fit"""
+    n_em, t_write = 0, 0.
+    t_fit = time.perf_counter()
+    if per_file:
+        output = pathlib.Path(output)
+        output.mkdir(parents=True, exist_ok=True)
+
+        with source:  # stops the prefetching also if a file fails
+            for frames_file, file in source:
+                n_em_file, t_write_file = _fit_write(infer, frames_file, output / f"{file.stem}.{format}",
+                                                     chunk_size)
+                n_em += n_em_file
+                t_write += t_write_file
+
+    else:
+        n_em, t_write = _fit_write(infer, source, output, chunk_size)
+
+    t_fit = time.perf_counter() - t_fit
+
+    rep = report(infer.metrics, n_em=n_em, t_write=t_write, t_fit=t_fit, t_total=time.perf_counter() - t0,
+                 loader=source.metrics if per_file else None)
+
+    if report_file is not None:
+        with pathlib.Path(report_file).open('w') as f:
+            json.dump(rep, f, indent=2)
+
+    return rep
+
+
+def _fit_write(infer: Infer, frames, output: Union[str, pathlib.Path], chunk_size: int):
+    """Fits the frames chunk by chunk and appends the emitters to the output file."""
+    suffix = pathlib.Path(output).suffix
+
+    if suffix == '.h5':
+        writer = decode.utils.emitter_io.EmitterWriterH5(output)
+    elif suffix == '.csv':
+        writer = decode.utils.emitter_io.EmitterWriterCSV(output)
+    else:
+        raise ValueError(f"Unsupported output format {suffix}. Supported are .h5 and .csv.")
+
+    n_em, t_write = 0, 0.
+    with writer:
+        for em in infer.forward_stream(frames, chunk_size=chunk_size):
+            t0 = time.perf_counter()
+            writer.append(em)
+            t_write += time.perf_counter() - t0
+            n_em += len(em)
+
+    return n_em, t_write
+
+
+def report(metrics: dict, n_em: int, t_write: float, t_fit: float, t_total: float,
+           loader: Optional[dict] = None) -> dict:
+    """
+    Throughput report of a fit. The throughput is computed from the wall-clock time of the fit, the times of the
+    stages are reported separately. They overlap (prefetching loader, pipelined post-processing), i.e. their sum may
+    exceed the wall-clock time.
+
+    Args:
+        metrics: metrics of the inference (see Infer.metrics)
+        n_em: number of fitted emitters
+        t_write: time spent writing the emitters (s)
+        t_fit: wall-clock time of the fit, i.e. of reading, inference and writing (s)
+        t_total: total time including setup (s)
+        loader: metrics of the file loader (see BatchFileLoader.metrics)
+
+    """
+    rep = {
+        'frames': metrics['frames'],
+        'emitters': n_em,
+        'frames_per_s': metrics['frames'] / t_fit if t_fit > 0 else None,
+        'emitters_per_s': n_em / t_fit if t_fit > 0 else None,
+        't_load': metrics['t_load'],
+        't_model': metrics['t_model'],
+        't_post_proc': metrics['t_post_proc'],
+        't_write': t_write,
+        't_fit': t_fit,
+        't_total': t_total,
+        'peak_rss_mb': peak_rss(),
+    }
+    if loader is not None:
+        rep.update({'files': loader['files'], 't_file_load': loader['t_load'], 't_file_wait': loader['t_wait']})
+
+    return rep
+
+
+def format_report(rep: dict) -> str:
+    lines = []
+    for k, v in rep.items():
+        lines.append(f"{k:>16}: {v:.3f}" if isinstance(v, float) else f"{k:>16}: {v}")
+
+    return '\n'.join(lines)
+
+
+def peak_rss() -> Optional[float]:
+    """Peak resident memory of this process in MB (None if not available on this platform)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10  # bytes on macos, kilobytes on linux
+
+
+def main():
+    args = parse_args()
+
+    rep = fit(model_file=args.model, param_file=args.param_file, frames=args.frames, output=args.output,
+              per_file=args.per_file, format=args.format, camera_file=args.camera, device=args.device,
+              batch_size=args.batch_size, num_workers=args.num_workers, threads=args.threads,
+              chunk_size=args.chunk_size, raw_th=args.raw_th, report_file=args.report_file)
+
+    print(format_report(rep))
+
+
+if __name__ == '__main__':
+    main()
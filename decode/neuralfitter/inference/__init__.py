@@ -1 +1,8 @@
 import decode.neuralfitter.inference.inference
+import decode.neuralfitter.inference.output_cache
+import decode.neuralfitter.inference.sharded
+import decode.neuralfitter.inference.autotune
+import decode.neuralfitter.inference.precision
+import decode.neuralfitter.inference.export
+import decode.neuralfitter.inference.runtime
+import decode.neuralfitter.inference.resumable
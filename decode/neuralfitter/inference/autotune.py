@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import pathlib
+import time
+from typing import Optional, Sequence, Union
+
+import torch
+
+from ...utils import frames_io, hardware
+from .inference import Infer
+
+
+def model_signature(model: torch.nn.Module, ch_in: int, frame_size: Sequence[int]) -> str:
+    """
+    Signature of the model with respect to its speed, i.e. architecture and size of the input but not the weights.
+
+    Args:
+        model: model
+        ch_in: number of input channels
+        frame_size: size of the frames (H x W)
+
+    """
+    hasher = hashlib.sha1()
+    hasher.update(f'{type(model).__module__}.{type(model).__qualname__}|{ch_in}|{tuple(frame_size)}'.encode())
+    for k, v in model.state_dict().items():
+        hasher.update(f'|{k}:{tuple(v.size())}:{v.dtype}'.encode())
+
+    return hasher.hexdigest()
+
+
+class InferAutotuner:
+    """
+    Tunes batch size, number of torch threads and number of data loading workers of an Infer instance by benchmarking
+    short calibration runs and picking the configuration with the highest frames/s. The parameters are tuned one
+    after another (threads, batch size, workers), each with the best values found so far for the others, which keeps
+    the calibration short compared to benchmarking all combinations.
+    The result is cached per machine, model signature and the settings of the inference that change the cost of a
+    batch (precision, memory format and tiling), such that subsequent runs on the same kind of node pick it up
+    without benchmarking.
+
+    Example:
+        >>> InferAutotuner().tune(infer, frames)  # sets infer.batch_size, infer.num_workers and the torch threads
+        >>> em = infer.forward(frames)
+
+    """
+    _cache_file_default = pathlib.Path.home() / '.cache' / 'decode' / 'autotune.json'
+
+    def __init__(self, batch_sizes: Sequence[int] = (8, 16, 32, 64, 128), threads: Optional[Sequence[int]] = None,
+                 workers: Sequence[int] = (0, 2, 4), n_frames: int = 256, memory_cap: Optional[float] = None,
+                 cache_file: Optional[Union[str, pathlib.Path]] = _cache_file_default):
+        """
+
+        Args:
+            batch_sizes: candidate batch sizes
+            threads: candidate number of torch (intra-op) threads. Defaults to powers of two up to the number of cpu
+            cores and the number of cores itself.
+            workers: candidate number of data loading workers
+            n_frames: number of frames of a calibration run
+            memory_cap: maximum memory (bytes) of the batches in flight. On cuda devices the peak memory of the
+            calibration run is measured, otherwise the memory of the input and output batches is estimated.
+            Configurations above the cap are skipped.
+            cache_file: json file of tuned configurations, None for no caching
+
+        """
+        n_cpu = os.cpu_count() or 1
+
+        self.batch_sizes = batch_sizes
+        self.threads = threads if threads is not None else \
+            sorted({2 ** i for i in range(n_cpu.bit_length()) if 2 ** i <= n_cpu} | {n_cpu})
+        self.workers = workers
+        self.n_frames = n_frames
+        self.memory_cap = memory_cap
+        self.cache_file = pathlib.Path(cache_file) if cache_file is not None else None
+
+        self.benchmarks = []  # (config, frames/s) of the last tuning
+
+    def tune(self, infer: Infer, frames: Union[torch.Tensor, frames_io.FrameStack], force: bool = False) -> dict:
+        """
+        Tunes and applies the configuration to the inference (batch size and number of workers) and to torch (number
+        of threads, process wide).
+
+        Args:
+            infer: inference
+            frames: frames of which the first n_frames are used for calibration
+            force: benchmark even if a cached configuration exists
+
+        Returns:
+            dict: batch_size, threads, num_workers and frames/s of the chosen configuration
+
+        """
+        frames = frames[:self.n_frames]
+        key = f'{hardware.machine_signature(infer.device)}|{infer.device}|' \
+              f'{model_signature(infer.model, infer.ch_in, frames.shape[-2:])}|' \
+              f'{infer.precision}|channels_last={infer.channels_last}|' \
+              f'tile={infer.tile_size},{infer.tile_overlap}'
+
+        cache = self._load_cache()
+        if not force and key in cache:
+            config = cache[key]
+        else:
+            config = self._search(infer, frames)
+            cache[key] = config
+            self._save_cache(cache)
+
+        self._apply(infer, config)
+        return config
+
+    def _search(self, infer: Infer, frames: torch.Tensor) -> dict:
+        self.benchmarks = []
+
+        config = {'batch_size': infer.batch_size, 'threads': torch.get_num_threads(),
+                  'num_workers': infer.num_workers}
+        if config['batch_size'] not in self.batch_sizes:
+            config['batch_size'] = min(self.batch_sizes, key=lambda b: abs(b - infer.batch_size))
+
+        """Warm-up, the first run includes one-time initialisations"""
+        self._benchmark(infer, frames[:min(len(frames), config['batch_size'])], {**config, 'num_workers': 0})
+
+        fps_best = None
+        for k, candidates in (('threads', self.threads), ('batch_size', self.batch_sizes),
+                              ('num_workers', self.workers)):
+            for c in candidates:
+                fps = self._benchmark(infer, frames, {**config, k: c})
+                if fps is not None and (fps_best is None or fps > fps_best):
+                    fps_best = fps
+                    config[k] = c
+
+        if fps_best is None:
+            raise ValueError("No configuration within the memory cap.")
+
+        return {**config, 'fps': fps_best}
+
+    def _benchmark(self, infer: Infer, frames: torch.Tensor, config: dict) -> Optional[float]:
+        """Frames/s of the configuration, None if it exceeds the memory cap."""
+
+        if self.memory_cap is not None and torch.device(infer.device).type != 'cuda' \
+                and self._memory_estimate(infer, frames, config) > self.memory_cap:
+            return None
+
+        self._apply(infer, config)
+        if torch.device(infer.device).type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(infer.device)
+
+        t0 = time.perf_counter()
+        infer.forward(frames)
+        if torch.device(infer.device).type == 'cuda':
+            torch.cuda.synchronize(infer.device)
+        fps = len(frames) / (time.perf_counter() - t0)
+
+        if self.memory_cap is not None and torch.device(infer.device).type == 'cuda' \
+                and torch.cuda.max_memory_allocated(infer.device) > self.memory_cap:
+            return None
+
+        self.benchmarks.append((dict(config), fps))
+        return fps
+
+    @staticmethod
+    def _memory_estimate(infer: Infer, frames: torch.Tensor, config: dict) -> float:
+        """Bytes of the input and output batches in flight (the data loader prefetches two batches per worker)."""
+        with torch.no_grad():
+            n_out = infer._forward_model(infer.model.to(infer.device).eval(),
+                                         torch.zeros(1, infer.ch_in, *frames.shape[-2:], device=infer.device)).numel()
+
+        n_in = infer.ch_in * frames.shape[-2] * frames.shape[-1]
+        n_batches = 1 + 2 * config['num_workers']
+
+        return config['batch_size'] * (n_in * n_batches + n_out) * 4
+
+    @staticmethod
+    def _apply(infer: Infer, config: dict):
+        infer.batch_size = config['batch_size']
+        infer.num_workers = config['num_workers']
+        torch.set_num_threads(config['threads'])
+
+    def _load_cache(self) -> dict:
+        if self.cache_file is None or not self.cache_file.is_file():
+            return {}
+
+        with self.cache_file.open() as f:
+            return json.load(f)
+
+    def _save_cache(self, cache: dict):
+        if self.cache_file is None:
+            return
+
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        file_tmp = self.cache_file.with_suffix('.tmp')
+        with file_tmp.open('w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(file_tmp, self.cache_file)
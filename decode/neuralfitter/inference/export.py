@@ -0,0 +1,121 @@
+import json
+import pathlib
+from typing import Optional, Sequence, Union
+
+import torch
+
+from .. import post_processing
+from ..utils import processing
+from . import runtime
+
+
+class FitModule(torch.nn.Module):
+    """
+    Pre-processing, model and the tensor stages of the post-processing as a single module with tensor outputs, such
+    that it can be traced to TorchScript or exported to ONNX.
+
+    The input is a block of raw frames (T x H x W) including the (ch_in - 1) / 2 halo frames at both ends, the outputs
+    are the frame index (relative to the first frame after the halo) and the features (columns) of the detected
+    emitters.
+
+    """
+
+    def __init__(self, model: torch.nn.Module, ch_in: int, frame_proc, post_proc):
+        """
+
+        Args:
+            model: model
+            ch_in: number of input channels (frame window)
+            frame_proc: pre-processing with tensor stages only (e.g. AmplitudeRescale)
+            post_proc: LookUpPostProcessing or TransformSequence of tensor stages (e.g. InverseParamListRescale,
+            Offset2Coordinate) that ends with a LookUpPostProcessing
+
+        """
+        super().__init__()
+
+        stages = list(post_proc.com) if isinstance(post_proc, processing.TransformSequence) else [post_proc]
+        if type(stages[-1]) is not post_processing.LookUpPostProcessing:
+            raise ValueError("Post-processing must end with a LookUpPostProcessing.")
+
+        self.model = model
+        self.ch_in = ch_in
+        self.frame_proc = frame_proc
+        self.post_stages = stages[:-1]
+        self.lookup = stages[-1]
+
+    @property
+    def columns(self) -> list:
+        columns = ['prob', 'phot', 'x', 'y', 'z', 'bg']
+        if self.lookup.photxyz_sigma_mapping is not None:
+            columns += ['phot_sig', 'x_sig', 'y_sig', 'z_sig']
+
+        return columns
+
+    def forward(self, frames: torch.Tensor):
+        if self.frame_proc is not None:
+            frames = self.frame_proc.forward(frames)
+
+        """Frame windows of the frames after the halo (shifted slices rather than unfold, which ONNX lacks)"""
+        n = frames.size(0) - self.ch_in + 1
+        x = torch.stack([frames[i:i + n] for i in range(self.ch_in)], 1)
+        x = self.model(x)
+
+        for stage in self.post_stages:
+            x = stage.forward(x)
+
+        """Look-up of the features of the active pixels"""
+        x_mapped = x[:, self.lookup.pphotxyzbg_mapping]
+        active_px = self.lookup._filter(x_mapped[:, 0])
+
+        features = [x_mapped]
+        if self.lookup.photxyz_sigma_mapping is not None:
+            features.append(x[:, self.lookup.photxyz_sigma_mapping])
+
+        frame_ix, features = self.lookup._lookup_features(torch.cat(features, 1), active_px)
+
+        return frame_ix, features.transpose(0, 1)
+
+
+def export(file: Union[str, pathlib.Path], model: torch.nn.Module, ch_in: int, frame_proc, post_proc,
+           frame_size: Sequence[int], px_size: Optional[Sequence[float]] = None, xy_unit: str = 'px',
+           format: str = 'torchscript', opset_version: int = 13):
+    """
+    Exports model, pre- and post-processing as single graph for deployment without the decode package and parameter
+    files (see runtime). Next to the graph, the meta data (frame window, columns, units) is written as json sidecar
+    file.
+
+    Args:
+        file: output file (.pt for TorchScript, .onnx for ONNX)
+        model: model
+        ch_in: number of input channels (frame window)
+        frame_proc: pre-processing (see FitModule)
+        post_proc: post-processing (see FitModule)
+        frame_size: frame size (H x W), the graph is specific to it because of the coordinate offsets
+        px_size: pixel size
+        xy_unit: xy unit of the output
+        format: 'torchscript' or 'onnx'
+        opset_version: ONNX opset version
+
+    """
+    file = pathlib.Path(file)
+
+    fit = FitModule(model=model, ch_in=ch_in, frame_proc=frame_proc, post_proc=post_proc).cpu().eval()
+    example = torch.rand(ch_in + 1, *frame_size)
+
+    with torch.no_grad():
+        if format == 'torchscript':
+            torch.jit.trace(fit, example, check_trace=False).save(str(file))
+
+        elif format == 'onnx':
+            torch.onnx.export(fit, example, str(file), input_names=['frames'], output_names=['frame_ix', 'features'],
+                              dynamic_axes={'frames': {0: 'n_frames'}, 'frame_ix': {0: 'n'}, 'features': {0: 'n'}},
+                              opset_version=opset_version)
+
+        else:
+            raise ValueError(f"Unsupported export format {format}. Supported are 'torchscript' and 'onnx'.")
+
+    meta = {'format': format, 'ch_in': ch_in, 'frame_size': list(frame_size), 'columns': fit.columns,
+            'xy_unit': xy_unit, 'px_size': list(px_size) if px_size is not None else None}
+
+    with runtime.meta_file(file).open('w') as f:
+        json.dump(meta, f, indent=2)
@@ -1,18 +1,31 @@
-from typing import Union, Callable
+import collections
+import concurrent.futures
+import functools
+import itertools
+import time
+from typing import Union, Callable, Iterable, Iterator, Optional, Tuple
 
 import torch
 from tqdm import tqdm
 
 from .. import dataset
 from ...generic import emitter
-from functools import partial
+from ...utils import frames_io
+from .output_cache import OutputCacheWriter
 
 
 class Infer:
+    _post_proc_pools = {'thread': concurrent.futures.ThreadPoolExecutor,
+                        'process': concurrent.futures.ProcessPoolExecutor}
+    _precisions = ('fp32', 'bf16')
 
     def __init__(self, model, ch_in: int, frame_proc, post_proc, device: Union[str, torch.device],
                  batch_size: int = 64, num_workers: int = 4, pin_memory: bool = True,
-                 forward_cat: Union[str, Callable] = 'emitter'):
+                 forward_cat: Union[str, Callable] = 'emitter', post_proc_workers: int = 0,
+                 post_proc_pool: str = 'thread', batch_windows: bool = False,
+                 tile_size: Optional[Tuple[int, int]] = None, tile_overlap: int = 0,
+                 output_cache: Optional[OutputCacheWriter] = None, precision: str = 'fp32',
+                 channels_last: bool = False):
         """
         Convenience class for inference.
 
@@ -27,7 +40,30 @@ class Infer:
             pin_memory:
             forward_cat: method which concatenates the output batches. Can be string or Callable.
             Use 'em' when the post-processor outputs an EmitterSet, or 'frames' when you don't use post-processing or if
-            the post-processor outputs frames.
+            the post-processor outputs frames. A Callable gets the list of batch outputs.
+            post_proc_workers: number of post-processing workers. If > 0, batches are post-processed in a worker pool
+            while the model forwards the next batches. 0 post-processes each batch synchronously.
+            post_proc_pool: 'thread' or 'process' pool of post-processing workers. A process pool requires the
+            post-processing to be picklable.
+            batch_windows: form the frame windows per batch as strided view of a contiguous block of frames (see
+            InferenceBatchDataset) instead of per sample. Faster, but the frame processing then gets a block of
+            frames instead of a window, i.e. it is only the same if the frame processing is frame-wise.
+            tile_size: if not None, the model forwards overlapping tiles of this size (H x W) of the frames, batched
+            across the frames, and only the core of each tile is put into the output. The output is the same as for
+            the whole frame if the overlap covers the receptive field of the model and the tile positions are
+            multiples of its downsampling factor (i.e. frame size, tile size and overlap are multiples of it).
+            With tiling, batch_size is the number of tiles per model forward. A batch holds as many frames as have at
+            most batch_size tiles together (at least one frame) and its tiles are forwarded across tile positions and
+            frames in forwards of batch_size tiles. Memory is then bounded by batch_size tiles for the model and by
+            max(batch_size tiles, one frame) for the input, the stitched output and the post-processing, i.e. only
+            a single frame of more than batch_size tiles grows the memory with the frame size.
+            tile_overlap: overlap of the tiles on each side in px
+            output_cache: if not None, the raw model output is additionally written to this cache, such that
+            post-processing can be re-run without inference (see PostProcessing.from_cache)
+            precision: 'fp32' or 'bf16'. The latter runs the model under bfloat16 autocast (requires torch >= 1.10),
+            the output is converted back to fp32. For int8 pass a quantized model (e.g. SigmaMUNet.quantize).
+            channels_last: run the model in channels-last memory format, which is faster for convolutions on most
+            cpus
         """
 
         self.model = model
@@ -38,62 +74,368 @@ class Infer:
         self.pin_memory = pin_memory
         self.frame_proc = frame_proc
         self.post_proc = post_proc
+        self.post_proc_workers = post_proc_workers
+        self.post_proc_pool = post_proc_pool
+        self.batch_windows = batch_windows
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.output_cache = output_cache
+        self.precision = precision
+        self.channels_last = channels_last
+
+        if self.tile_size is not None and min(self.tile_size) <= 2 * self.tile_overlap:
+            raise ValueError(f"Tile size {tile_size} must be larger than twice the overlap ({tile_overlap}).")
+
+        if self.post_proc_pool not in self._post_proc_pools:
+            raise ValueError(f"Unsupported post-processing pool {post_proc_pool}. "
+                             f"Supported are {tuple(self._post_proc_pools.keys())}.")
+
+        if self.precision not in self._precisions:
+            raise ValueError(f"Unsupported precision {precision}. Supported are {self._precisions}.")
+
+        if self.precision == 'bf16' and not hasattr(torch, 'autocast'):
+            raise ValueError(f"Precision bf16 requires torch.autocast (torch >= 1.10), "
+                             f"installed is {torch.__version__}.")
 
         self.forward_cat = self._setup_forward_cat(forward_cat)
+        self._batch_frames = batch_size  # frames per batch of the current forward (see _frames_per_batch)
+        self.reset_metrics()
 
-    def forward(self, frames: torch.Tensor) -> emitter.EmitterSet:
+    def forward(self, frames: Union[torch.Tensor, frames_io.FrameStack]) -> emitter.EmitterSet:
         """
         Forward frames through model, pre- and post-processing and output EmitterSet
 
         Args:
-            frames:
+            frames: frames, either as tensor or as lazily loaded FrameStack which is read batch by batch
 
         """
 
         """Form Dataset and Dataloader"""
+        return self._forward_ds(self._get_dataset(frames, pad='same'), frames.shape[-2:])
+
+    def forward_stream(self, frame_source: Union[torch.Tensor, frames_io.FrameStack, Iterable[torch.Tensor]],
+                       chunk_size: int = 1000) -> Iterator:
+        """
+        Forward frames chunk by chunk, such that memory is bounded by the chunk size and not by the length of the
+        acquisition. The (ch_in - 1) / 2 boundary frames of the frame window are carried over between chunks, i.e. the
+        output is the same as the output of forward on all frames.
+
+        Args:
+            frame_source: frames as tensor or FrameStack (read chunk by chunk), or an iterable of frame tensors of any
+                size (e.g. the frames of consecutive files)
+            chunk_size: number of frames per chunk
+
+        Returns:
+            iterator of the outputs per chunk. EmitterSets have the global frame index, i.e. relative to the first frame
+                of the frame source.
+
+        """
+        hw = (self.ch_in - 1) // 2  # half window without centre
+
+        if isinstance(frame_source, (torch.Tensor, frames_io.FrameStack)):
+            blocks = (frame_source[i:i + chunk_size] for i in range(0, len(frame_source), chunk_size))
+        else:
+            blocks = iter(frame_source)
+
+        buffer = None  # frames that are still needed, starting at global frame buffer_start
+        buffer_start, ix = 0, 0  # ix is the next frame to forward
+
+        for block in blocks:
+            buffer = block if buffer is None else torch.cat([buffer, block], 0)
+
+            while buffer_start + len(buffer) - ix >= chunk_size + hw:  # chunk and trailing halo available
+                yield self.forward_range(buffer, buffer_start, ix, ix + chunk_size)
+                ix += chunk_size
+
+                buffer = buffer[max(ix - hw - buffer_start, 0):]
+                buffer_start = max(ix - hw, buffer_start)
+
+        """End of source, the remaining frames are padded as in forward"""
+        n = buffer_start + len(buffer) if buffer is not None else 0
+        for ix_chunk in range(ix, n, chunk_size):
+            yield self.forward_range(buffer, buffer_start, ix_chunk, min(ix_chunk + chunk_size, n), n)
+
+    def frame_range(self, start: int, end: int, n_frames: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Range of the frames (low, high exclusive, global index) that forward_range reads to forward the frames start
+        to end, i.e. these frames and the (ch_in - 1) / 2 frames of the frame window on either side.
+
+        Args:
+            start: first frame
+            end: last frame (exclusive)
+            n_frames: number of frames of the acquisition, None if unknown
+
+        """
+        hw = (self.ch_in - 1) // 2
+        return max(start - hw, 0), end + hw if n_frames is None else min(end + hw, n_frames)
+
+    def forward_range(self, frames: Union[torch.Tensor, frames_io.FrameStack], frames_start: int, start: int,
+                      end: int, n_frames: Optional[int] = None):
+        """
+        Forwards the frames start to end of an acquisition, e.g. a chunk or a shard of it. The output is the same as
+        the respective part of the output of forward on all frames, i.e. the frame window is formed of the
+        neighbouring frames (see frame_range) and padded by replicating the first and last frame of the acquisition.
+
+        Args:
+            frames: frames that contain at least the frames of frame_range, the first of them being the frame
+                frames_start of the acquisition. Of a FrameStack only those frames are read.
+            frames_start: global index of the first of the frames
+            start: first frame to forward (global index)
+            end: last frame to forward (exclusive)
+            n_frames: number of frames of the acquisition. If None (e.g. for a stream), the last frame is not padded,
+                i.e. the frames after end must be available.
+
+        Returns:
+            output of the frames start to end. EmitterSets have the global frame index.
+
+        """
+        hw = (self.ch_in - 1) // 2
+
+        frame_ix = torch.arange(start - hw, end + hw).clamp(min=0)
+        if n_frames is not None:
+            frame_ix = frame_ix.clamp(max=n_frames - 1)
+
+        out = self._forward_ds(self._get_dataset(frames[frame_ix - frames_start], pad=None),
+                               frames.shape[-2:])  # without the halo
+        if isinstance(out, emitter.EmitterSet):
+            out.frame_ix = out.frame_ix + start
+
+        return out
+
+    def _get_dataset(self, frames, pad: Optional[str]):
+        """
+        Dataset of the frames. Pad None only forwards the frames with a full frame window (i.e. the border frames are
+        only used as window of the inner ones).
+
+        """
+        if self.batch_windows:
+            return dataset.InferenceBatchDataset(frames=frames, frame_proc=self.frame_proc, frame_window=self.ch_in,
+                                                 batch_size=self._frames_per_batch(frames.shape[-2:]), pad=pad)
+
         ds = dataset.InferenceDataset(frames=frames, frame_proc=self.frame_proc, frame_window=self.ch_in)
-        dl = torch.utils.data.DataLoader(dataset=ds, batch_size=self.batch_size, shuffle=False,
+        if pad is None:
+            hw = (self.ch_in - 1) // 2
+            ds = torch.utils.data.Subset(ds, range(hw, len(ds) - hw))
+
+        return ds
+
+    def _forward_ds(self, ds, frame_size):
+
+        """Batched datasets return whole batches"""
+        self._batch_frames = self._frames_per_batch(frame_size)
+        batch_size = None if isinstance(ds, dataset.InferenceBatchDataset) else self._batch_frames
+        dl = torch.utils.data.DataLoader(dataset=ds, batch_size=batch_size, shuffle=False,
                                          num_workers=self.num_workers, pin_memory=self.pin_memory)
 
         """Move Model"""
         model = self.model.to(self.device)
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
         model.eval()
 
-        out = []
-
+        """
+        Cat to single emitterset / frame tensor depending on the specification of the forward_cat attr.
+        The batch outputs are passed lazily so that they can be accumulated batch by batch.
+        """
         with torch.no_grad():
-            for sample in tqdm(dl):
+            out = self.forward_cat(self._forward_batches(model, dl))
+
+        return out
+
+    def _forward_batches(self, model, dl):
+        """
+        Generator of the post-processed outputs per batch. With post-processing workers, the post-processing of a
+        batch runs in the pool while the next batches are forwarded. At most two batches per worker are pending and
+        the outputs are yielded in order of the batches, such that the frame index offsets of the batches remain valid.
+
+        """
+
+        if self.post_proc_workers == 0:
+            for sample in self._load_batches(dl):
                 x_in = sample.to(self.device)
 
                 # compute output
-                y_out = model(x_in)
+                y_out = self._forward_model_timed(model, x_in)
+                if self.output_cache is not None:
+                    self.output_cache.append(y_out)
 
-                """In post processing we need to make sure that we get a single Emitterset for each batch, 
+                """In post processing we need to make sure that we get a single Emitterset for each batch,
                 so that we can easily concatenate."""
-                out.append(self.post_proc.forward(y_out))
+                t0 = time.perf_counter()
+                out = self.post_proc.forward(y_out)
+                self._metrics['t_post_proc'] += time.perf_counter() - t0
+
+                yield out
+
+            return
+
+        with self._post_proc_pools[self.post_proc_pool](max_workers=self.post_proc_workers) as pool:
+            pending = collections.deque()
+
+            for sample in self._load_batches(dl):
+                y_out = self._forward_model_timed(model, sample.to(self.device))
+                if self.output_cache is not None:
+                    self.output_cache.append(y_out)
+                if self.post_proc_pool == 'process':
+                    y_out = y_out.cpu()
+
+                pending.append(pool.submit(self.post_proc.forward, y_out))
+                if len(pending) >= 2 * self.post_proc_workers:
+                    yield self._result_timed(pending.popleft())
+
+            while len(pending) != 0:
+                yield self._result_timed(pending.popleft())
+
+    @property
+    def metrics(self) -> dict:
+        """
+        Summary of the inference since construction (or reset_metrics): number of frames and batches, and the time in
+        seconds the inference spent waiting for the data loader (loading and frame processing, unless done in
+        workers), in the model and in the post-processing (with post-processing workers the time waited for their
+        results). On cuda devices, the model time is partially accounted to the post-processing because the model
+        runs asynchronously.
+
+        """
+        return dict(self._metrics)
+
+    def reset_metrics(self):
+        self._metrics = {'frames': 0, 'batches': 0, 't_load': 0., 't_model': 0., 't_post_proc': 0.}
 
-        """Cat to single emitterset / frame tensor depending on the specification of the forward_cat attr."""
-        out = self.forward_cat(out)
+    def _load_batches(self, dl):
+        """Iterates over the data loader and accumulates the time waited for the batches."""
+        batches = iter(tqdm(dl))
+
+        while True:
+            t0 = time.perf_counter()
+            try:
+                sample = next(batches)
+            except StopIteration:
+                return
+            self._metrics['t_load'] += time.perf_counter() - t0
+
+            self._metrics['frames'] += len(sample)
+            self._metrics['batches'] += 1
+            yield sample
+
+    def _forward_model_timed(self, model, x: torch.Tensor) -> torch.Tensor:
+        t0 = time.perf_counter()
+        out = self._forward_model(model, x)
+        self._metrics['t_model'] += time.perf_counter() - t0
 
         return out
 
+    def _result_timed(self, future):
+        t0 = time.perf_counter()
+        out = future.result()
+        self._metrics['t_post_proc'] += time.perf_counter() - t0
+
+        return out
+
+    def _forward_model(self, model, x: torch.Tensor) -> torch.Tensor:
+        """Forwards the batch through the model in the set precision and memory format."""
+
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+
+        if self.precision == 'bf16':
+            with torch.autocast(torch.device(self.device).type, dtype=torch.bfloat16):
+                out = self._forward_tiles(model, x)
+        else:
+            out = self._forward_tiles(model, x)
+
+        return out.float().contiguous()
+
+    def _forward_tiles(self, model, x: torch.Tensor) -> torch.Tensor:
+        """
+        Forwards the batch through the model. If a tile size is set, the tiles of all frames of the batch are gathered
+        and forwarded batch_size tiles at a time.
+
+        """
+        if self.tile_size is None:
+            return model(x)
+
+        frame_tiles = list(itertools.product(range(len(x)), self._tiles(x.size()[-2:])))  # (frame, tile) pairs
+
+        out = None
+        for i in range(0, len(frame_tiles), self.batch_size):
+            batch_tiles = frame_tiles[i:i + self.batch_size]
+
+            x_tiles = torch.stack([x[(f, ..., *tile)] for f, (tile, _, _) in batch_tiles], 0)
+            if self.channels_last:
+                x_tiles = x_tiles.contiguous(memory_format=torch.channels_last)
+            y = model(x_tiles)
+
+            if out is None:
+                out = y.new_empty((len(x), y.size(1), *x.size()[-2:]))
+            for y_tile, (f, (_, tile_core, core)) in zip(y, batch_tiles):
+                out[(f, ..., *core)] = y_tile[(..., *tile_core)]
+
+        return out
+
+    def _frames_per_batch(self, frame_size) -> int:
+        """Number of frames per batch, with tiling as many as have at most batch_size tiles but at least one."""
+
+        if self.tile_size is None:
+            return self.batch_size
+
+        return max(1, self.batch_size // len(self._tiles(frame_size)))
+
+    def _tiles(self, frame_size) -> list:
+        """
+        Tiling of a frame. The cores of the tiles cover the frame, the tiles extend them by the overlap and are
+        shifted inwards at the border of the frame such that all tiles are of the same size.
+
+        Returns:
+            list of slices (tile in frame, core in tile, core in frame) for both dimensions
+
+        """
+        def tiles_1d(n, size, overlap):
+            if size >= n:
+                return [(slice(0, n), slice(0, n), slice(0, n))]
+
+            tiles = []
+            for core_start in range(0, n, size - 2 * overlap):
+                core_end = min(core_start + size - 2 * overlap, n)
+                start = min(max(core_start - overlap, 0), n - size)
+
+                tiles.append((slice(start, start + size), slice(core_start - start, core_end - start),
+                              slice(core_start, core_end)))
+
+            return tiles
+
+        return [tuple(zip(t0, t1)) for t0, t1 in itertools.product(
+            tiles_1d(frame_size[0], self.tile_size[0], self.tile_overlap),
+            tiles_1d(frame_size[1], self.tile_size[1], self.tile_overlap))]
+
+    def _cat_emitter(self, x):
+        return emitter.EmitterSetBuilder().extend(x, step_frame_ix=self._batch_frames).finalize()
+
     def _setup_forward_cat(self, forward_cat):
+        """Bound methods and module level functions instead of lambdas, such that the instance remains picklable."""
 
         if forward_cat is None:
-            return lambda x: x
+            return list
 
         elif isinstance(forward_cat, str):
 
             if forward_cat == 'emitter':
-                return partial(emitter.EmitterSet.cat, step_frame_ix=self.batch_size)
+                return self._cat_emitter
 
             elif forward_cat == 'frames':
-                return partial(torch.cat, dim=0)
+                return _cat_frames
 
         elif callable(forward_cat):
-            return forward_cat
+            return functools.partial(_cat_list, forward_cat)
 
         else:
             raise TypeError(f"Specified forward cat method was wrong.")
 
         raise ValueError(f"Unsupported forward_cat value.")
+
+
+def _cat_frames(x):
+    return torch.cat(list(x), dim=0)
+
+
+def _cat_list(forward_cat, x):
+    return forward_cat(list(x))
@@ -0,0 +1,214 @@
+import pathlib
+from typing import Optional, Tuple
+
+import h5py
+import numpy as np
+import torch
+
+from ...generic import emitter
+
+cache_format = 'decode_output_cache'
+cache_version = 1  # increase when the layout changes, the reader rejects files of newer versions
+
+
+class OutputCacheWriter:
+    """
+    Writes the raw model output sparsely to a chunked and compressed HDF5 file, such that post-processing can be re-run
+    (e.g. with different thresholds) without inference (see post_process_cache).
+    Only the pixels whose detection probability is at least min_p, and their neighbourhood, are stored. Post-processing
+    of the cache is the same as of the model output as long as its thresholds are not lower than min_p and it does not
+    look further than the neighbourhood around active pixels (PostProcessing.from_cache checks the latter).
+
+    Example:
+        >>> with OutputCacheWriter('output.h5', min_p=0.1) as cache:
+        >>>     infer = Infer(..., output_cache=cache)
+        >>>     infer.forward(frames)
+        >>> em = post_proc.from_cache('output.h5')
+
+    """
+
+    def __init__(self, file: (str, pathlib.Path), min_p: float = 0.01, p_channel: int = 0, neighbourhood: int = 1,
+                 chunk_size: int = 2 ** 16, compression: Optional[str] = 'gzip', compression_opts: Optional[int] = 4):
+        """
+
+        Args:
+            file: path of the output file (will be overwritten)
+            min_p: minimal detection probability of the stored pixels
+            p_channel: detection channel of the model output
+            neighbourhood: pixels within this distance (in px) of a stored pixel are stored as well
+            chunk_size: number of pixels per chunk of the datasets
+            compression: h5py compression filter, None for no compression
+            compression_opts: options for compression filter
+
+        """
+        self.min_p = min_p
+        self.p_channel = p_channel
+        self.neighbourhood = neighbourhood
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_opts = compression_opts if compression is not None else None
+
+        self._file = h5py.File(file, 'w')
+        self._file.attrs['format'] = cache_format
+        self._file.attrs['version'] = cache_version
+        self._file.attrs['min_p'] = min_p
+        self._file.attrs['p_channel'] = p_channel
+        self._file.attrs['neighbourhood'] = neighbourhood
+
+        self._n_frames = 0
+        self._n_px = 0
+        self._counts = []  # number of stored pixels per frame, per append
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self._n_frames
+
+    def append(self, x: torch.Tensor):
+        """
+        Append the model output of the next frames.
+
+        Args:
+            x: model output of size N x C x H x W
+
+        """
+        if x.dim() != 4:
+            raise ValueError("Wrong dimensionality. Needs to be N x C x H x W.")
+
+        if 'data/values' not in self._file:
+            self._create_datasets(x.size(1))
+            self._file.attrs['shape'] = tuple(x.size()[1:])
+        elif tuple(x.size()[1:]) != tuple(self._file.attrs['shape']):
+            raise ValueError(f"Output size {tuple(x.size()[1:])} differs from the previous outputs.")
+
+        """Active pixels and their neighbourhood"""
+        active = (x[:, [self.p_channel]] >= self.min_p).float()
+        if self.neighbourhood >= 1:
+            active = torch.nn.functional.max_pool2d(active, 2 * self.neighbourhood + 1, 1, self.neighbourhood)
+        active = active[:, 0].bool()
+
+        ix = active.nonzero()
+        values = x.permute(0, 2, 3, 1)[active]
+
+        n_px = self._n_px + len(ix)
+        for k, v in (('frame_ix', ix[:, 0] + self._n_frames), ('px', ix[:, 1:]), ('values', values)):
+            ds = self._file['data'][k]
+            ds.resize(n_px, axis=0)
+            ds[self._n_px:n_px] = v.cpu().numpy()
+
+        self._counts.append(torch.bincount(ix[:, 0], minlength=x.size(0)).cpu().numpy())
+        self._n_frames += x.size(0)
+        self._n_px = n_px
+
+    def close(self):
+        """Writes the frame index and closes the file."""
+
+        if not self._file:  # already closed
+            return
+
+        counts = np.concatenate(self._counts) if len(self._counts) != 0 else np.zeros(0, dtype=np.int64)
+        self._file.create_dataset('index/frame_offsets', data=np.concatenate([[0], np.cumsum(counts)]))
+        self._file.attrs['n_frames'] = self._n_frames
+
+        self._file.close()
+
+    def _create_datasets(self, n_channels: int):
+        for k, dtype, shape in (('frame_ix', np.int64, ()), ('px', np.int32, (2,)), ('values', np.float32,
+                                                                                     (n_channels,))):
+            self._file.create_dataset(f'data/{k}', shape=(0, *shape), maxshape=(None, *shape), dtype=dtype,
+                                      chunks=(self.chunk_size, *shape), compression=self.compression,
+                                      compression_opts=self.compression_opts)
+
+
+class OutputCache:
+    """
+    Reads the raw model output that was written by the OutputCacheWriter. Frames are returned dense, pixels that were
+    not stored are 0 except for the detection channel which is set to a negative value, i.e. below any threshold
+    (0 would be a local maximum for the non-maximum suppression).
+
+    """
+    _p_fill = -1.
+
+    def __init__(self, file: (str, pathlib.Path)):
+        """
+
+        Args:
+            file: path to file
+
+        """
+        self.file = pathlib.Path(file)
+
+        with h5py.File(self.file, 'r') as f:
+            if f.attrs.get('format') != cache_format:
+                raise ValueError(f"File {file} is not an output cache of the expected format.")
+            if f.attrs['version'] > cache_version:
+                raise ValueError(f"File version {f.attrs['version']} is newer than the supported one "
+                                 f"({cache_version}).")
+
+            self.min_p = float(f.attrs['min_p'])
+            self.p_channel = int(f.attrs['p_channel'])
+            self.neighbourhood = int(f.attrs['neighbourhood'])
+            self._n_frames = int(f.attrs['n_frames'])
+            self._shape = tuple(f.attrs['shape']) if 'shape' in f.attrs else None
+            self._frame_offsets = f['index/frame_offsets'][:]
+
+    def __len__(self):
+        return self._n_frames
+
+    @property
+    def shape(self) -> Optional[Tuple[int, int, int]]:
+        """Size of the output of a single frame (C x H x W)."""
+        return self._shape
+
+    def get_frames(self, frame_start: int, frame_end: int) -> torch.Tensor:
+        """
+        Dense model output of the frames frame_start to frame_end (exclusive).
+
+        Returns:
+            torch.Tensor: N x C x H x W
+
+        """
+        if self._shape is None:
+            raise ValueError(f"The output cache {self.file} holds no model output (no batch was written).")
+
+        frame_start, frame_end = max(frame_start, 0), min(frame_end, len(self))
+        out = torch.zeros((max(frame_end - frame_start, 0), *self._shape))
+        out[:, self.p_channel] = self._p_fill
+
+        ix_low, ix_high = int(self._frame_offsets[frame_start]), int(self._frame_offsets[max(frame_end, frame_start)])
+        with h5py.File(self.file, 'r') as f:
+            frame_ix = torch.from_numpy(f['data/frame_ix'][ix_low:ix_high]) - frame_start
+            px = torch.from_numpy(f['data/px'][ix_low:ix_high]).long()
+            values = torch.from_numpy(f['data/values'][ix_low:ix_high])
+
+        out.permute(0, 2, 3, 1)[frame_ix, px[:, 0], px[:, 1]] = values
+
+        return out
+
+
+def post_process_cache(post_proc, cache: (str, pathlib.Path, OutputCache), batch_size: int = 64):
+    """
+    Runs the post-processing batch by batch over the cached model output and concatenates the outputs.
+
+    Args:
+        post_proc: post-processing (or sequence of transformations) that outputs an EmitterSet per batch
+        cache: output cache or path to it
+        batch_size: number of frames that are post-processed at once
+
+    Returns:
+        EmitterSet: emitters with the frame index of the cached frames
+
+    """
+    if not isinstance(cache, OutputCache):
+        cache = OutputCache(cache)
+
+    builder = emitter.EmitterSetBuilder()
+    for frame_start in range(0, len(cache), batch_size):
+        builder.append(post_proc.forward(cache.get_frames(frame_start, frame_start + batch_size)),
+                       frame_ix_shift=frame_start)
+
+    return builder.finalize()
@@ -0,0 +1,51 @@
+from collections import namedtuple
+from typing import Optional, Union
+
+import torch
+
+from ...evaluation import evaluation as eval_mod
+from ...evaluation import match_emittersets
+from ...generic import emitter
+from ...utils import frames_io
+from .inference import Infer
+
+_accuracy_return = namedtuple('AccuracyCheck', ['passed', 'eval_ref', 'eval'])
+
+
+def check_accuracy(infer_ref: Infer, infer: Infer, frames: Union[torch.Tensor, frames_io.FrameStack],
+                   em_tar: emitter.EmitterSet, matcher: match_emittersets.EmitterMatcher,
+                   evaluation: Optional[eval_mod.SMLMEvaluation] = None, jac_tol: float = 0.01,
+                   rmse_tol: float = 0.05) -> _accuracy_return:
+    """
+    Accuracy regression check of a reduced precision (bf16) or quantized inference against the fp32 reference, e.g. on
+    simulated frames. Both are evaluated against the ground truth and the check passes if the Jaccard index drops by
+    at most jac_tol (absolute) and the lateral and axial RMSE increase by at most rmse_tol (relative).
+
+    Args:
+        infer_ref: fp32 reference inference
+        infer: inference to check
+        frames: frames
+        em_tar: ground truth emitters of the frames
+        matcher: matching of output and ground truth (e.g. GreedyHungarianMatching)
+        evaluation: evaluation of the matched emitters, defaults to SMLMEvaluation
+        jac_tol: maximum absolute drop of the Jaccard index
+        rmse_tol: maximum relative increase of the lateral and axial RMSE
+
+    Returns:
+        (bool, namedtuple, namedtuple)
+
+            - **passed**: whether the check passed
+            - **eval_ref**: evaluation of the reference
+            - **eval**: evaluation of the inference to check
+
+    """
+    evaluation = evaluation if evaluation is not None else eval_mod.SMLMEvaluation()
+
+    eval_ref = evaluation.forward(*matcher.forward(infer_ref.forward(frames), em_tar))
+    eval_out = evaluation.forward(*matcher.forward(infer.forward(frames), em_tar))
+
+    passed = eval_out.jac >= eval_ref.jac - jac_tol
+    for k in ('rmse_lat', 'rmse_ax'):
+        passed &= not getattr(eval_out, k) > getattr(eval_ref, k) * (1 + rmse_tol)  # nan (no matches) passes
+
+    return _accuracy_return(passed=bool(passed), eval_ref=eval_ref, eval=eval_out)
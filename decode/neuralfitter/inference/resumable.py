@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import pathlib
+from typing import Optional, Union
+
+import torch
+
+from ...generic import emitter
+from ...utils import emitter_io, frames_io, model_io
+from .inference import Infer
+
+
+class ResumableInfer:
+    """
+    Resumable inference for long running fits. The frames are forwarded chunk by chunk and the emitters of every
+    completed chunk are written to the output directory, together with a manifest of the completed frame ranges, the
+    model hash and the post-processing parameters. When restarted with the same output directory (e.g. after a crash
+    or preemption), completed chunks are skipped. At the end, the chunks are merged.
+
+    Layout of the output directory:
+        manifest.json: n_frames, chunk_size, model_hash, post_proc, done (list of completed [start, end) ranges)
+        chunk_<start>_<end>.h5: emitters of the chunk (columnar HDF5 format) with the global frame index
+
+    Example:
+        >>> em = ResumableInfer(infer, 'fit_run/', model_file='model.pt').forward(frames)
+
+    """
+    _manifest = 'manifest.json'
+    _chunk_file = 'chunk_{:09d}_{:09d}.h5'
+
+    def __init__(self, infer: Infer, out_dir: Union[str, pathlib.Path], chunk_size: int = 1000,
+                 model_file: Optional[Union[str, pathlib.Path]] = None):
+        """
+
+        Args:
+            infer: inference, its post-processing must output an EmitterSet
+            out_dir: output directory of the chunks and the manifest
+            chunk_size: number of frames per chunk
+            model_file: file of the model weights for the model hash. If None, the hash is calculated from the weights
+            of the model instance.
+
+        """
+        self.infer = infer
+        self.out_dir = pathlib.Path(out_dir)
+        self.chunk_size = chunk_size
+        self.model_hash = model_io.hash_model(model_file) if model_file is not None \
+            else model_io.hash_state_dict(infer.model)
+
+    def forward(self, frames: Union[torch.Tensor, frames_io.FrameStack],
+                file: Optional[Union[str, pathlib.Path]] = None) -> Optional[emitter.EmitterSet]:
+        """
+        Forwards the frames that are not done yet and merges all chunks.
+
+        Args:
+            frames: all frames of the fit
+            file: if not None, the chunks are merged into this HDF5 file instead of being returned
+
+        Returns:
+            EmitterSet with the global frame index, None if written to file
+
+        """
+        manifest = self._load_manifest(len(frames))
+        done = {tuple(r) for r in manifest['done']}
+
+        for start in range(0, len(frames), self.chunk_size):
+            end = min(start + self.chunk_size, len(frames))
+            if (start, end) in done:
+                continue
+
+            em = self.infer.forward_range(frames, 0, start, end, len(frames))
+            if not isinstance(em, emitter.EmitterSet):
+                raise ValueError("Resumable inference requires the post-processing to output an EmitterSet.")
+
+            """Chunk first, then manifest. A chunk without manifest entry is simply recomputed."""
+            chunk_file = self.out_dir / self._chunk_file.format(start, end)
+            emitter_io.save_h5(chunk_file.with_suffix('.tmp'), em)
+            os.replace(chunk_file.with_suffix('.tmp'), chunk_file)
+
+            manifest['done'].append([start, end])
+            self._save_manifest(manifest)
+
+        return self.merge(file)
+
+    def merge(self, file: Optional[Union[str, pathlib.Path]] = None) -> Optional[emitter.EmitterSet]:
+        """
+        Merges the completed chunks in order of their frames.
+
+        Args:
+            file: if not None, the chunks are streamed into this HDF5 file instead of being returned
+
+        """
+        with (self.out_dir / self._manifest).open() as f:
+            done = sorted(tuple(r) for r in json.load(f)['done'])
+
+        files = [self.out_dir / self._chunk_file.format(start, end) for start, end in done]
+
+        if file is None:
+            return emitter.EmitterSet.cat([emitter.EmitterSet.load(f) for f in files])
+
+        with emitter_io.EmitterWriterH5(file) as writer:
+            for f in files:
+                writer.append(emitter.EmitterSet.load(f))
+
+    def _load_manifest(self, n_frames: int) -> dict:
+        """Loads the manifest of a previous run and checks that it belongs to the same fit, or starts a new one."""
+
+        manifest = {'n_frames': n_frames, 'chunk_size': self.chunk_size, 'model_hash': self.model_hash,
+                    'post_proc': _params(self.infer.post_proc), 'done': []}
+
+        file = self.out_dir / self._manifest
+        if not file.is_file():
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+            self._save_manifest(manifest)
+            return manifest
+
+        with file.open() as f:
+            manifest_prev = json.load(f)
+
+        for k in ('n_frames', 'chunk_size', 'model_hash', 'post_proc'):
+            if manifest_prev[k] != manifest[k]:
+                raise ValueError(f"Output directory {self.out_dir} belongs to a different fit ({k} differs). "
+                                 f"Use a new output directory.")
+
+        return manifest_prev
+
+    def _save_manifest(self, manifest: dict):
+        file = self.out_dir / self._manifest
+        with file.with_suffix('.tmp').open('w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(file.with_suffix('.tmp'), file)
+
+
+def _params(obj, _seen: frozenset = frozenset()):
+    """
+    Json representation of the parameters of a (sequence of) processing objects. Objects are represented by their
+    pickled state (__getstate__ if they define one), which leaves out runtime state such as worker pools.
+
+    """
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    if isinstance(obj, torch.Tensor):  # large tensors (e.g. coordinate meshes) by hash
+        return obj.tolist() if obj.numel() <= 16 else \
+            'sha1:' + hashlib.sha1(obj.detach().cpu().contiguous().numpy().tobytes()).hexdigest()
+    if isinstance(obj, (list, tuple)):
+        return [_params(o, _seen) for o in obj]
+    if isinstance(obj, dict):
+        return {str(k): _params(v, _seen) for k, v in obj.items()}
+    if hasattr(obj, '__dict__'):
+        if id(obj) in _seen:  # reference cycle
+            return type(obj).__name__
+
+        getstate = getattr(type(obj), '__getstate__', None)
+        state = obj.__getstate__() if getstate not in (None, getattr(object, '__getstate__', None)) else vars(obj)
+        state = state if isinstance(state, dict) else vars(obj)
+        _seen = _seen | {id(obj)}
+
+        return {type(obj).__name__: {k: _params(v, _seen) for k, v in state.items() if not callable(v)}}
+
+    return repr(obj)
@@ -0,0 +1,134 @@
+"""
+Minimal runtime for fitting with an exported model (see decode.neuralfitter.inference.export).
+
+It only depends on torch, numpy and tifffile (and onnxruntime for ONNX graphs), i.e. this file can be copied next to
+the exported model and run on its own:
+
+    python runtime.py model.pt frames.tif emitters.csv
+"""
+import argparse
+import json
+import pathlib
+from typing import Iterator, Union
+
+import numpy as np
+import torch
+
+
+def meta_file(file: Union[str, pathlib.Path]) -> pathlib.Path:
+    """Path of the json meta data of an exported model."""
+    file = pathlib.Path(file)
+    return file.with_name(file.name + '.json')
+
+
+class Runtime:
+    """
+    Loads an exported model and streams frames to emitters.
+
+    Example:
+        >>> rt = Runtime('model.pt')
+        >>> for frame_ix, features in rt.forward_stream(frames):
+        >>>     ...
+
+    """
+
+    def __init__(self, file: Union[str, pathlib.Path], device: str = 'cpu'):
+        """
+
+        Args:
+            file: exported model
+            device: device (TorchScript only, ONNX graphs run on the cpu provider)
+
+        """
+        with meta_file(file).open() as f:
+            self.meta = json.load(f)
+
+        self.ch_in = self.meta['ch_in']
+        self.columns = self.meta['columns']
+        self.device = device
+
+        if self.meta['format'] == 'torchscript':
+            self._module = torch.jit.load(str(file), map_location=device)
+            self._session = None
+
+        elif self.meta['format'] == 'onnx':
+            import onnxruntime  # optional dependency
+            self._module = None
+            self._session = onnxruntime.InferenceSession(str(file), providers=['CPUExecutionProvider'])
+
+        else:
+            raise ValueError(f"Unsupported format {self.meta['format']}.")
+
+    def forward(self, frames: torch.Tensor):
+        """
+        Forwards a block of frames including (ch_in - 1) / 2 halo frames at both ends.
+
+        Returns:
+            frame index (relative to the first frame after the halo) and features of the emitters (columns)
+
+        """
+        if self._session is not None:
+            frame_ix, features = self._session.run(None, {'frames': frames.cpu().numpy()})
+            return torch.from_numpy(frame_ix), torch.from_numpy(features)
+
+        with torch.no_grad():
+            frame_ix, features = self._module(frames.to(self.device))
+
+        return frame_ix.cpu(), features.cpu()
+
+    def forward_stream(self, frames, chunk_size: int = 1000) -> Iterator:
+        """
+        Forwards frames chunk by chunk. The frames at the start and end are padded by replication.
+
+        Args:
+            frames: indexable frames (tensor or numpy array, e.g. a memory mapped tiff)
+            chunk_size: number of frames per chunk
+
+        Returns:
+            iterator of frame index (global) and features of the emitters per chunk
+
+        """
+        hw = (self.ch_in - 1) // 2
+        n = len(frames)
+
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            ix = np.clip(np.arange(start - hw, end + hw), 0, n - 1)
+
+            block = torch.as_tensor(np.asarray(frames[ix.min():ix.max() + 1]), dtype=torch.float32)
+            frame_ix, features = self.forward(block[torch.from_numpy(ix - ix.min())])
+
+            yield frame_ix + start, features
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit frames with an exported model.")
+    parser.add_argument('model', help='exported model (.pt or .onnx)')
+    parser.add_argument('frames', help='tiff file of the frames')
+    parser.add_argument('output', help='output csv file')
+    parser.add_argument('-d', '--device', default='cpu', help='device')
+    parser.add_argument('-c', '--chunk_size', default=1000, type=int, help='number of frames per chunk')
+
+    args = parser.parse_args()
+
+    import tifffile
+
+    rt = Runtime(args.model, device=args.device)
+    frames = tifffile.memmap(args.frames) if _is_memmappable(args.frames) else tifffile.imread(args.frames)
+
+    with open(args.output, 'w') as f:
+        f.write(','.join(['frame_ix'] + rt.columns) + '\n')
+        for frame_ix, features in rt.forward_stream(frames, chunk_size=args.chunk_size):
+            np.savetxt(f, np.concatenate([frame_ix[:, None].numpy(), features.numpy()], 1), delimiter=',',
+                       fmt=['%d'] + ['%.6g'] * len(rt.columns))
+
+
+def _is_memmappable(file) -> bool:
+    import tifffile
+
+    with tifffile.TiffFile(file) as tif:
+        return tif.series[0].dataoffset is not None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import concurrent.futures
+import copy
+import os
+import pathlib
+from typing import List, Optional, Tuple, Union
+
+import torch
+
+from ...generic import emitter
+from ...utils import emitter_io, frames_io
+from .inference import Infer
+
+
+def shard_ranges(n_frames: int, n_shards: int) -> List[Tuple[int, int]]:
+    """
+    Splits the frames into contiguous shards of (almost) the same size.
+
+    Args:
+        n_frames: number of frames
+        n_shards: number of shards
+
+    Returns:
+        list of (start, end) frame index of the shards, end exclusive. Empty shards are omitted.
+
+    """
+    if n_shards < 1:
+        raise ValueError(f"Number of shards must be at least 1 and not {n_shards}.")
+
+    bounds = [n_frames * i // n_shards for i in range(n_shards + 1)]
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+class ShardedInfer:
+    """
+    Data-parallel inference. The frames are split into contiguous shards, each of which is forwarded by its own model
+    replica in an independent process with its own thread budget. The shards are extended by the (ch_in - 1) / 2 halo
+    frames of the frame window, therefore the merged output is the same as the output of Infer.forward on all frames
+    (given the post-processing is frame-wise).
+
+    Two backends are available:
+        - forward: runs the shards in a local process pool and merges the outputs in memory.
+        - forward_shard / merge: file based handoff for clusters. Every job forwards one shard and writes its emitters
+          to a shard file in a shared directory, the driver merges the shard files once all of them are present.
+
+    Example (cluster):
+        >>> # job k of n
+        >>> ShardedInfer(infer, n_shards=n).forward_shard(frames, k, 'shards/')
+        >>> # driver, after all jobs finished
+        >>> em = ShardedInfer.merge('shards/', n_shards=n)
+
+    """
+    _shard_file = 'shard_{:05d}.h5'
+
+    def __init__(self, infer: Infer, n_shards: int, threads_per_shard: Optional[int] = None,
+                 mp_context: Optional[str] = 'spawn'):
+        """
+
+        Args:
+            infer: inference that is run per shard. Model, pre- and post-processing must be picklable for the local
+            backend. Within the shards, data loading is done in the main thread of the shard (num_workers 0).
+            n_shards: number of shards
+            threads_per_shard: number of torch threads per shard. Defaults to the number of CPU cores divided by the
+            number of shards.
+            mp_context: multiprocessing start method of the local backend. 'spawn' avoids forking a process whose
+            thread pools are already initialised.
+
+        """
+        self.infer = infer
+        self.n_shards = n_shards
+        self.threads_per_shard = threads_per_shard if threads_per_shard is not None \
+            else max(1, (os.cpu_count() or 1) // n_shards)
+        self.mp_context = mp_context
+
+    def forward(self, frames: Union[torch.Tensor, frames_io.FrameStack]):
+        """
+        Forwards the shards in a pool of n_shards local processes and merges their outputs.
+
+        Args:
+            frames: frames as tensor or FrameStack. A FrameStack is passed as is, i.e. every shard reads its frames
+            itself.
+
+        Returns:
+            EmitterSet with the global frame index, or frames if the inference outputs frames
+
+        """
+        shards = shard_ranges(len(frames), self.n_shards)
+        ctx = torch.multiprocessing.get_context(self.mp_context) if self.mp_context is not None else None
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards), mp_context=ctx) as pool:
+            futures = [pool.submit(_forward_shard, self._shard_infer(), *self._shard_frames(frames, start, end),
+                                   start, end, len(frames), self.threads_per_shard) for start, end in shards]
+            out = [f.result() for f in futures]
+
+        if isinstance(out[0], emitter.EmitterSet):
+            return emitter.EmitterSet.cat(out)
+
+        return torch.cat(out, 0)
+
+    def forward_shard(self, frames: Union[torch.Tensor, frames_io.FrameStack], shard_ix: int,
+                      shard_dir: Union[str, pathlib.Path]) -> pathlib.Path:
+        """
+        Forwards a single shard in this process and writes its emitters to the shard directory. The file appears
+        only once it is complete (written to a temporary file and renamed).
+
+        Args:
+            frames: all frames (the shard is selected from them)
+            shard_ix: index of the shard
+            shard_dir: shared directory of the shard files
+
+        Returns:
+            path of the shard file
+
+        """
+        shards = shard_ranges(len(frames), self.n_shards)
+        if not 0 <= shard_ix < self.n_shards:
+            raise ValueError(f"Shard index {shard_ix} out of range for {self.n_shards} shards.")
+
+        shard_dir = pathlib.Path(shard_dir)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        file = shard_dir / self._shard_file.format(shard_ix)
+
+        if shard_ix < len(shards):
+            start, end = shards[shard_ix]
+            em = _forward_shard(self._shard_infer(), *self._shard_frames(frames, start, end), start, end,
+                                len(frames), self.threads_per_shard)
+        else:  # more shards than frames
+            em = emitter.EmptyEmitterSet()
+
+        if not isinstance(em, emitter.EmitterSet):
+            raise ValueError("File based sharding requires the inference to output an EmitterSet.")
+
+        file_tmp = file.with_suffix('.tmp')
+        emitter_io.save_h5(file_tmp, em)
+        os.replace(file_tmp, file)
+
+        return file
+
+    @classmethod
+    def merge(cls, shard_dir: Union[str, pathlib.Path], n_shards: int,
+              file: Optional[Union[str, pathlib.Path]] = None) -> Optional[emitter.EmitterSet]:
+        """
+        Merges the shard files of forward_shard.
+
+        Args:
+            shard_dir: shared directory of the shard files
+            n_shards: number of shards
+            file: if not None, the shards are streamed shard by shard into this HDF5 file instead of being returned
+
+        Returns:
+            EmitterSet with the global frame index, None if written to file
+
+        """
+        files = [pathlib.Path(shard_dir) / cls._shard_file.format(i) for i in range(n_shards)]
+
+        missing = [f.name for f in files if not f.is_file()]
+        if len(missing) != 0:
+            raise ValueError(f"Shards are not complete, missing: {missing}.")
+
+        if file is None:
+            return emitter.EmitterSet.cat([emitter.EmitterSet.load(f) for f in files])
+
+        with emitter_io.EmitterWriterH5(file) as writer:
+            for f in files:  # shards are in order of their frames
+                writer.append(emitter.EmitterSet.load(f))
+
+    def _shard_infer(self) -> Infer:
+        infer = copy.copy(self.infer)
+        infer.num_workers = 0
+        infer.pin_memory = False
+        infer.output_cache = None
+        if self.infer.forward_cat == self.infer._cat_emitter:  # bind to the copy
+            infer.forward_cat = infer._cat_emitter
+
+        return infer
+
+    def _shard_frames(self, frames, start: int, end: int):
+        """Frames that are passed to a shard, i.e. the shard and its halo, and the index of the first of them."""
+        if isinstance(frames, frames_io.FrameStack):
+            return frames, 0
+
+        low, high = self.infer.frame_range(start, end, len(frames))
+        return frames[low:high], low
+
+
+def _forward_shard(infer: Infer, frames, frames_start: int, start: int, end: int, n_frames: int, n_threads: int):
+    """
+    Forwards frames start to end (global index) of a shard. frames_start is the global index of the first of the
+    frames, of a FrameStack only the shard and its halo are read (see Infer.forward_range).
+
+    """
+    torch.set_num_threads(n_threads)
+
+    return infer.forward_range(frames, frames_start, start, end, n_frames)
@@ -1,3 +1,4 @@
+import decode.neuralfitter.models.quantization
 import decode.neuralfitter.models.unet_param
 import decode.neuralfitter.models.model_param
 import decode.neuralfitter.models.model_speced_impl
@@ -1,7 +1,7 @@
 import torch
 from torch import nn as nn
 
-from . import unet_param
+from . import quantization, unet_param
 from ..utils import last_layer_dynamics as lyd
 
 
@@ -156,6 +156,11 @@ class DoubleMUnet(nn.Module):
                       norm=norm_head, norm_groups=norm_head_groups,
                       padding=True, activation=activation) for _ in range(self.ch_out)])
 
+        """Boundaries of the int8 region and concatenation for static quantization, identities in floating point"""
+        self.quant = quantization.tq().QuantStub()
+        self.dequant = quantization.tq().DeQuantStub()
+        self.cat_shared = nn.quantized.FloatFunctional()
+
         self._use_last_nl = use_last_nl
 
         self.p_nl = torch.sigmoid  # only in inference, during training
@@ -200,6 +205,22 @@ class DoubleMUnet(nn.Module):
         """
         return lyd.weight_by_gradient(self.mt_heads, loss, optimizer)
 
+    def quantize(self, calibration, backend: str = 'fbgemm') -> nn.Module:
+        """
+        Post-training static int8 quantization for inference on the cpu. The network runs in int8 from the input
+        (quant) to the output of the heads (dequant), the final non-linearities in floating point. Use together with a
+        fp32 reference and an accuracy check (see decode.neuralfitter.inference.precision.check_accuracy).
+
+        Args:
+            calibration: a few representative input batches (e.g. simulated frames)
+            backend: quantization backend
+
+        Returns:
+            quantized copy of the model
+
+        """
+        return quantization.quantize_static(self, calibration, backend=backend)
+
     def apply_detection_nonlin(self, x: torch.Tensor) -> torch.Tensor:
         """
         Apply detection non-linearity. Useful for non-training situations. When BCEWithLogits loss is used, do not use this
@@ -252,7 +273,7 @@ class DoubleMUnet(nn.Module):
 
         o_head = []
         for i in range(self.ch_out):
-            o_head.append(self.mt_heads[i].forward(o))
+            o_head.append(self.dequant(self.mt_heads[i].forward(o)))
         o = torch.cat(o_head, 1)
 
         """Apply the final non-linearities"""
@@ -266,18 +287,18 @@ class DoubleMUnet(nn.Module):
 
     def _forward_core(self, x) -> torch.Tensor:
         if self.ch_in == 3:
-            x0 = x[:, [0]]
-            x1 = x[:, [1]]
-            x2 = x[:, [2]]
+            x0 = self.quant(x[:, [0]])
+            x1 = self.quant(x[:, [1]])
+            x2 = self.quant(x[:, [2]])
 
             o0 = self.unet_shared.forward(x0)
             o1 = self.unet_shared.forward(x1)
             o2 = self.unet_shared.forward(x2)
 
-            o = torch.cat((o0, o1, o2), 1)
+            o = self.cat_shared.cat((o0, o1, o2), 1)
 
         elif self.ch_in == 1:
-            o = self.unet_shared.forward(x)
+            o = self.unet_shared.forward(self.quant(x))
 
         o = self.unet_union.forward(o)
 
@@ -296,14 +317,14 @@ class MLTHeads(nn.Module):
             groups_1 = None
             groups_2 = None
 
-        padding = padding
+        padding = int(padding)  # recent torch versions do not accept a bool padding
 
         self.core = self._make_core(in_channels, groups_1, groups_2, activation, padding, self.norm)
-        self.out_conv = nn.Conv2d(in_channels, out_channels, kernel_size=last_kernel, padding=False)
+        self.out_conv = nn.Conv2d(in_channels, out_channels, kernel_size=last_kernel, padding=0)
 
     def forward(self, x):
-        o = self.core.forward(x)
-        o = self.out_conv.forward(o)
+        o = self.core(x)
+        o = self.out_conv(o)  # called (not forward) such that the observer hooks of quantization run
 
         return o
 
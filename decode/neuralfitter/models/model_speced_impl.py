@@ -55,7 +55,7 @@ class SigmaMUNet(model_param.DoubleMUnet):
         x = self._forward_core(x)
 
         """Forward through the respective heads"""
-        x_heads = [mt_head.forward(x) for mt_head in self.mt_heads]
+        x_heads = [self.dequant(mt_head.forward(x)) for mt_head in self.mt_heads]
         x = torch.cat(x_heads, dim=1)
 
         """Clamp prob before sigmoid"""
@@ -0,0 +1,145 @@
+import copy
+from typing import Iterable, Tuple, Type
+
+import torch
+from torch import nn as nn
+
+
+def tq():
+    """
+    The quantization module of torch, imported on use. It moved to torch.ao.quantization in torch 1.10,
+    torch.quantization is the location of older versions.
+
+    """
+    try:
+        from torch.ao import quantization
+    except ImportError:
+        from torch import quantization
+
+    return quantization
+
+
+class FloatModule(nn.Module):
+    """
+    Runs a module in floating point within the int8 region of a quantized model, i.e. dequantizes its input and
+    quantizes its output. For operations without an efficient int8 kernel.
+
+    """
+
+    def __init__(self, module: nn.Module):
+        super().__init__()
+        self.dequant = tq().DeQuantStub()
+        self.module = module
+        self.module.qconfig = None
+        self.quant = tq().QuantStub()
+
+    def forward(self, x):
+        return self.quant(self.module(self.dequant(x)))
+
+
+def quantize_static(model: nn.Module, calibration: Iterable[torch.Tensor], backend: str = 'fbgemm',
+                    float_modules: Tuple[Type[nn.Module], ...] = (nn.ELU,)) -> nn.Module:
+    """
+    Post-training static int8 quantization of a model as a whole. The model marks the int8 region by a QuantStub at
+    its input and DeQuantStub(s) at its outputs, concatenations are done by FloatFunctional modules. In between, the
+    tensors stay quantized, i.e. there is no quantize / dequantize round-trip per layer. Convolutions followed by a
+    ReLU (or batch norm) are fused. Modules of the float_modules types are run in floating point (see FloatModule), e.g.
+    ELU, whose int8 kernel is slower than the float round-trip on the channels-last output of quantized convolutions.
+    The quantization ranges of the activations are calibrated on a few representative
+    input batches (e.g. simulated frames). Quantized models run on the cpu only.
+
+    Note that the quantization engine is process wide. It is set to the backend here, once, because the quantized
+    model runs on the engine it was quantized for.
+
+    Args:
+        model: model (is not modified)
+        calibration: input batches for calibration
+        backend: quantization backend (engine), e.g. 'fbgemm' (x86), 'qnnpack' (arm) or 'x86' (torch >= 2.0)
+        float_modules: module types that are run in floating point
+
+    Returns:
+        quantized copy of the model in eval mode
+
+    """
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError(f"Unsupported quantization backend {backend}. "
+                         f"Supported are {torch.backends.quantized.supported_engines}.")
+
+    model = copy.deepcopy(model).cpu().eval()
+    _unshare_modules(model)
+    _fuse(model)
+    _wrap_float(model, float_modules)
+
+    if torch.backends.quantized.engine != backend:
+        torch.backends.quantized.engine = backend
+
+    tq_ = tq()
+    model.qconfig = tq_.get_default_qconfig(backend)
+    tq_.prepare(model, inplace=True)
+
+    """Calibrate"""
+    n = 0
+    with torch.no_grad():
+        for x in calibration:
+            model(x.cpu())
+            n += 1
+
+    if n == 0:
+        raise ValueError("Calibration requires at least one batch.")
+
+    tq_.convert(model, inplace=True)
+
+    return model
+
+
+def _unshare_modules(module: nn.Module, seen: set = None):
+    """
+    Copies modules that are used at several places (e.g. the activation passed to all blocks), such that each place
+    gets its own observer and quantization range.
+
+    """
+    seen = set() if seen is None else seen
+
+    for name, child in list(module._modules.items()):  # named_children skips repeated modules
+        if child is None:
+            continue
+
+        if id(child) in seen:
+            child = copy.deepcopy(child)
+            setattr(module, name, child)
+
+        seen.add(id(child))
+        _unshare_modules(child, seen)
+
+
+def _fuse(module: nn.Module):
+    """Fuses conv + (batch norm) + relu of sequential blocks in place."""
+    patterns = ((nn.Conv2d, nn.BatchNorm2d, nn.ReLU), (nn.Conv2d, nn.BatchNorm2d), (nn.Conv2d, nn.ReLU))
+
+    for child in module.children():
+        _fuse(child)
+
+    if not isinstance(module, nn.Sequential):
+        return
+
+    names, children = zip(*module.named_children()) if len(module) != 0 else ((), ())
+    fuse, i = [], 0
+    while i < len(children):
+        for pattern in patterns:
+            if tuple(type(c) for c in children[i:i + len(pattern)]) == pattern:
+                fuse.append(list(names[i:i + len(pattern)]))
+                i += len(pattern)
+                break
+        else:
+            i += 1
+
+    if len(fuse) != 0:
+        tq().fuse_modules(module, fuse, inplace=True)
+
+
+def _wrap_float(module: nn.Module, float_modules: Tuple[Type[nn.Module], ...]):
+    for name, child in module.named_children():
+        if isinstance(child, float_modules):
+            setattr(module, name, FloatModule(child))
+        else:
+            _wrap_float(child, float_modules)
@@ -1,4 +1,3 @@
-import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -125,6 +124,8 @@ class UNetBase(nn.Module):
                                                          self.depth - level - 1,
                                                          mode=upsample_mode)
                                          for level in range(self.depth)])
+        # concatenation of the skip connections, observed per level for static quantization
+        self.skip_cats = nn.ModuleList([nn.quantized.FloatFunctional() for _ in range(self.depth)])
         # output conv and activation
         # the output conv is not followed by a non-linearity, because we apply
         # activation afterwards
@@ -146,9 +147,9 @@ class UNetBase(nn.Module):
         return input_[crop]
 
     # crop the `from_encoder` tensor and concatenate both
-    def _crop_and_concat(self, from_decoder, from_encoder):
+    def _crop_and_concat(self, from_decoder, from_encoder, level):
         cropped = self._crop_tensor(from_encoder, from_decoder.shape)
-        return torch.cat((cropped, from_decoder), dim=1)
+        return self.skip_cats[level].cat((cropped, from_decoder), dim=1)
 
     def forward_parts(self, parts):
         if 'encoder' in parts:
@@ -169,7 +170,7 @@ class UNetBase(nn.Module):
             for level in range(self.depth):
                 x = self.upsamplers[level](x)
                 x = self.decoder[level](self._crop_and_concat(x,
-                                                              encoder_out[level]))
+                                                              encoder_out[level], level))
 
             # apply output conv and activation (if given)
             x = self.out_conv(x)
@@ -195,7 +196,7 @@ class UNetBase(nn.Module):
         for level in range(self.depth):
             x = self.upsamplers[level](x)
             x = self.decoder[level](self._crop_and_concat(x,
-                                                          encoder_out[level]))
+                                                          encoder_out[level], level))
 
         # apply output conv and activation (if given)
         x = self.out_conv(x)
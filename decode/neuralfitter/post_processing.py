@@ -1,20 +1,24 @@
-import warnings
+import concurrent.futures
+import functools
+import weakref
 from abc import ABC, abstractmethod  # abstract class
-from typing import Union, Callable
+from collections import namedtuple
+from typing import Union, Callable, Optional, Sequence
 
-import scipy
+import numpy as np
 import torch
 from deprecated import deprecated
-from sklearn.cluster import AgglomerativeClustering
 
 import decode.simulation.background
 from decode.evaluation import match_emittersets
 from decode.generic.emitter import EmitterSet, EmptyEmitterSet
-from decode.neuralfitter.utils.probability import binom_pdiverse
+
+SweepCounts = namedtuple('SweepCounts', ['th', 'tp', 'fp', 'fn'])
 
 
 class PostProcessing(ABC):
     _return_types = ('batch-set', 'frame-set')
+    _footprint = 0  # distance (px) around the active pixels that the post-processing reads from the model output
 
     def __init__(self, xy_unit, px_size, return_format: str):
         """
@@ -73,6 +77,31 @@ class PostProcessing(ABC):
         else:
             raise ValueError
 
+    def from_cache(self, cache, batch_size: int = 64) -> EmitterSet:
+        """
+        Post-process the raw model output of an output cache (see decode.neuralfitter.inference.output_cache) batch by
+        batch instead of running inference again, e.g. to tune thresholds. The neighbourhood of the stored pixels must
+        cover the footprint of the post-processing, otherwise its output would differ from the one of the model output.
+
+        Args:
+            cache: output cache or path to it
+            batch_size: number of frames that are post-processed at once
+
+        Returns:
+            EmitterSet
+
+        """
+        from decode.neuralfitter.inference import output_cache  # local, the core module does not depend on inference
+
+        if not isinstance(cache, output_cache.OutputCache):
+            cache = output_cache.OutputCache(cache)
+
+        if cache.neighbourhood < self._footprint:
+            raise ValueError(f"The output cache stores a neighbourhood of {cache.neighbourhood} px around the active "
+                             f"pixels, {type(self).__name__} requires {self._footprint} px.")
+
+        return output_cache.post_process_cache(self, cache, batch_size=batch_size)
+
     @abstractmethod
     def forward(self, x: torch.Tensor) -> (EmitterSet, list):
         """
@@ -117,7 +146,6 @@ class LookUpPostProcessing(PostProcessing):
     in the respective channels.
 
     """
-
     def __init__(self, raw_th: float, xy_unit: str, px_size=None,
                  pphotxyzbg_mapping: Union[list, tuple] = (0, 1, 2, 3, 4, -1),
                  photxyz_sigma_mapping: Union[list, tuple, None] = (5, 6, 7, 8)):
@@ -169,11 +197,29 @@ class LookUpPostProcessing(PostProcessing):
         assert features.dim() == 4
         assert active_px.dim() == features.dim() - 1
 
-        batch_ix = active_px.nonzero()[:, 0]
-        features_active = features.permute(1, 0, 2, 3)[:, active_px]
+        """Gather the active pixels only, i.e. no copy of the full feature channels."""
+        batch_ix, h_ix, w_ix = active_px.nonzero(as_tuple=True)
+        features_active = features[batch_ix, :, h_ix, w_ix].t()
 
         return batch_ix, features_active
 
+    def _lookup_active(self, x: torch.Tensor, active_px: torch.Tensor) -> tuple:
+        """
+        Look-up of the features (phot, x, y, z, bg) and the sigma features (phot, x, y, z) of the active pixels from
+        the channels of the model output in one gather.
+
+        Returns:
+            frame_ix, features, features_sigma (None if there is no sigma mapping)
+
+        """
+        frame_ix, features_all = self._lookup_features(x, active_px)
+
+        features = features_all[list(self.pphotxyzbg_mapping[1:])]
+        features_sigma = features_all[list(self.photxyz_sigma_mapping)] \
+            if self.photxyz_sigma_mapping is not None else None
+
+        return frame_ix, features, features_sigma
+
     def forward(self, x: torch.Tensor) -> EmitterSet:
         """
         Forward model output tensor through post-processing and return EmitterSet. Will include sigma values in
@@ -186,24 +232,94 @@ class LookUpPostProcessing(PostProcessing):
             EmitterSet
 
         """
-        """Reorder features channel-wise."""
-        x_mapped = x[:, self.pphotxyzbg_mapping]
+        return self._forward_detection(x, x[:, self.pphotxyzbg_mapping[0]])
 
-        """Filter"""
-        active_px = self._filter(x_mapped[:, 0])  # 0th ch. is detection channel
-        prob = x_mapped[:, 0][active_px]
+    def _forward_detection(self, x: torch.Tensor, p: torch.Tensor) -> EmitterSet:
+        """
+        Filter the detection channel p and look-up the features of the active pixels in the model output x.
 
-        """Look-Up in channels"""
-        frame_ix, features = self._lookup_features(x_mapped[:, 1:], active_px)
+        """
+        active_px = self._filter(p)
+        frame_ix, features, features_sigma = self._lookup_active(x, active_px)
 
-        """Return EmitterSet"""
-        xyz = features[1:4].transpose(0, 1)
+        return self._emitter_set(p[active_px], frame_ix, features, features_sigma)
 
-        """If sigma mapping is present, get those values as well."""
-        if self.photxyz_sigma_mapping is not None:
-            sigma = x[:, self.photxyz_sigma_mapping]
-            _, features_sigma = self._lookup_features(sigma, active_px)
+    def sweep(self, x: torch.Tensor, thresholds: Sequence[float], em_tar: Optional[EmitterSet] = None,
+              matcher: Optional[match_emittersets.EmitterMatcher] = None) -> list:
+        """
+        Post-processing of the same model output for multiple thresholds (raw_th), e.g. to choose the threshold on a
+        validation set. The candidate pixels above the lowest threshold and their features are extracted once, the
+        output for each threshold is a subset of them. The output is the same as of forward with the respective raw_th.
+
+        Args:
+            x: model output
+            thresholds: thresholds
+            em_tar: target emitters of the frames of x. If specified (together with the matcher) only the counts of
+                true positives, false positives and false negatives are returned.
+            matcher: matching of output and target
+
+        Returns:
+            list of EmitterSet or of SweepCounts (th, tp, fp, fn) per threshold
+
+        """
+        if (em_tar is None) != (matcher is None):
+            raise ValueError("Target emitters and matcher must be specified together.")
+
+        with torch.no_grad():
+            th_break, prob_below, prob_above = self._sweep_prob(x[:, self.pphotxyzbg_mapping[0]])
 
+            """Candidates of all thresholds"""
+            is_cand = (prob_below >= min(thresholds)) + (prob_above >= min(thresholds))
+            th_break, prob_below, prob_above = th_break[is_cand], prob_below[is_cand], prob_above[is_cand]
+
+            frame_ix, features, features_sigma = self._lookup_active(x, is_cand)
+
+            is_em = [torch.where(th < th_break, prob_below, prob_above) >= th for th in thresholds]
+
+            """Counts of the greedy matcher, the candidates are paired and sorted once for all thresholds"""
+            if isinstance(matcher, match_emittersets.GreedyHungarianMatching):
+                em_cand = self._emitter_set(prob_above, frame_ix, features, features_sigma)
+                counts = matcher.count_subsets(em_cand, em_tar, is_em)
+
+                return [SweepCounts(th, *c) for th, c in zip(thresholds, counts)]
+
+            out = []
+            for th, is_em_th in zip(thresholds, is_em):
+                prob = torch.where(th < th_break, prob_below, prob_above)
+
+                em = self._emitter_set(prob[is_em_th], frame_ix[is_em_th], features[:, is_em_th],
+                                       features_sigma[:, is_em_th] if features_sigma is not None else None)
+
+                if matcher is not None:
+                    tp, fp, fn, _ = matcher.forward(em, em_tar)
+                    em = SweepCounts(th=th, tp=len(tp), fp=len(fp), fn=len(fn))
+
+                out.append(em)
+
+        return out
+
+    def _sweep_prob(self, p: torch.Tensor) -> tuple:
+        """
+        Output probability of each pixel as function of the threshold. For the look-up and the NMS this is a step
+        function: prob_below for thresholds below th_break and prob_above otherwise. A pixel is an emitter for a
+        threshold if its output probability is above it.
+
+        Args:
+            p: detection channel
+
+        Returns:
+            th_break, prob_below, prob_above
+
+        """
+        return p, p, p
+
+    def _emitter_set(self, prob: torch.Tensor, frame_ix: torch.Tensor, features: torch.Tensor,
+                     features_sigma: Optional[torch.Tensor]) -> EmitterSet:
+        """EmitterSet of the looked up features (phot, x, y, z, bg) and sigma features (phot, x, y, z)."""
+
+        xyz = features[1:4].transpose(0, 1)
+
+        if features_sigma is not None:
             xyz_sigma = features_sigma[1:4].transpose(0, 1).cpu()
             phot_sigma = features_sigma[0].cpu()
         else:
@@ -223,6 +339,7 @@ class NMSPostProcessing(LookUpPostProcessing):
 
     _p_aggregations = ('sum', 'norm_sum')  # , 'max', 'pbinom_cdf', 'pbinom_pdf')
     _split_th = 0.6
+    _footprint = 1  # 3 x 3 maximum and aggregation
 
     def __init__(self, raw_th: float, xy_unit: str, px_size=None,
                  pphotxyzbg_mapping: Union[list, tuple] = (0, 1, 2, 3, 4, -1),
@@ -245,9 +362,42 @@ class NMSPostProcessing(LookUpPostProcessing):
         self.p_aggregation = self.set_p_aggregation(p_aggregation)
 
     def forward(self, x: torch.Tensor) -> EmitterSet:
-        x[:, 0] = self._nms(x[:, 0], self.p_aggregation, self.raw_th, self._split_th)
+        """
+        Forward model output tensor through the non-maximum suppression and the look-up. The model output is not
+        modified.
+
+        Args:
+            x: model output
+
+        Returns:
+            EmitterSet
+
+        """
+        p = self._nms(x[:, self.pphotxyzbg_mapping[0]], self.p_aggregation, self.raw_th, self._split_th)
+
+        return self._forward_detection(x, p)
+
+    def _sweep_prob(self, p: torch.Tensor) -> tuple:
+        """
+        The raw threshold enters the NMS only through the maximum mask: a pixel is part of it if it is the maximum of
+        its 3x3 patch and above the threshold, or if it is 0 and its whole patch is below the threshold. Hence the
+        output of a pixel changes at its own probability (at the maximum of its patch for pixels that are 0).
+
+        """
+        with torch.no_grad():
+            p = p[:, None]
 
-        return super().forward(x)
+            pool = torch.nn.functional.max_pool2d(p, 3, 1, padding=1)
+            conv = torch.nn.functional.conv2d(p, _nms_filter(p.device, p.dtype), padding=1)
+
+            is_zero = p == 0
+            is_max = (p == pool) * ~is_zero
+
+            """Below the break: maximum mask of the local maxima. Above: maximum mask of the zeros."""
+            p_below = self.p_aggregation(is_max * conv, (p * ~is_max > self._split_th) * conv)
+            p_above = self.p_aggregation(is_zero * conv, (p > self._split_th) * conv)
+
+            return torch.where(is_zero, pool, p)[:, 0], p_below[:, 0], p_above[:, 0]
 
     @staticmethod
     def _nms(p: torch.Tensor, p_aggregation, raw_th, split_th) -> torch.Tensor:
@@ -260,33 +410,27 @@ class NMSPostProcessing(LookUpPostProcessing):
         """
 
         with torch.no_grad():
-            p_copy = p.clone()
+            p = p[:, None]
 
             """Probability values > 0.3 are regarded as possible locations"""
-            p_clip = torch.where(p > raw_th, p, torch.zeros_like(p))[:, None]
+            p_clip = p.masked_fill(p <= raw_th, 0.)
 
             """localize maximum values within a 3x3 patch"""
-            pool = torch.nn.functional.max_pool2d(p_clip, 3, 1, padding=1)
-            max_mask1 = torch.eq(p[:, None], pool).float()
+            max_mask1 = p == torch.nn.functional.max_pool2d(p_clip, 3, 1, padding=1)
+            del p_clip
 
             """Add probability values from the 4 adjacent pixels"""
-            diag = 0.  # 1/np.sqrt(2)
-            filt = torch.tensor([[diag, 1., diag], [1, 1, 1], [diag, 1, diag]]).unsqueeze(0).unsqueeze(0).to(p.device)
-            conv = torch.nn.functional.conv2d(p[:, None], filt, padding=1)
-            p_ps1 = max_mask1 * conv
+            conv = torch.nn.functional.conv2d(p, _nms_filter(p.device, p.dtype), padding=1)
 
             """
             In order do be able to identify two fluorophores in adjacent pixels we look for 
             probablity values > 0.6 that are not part of the first mask
             """
-            p_copy *= (1 - max_mask1[:, 0])
-            # p_clip = torch.where(p_copy > split_th, p_copy, torch.zeros_like(p_copy))[:, None]
-            max_mask2 = torch.where(p_copy > split_th, torch.ones_like(p_copy), torch.zeros_like(p_copy))[:, None]
-            p_ps2 = max_mask2 * conv
+            max_mask2 = (p > split_th) * ~max_mask1
 
             """This is our final clustered probablity which we then threshold (normally > 0.7)
             to get our final discrete locations"""
-            p_ps = p_aggregation(p_ps1, p_ps2)
+            p_ps = p_aggregation(conv * max_mask1, conv * max_mask2)
             assert p_ps.size(1) == 1
 
             return p_ps.squeeze(1)
@@ -327,6 +471,7 @@ class ConsistencyPostprocessing(PostProcessing):
     """
     _p_aggregations = ('sum', 'max', 'pbinom_cdf', 'pbinom_pdf')
     _xy_unit = 'nm'
+    _footprint = 6  # 13 x 13 mean filter of the background
 
     def __init__(self, *, raw_th, em_th, xy_unit: str, img_shape, ax_th=None, vol_th=None, lat_th=None,
                  p_aggregation='pbinom_cdf', px_size=None, match_dims=2, diag=0, pphotxyzbg_mapping=[0, 1, 2, 3, 4, -1],
@@ -346,7 +491,8 @@ class ConsistencyPostprocessing(PostProcessing):
             px_size:
             match_dims:
             diag:
-            num_workers:
+            num_workers: number of processes that cluster the frames with difficult pixels (in chunks of frames). 0
+                clusters the batch in this process.
             skip_th: relative fraction of the detection output to be on to skip post_processing.
                 This is useful during training when the network has not yet converged and major parts of the
                 detection output is white (i.e. non sparse detections).
@@ -360,12 +506,15 @@ class ConsistencyPostprocessing(PostProcessing):
         self.p_aggregation = p_aggregation
         self.match_dims = match_dims
         self.num_workers = num_workers
+        self._pool = None  # process pool of the workers, started on first use and shut down by close
+        self._pool_finalizer = None
         self.skip_th = skip_th
 
         self.pphotxyzbg_mapping = pphotxyzbg_mapping
 
-        self._filter = match_emittersets.GreedyHungarianMatching(match_dims=match_dims, dist_lat=lat_th,
-                                                                 dist_ax=ax_th, dist_vol=vol_th).filter
+        self._matcher = match_emittersets.GreedyHungarianMatching(match_dims=match_dims, dist_lat=lat_th,
+                                                                  dist_ax=ax_th, dist_vol=vol_th)
+        self._filter = self._matcher.filter
 
         self._bg_calculator = decode.simulation.background.BgPerEmitterFromBgFrame(filter_size=13, xextent=(0., 1.),
                                                                                    yextent=(0., 1.),
@@ -373,11 +522,6 @@ class ConsistencyPostprocessing(PostProcessing):
 
         self._neighbor_kernel = torch.tensor([[diag, 1, diag], [1, 1, 1], [diag, 1, diag]]).float().view(1, 1, 3, 3)
 
-        self._clusterer = AgglomerativeClustering(n_clusters=None,
-                                                  distance_threshold=lat_th if self.match_dims == 2 else vol_th,
-                                                  affinity='precomputed',
-                                                  linkage='single')
-
         if sanity_check:
             self.sanity_check()
 
@@ -426,79 +570,189 @@ class ConsistencyPostprocessing(PostProcessing):
 
     def _cluster_batch(self, p, features):
         """
-        Cluster a batch of frames
-        
+        Cluster a batch of frames. Candidate groups are the connected components of the active pixels in the 3 x 3
+        neighbourhood graph. Within a group, two pixels are linked if their features are consistent,
+        i.e. within the lateral / axial / volume thresholds and closer than the clustering distance; the clusters are
+        the connected components of these links (single linkage). All groups of the batch are processed at once.
+
         Args:
             p (torch.Tensor): detections
             features (torch.Tensor): features
 
         Returns:
+            p_out: aggregated probability at the first pixel (in raster order) of each cluster, 0 elsewhere
+            feat_out: features averaged (probability weighted) over each cluster at all its pixels
 
         """
 
-        clusterer = self._clusterer
-        p_aggregation = self.p_aggregation
-
         if p.size(1) > 1:
             raise ValueError("Not Supported shape for propbabilty.")
-        p_out = torch.zeros_like(p).view(p.size(0), p.size(1), -1)
-        feat_out = features.clone().view(features.size(0), features.size(1), -1)
-
-        """Frame wise clustering."""
-        for i in range(features.size(0)):
-            ix = p[i, 0] > 0
-            if (ix == 0.).all().item():
-                continue
-            alg_ix = (p[i].view(-1) > 0).nonzero().squeeze(1)
-
-            p_frame = p[i, 0, ix].view(-1)
-            f_frame = features[i, :, ix]
-            # flatten samples and put them in the first dim
-            f_frame = f_frame.reshape(f_frame.size(0), -1).permute(1, 0)
-
-            filter_mask = self._filter(f_frame[:, 1:4], f_frame[:, 1:4])
-            if self.match_dims == 2:
-                dist_mat = torch.pdist(f_frame[:, 1:3])
-            elif self.match_dims == 3:
-                dist_mat = torch.pdist(f_frame[:, 1:4])
-            else:
-                raise ValueError
 
-            dist_mat = torch.from_numpy(scipy.spatial.distance.squareform(dist_mat))
-            dist_mat[~filter_mask] = 999999999999.  # those who shall not match shall be separated, only finite vals ...
+        p_out = torch.zeros_like(p).view(-1)
+        feat_out = features.clone().permute(1, 0, 2, 3).reshape(features.size(1), -1)
 
-            if dist_mat.shape[0] == 1:
-                warnings.warn("I don't know how this can happen but there seems to be a"
-                              " single an isolated difficult case ...", stacklevel=3)
-                n_clusters = 1
-                labels = torch.tensor([0])
-            else:
-                clusterer.fit(dist_mat)
-                n_clusters = clusterer.n_clusters_
-                labels = torch.from_numpy(clusterer.labels_)
-
-            for c in range(n_clusters):
-                in_cluster = labels == c
-                feat_ix = alg_ix[in_cluster]
-                if p_aggregation == 'sum':
-                    p_agg = p_frame[in_cluster].sum()
-                elif p_aggregation == 'max':
-                    p_agg = p_frame[in_cluster].max()
-                elif p_aggregation == 'pbinom_cdf':
-                    z = binom_pdiverse(p_frame[in_cluster].view(-1))
-                    p_agg = z[1:].sum()
-                elif p_aggregation == 'pbinom_pdf':
-                    z = binom_pdiverse(p_frame[in_cluster].view(-1))
-                    p_agg = z[1]
-                else:
-                    raise ValueError
-
-                p_out[i, 0, feat_ix[0]] = p_agg  # only set first element to some probability
-                """Average the features."""
-                feat_av = (feat_out[i, :, feat_ix] * p_frame[in_cluster]).sum(1) / p_frame[in_cluster].sum()
-                feat_out[i, :, feat_ix] = feat_av.unsqueeze(1).repeat(1, in_cluster.sum())
-
-        return p_out.reshape(p.size()), feat_out.reshape(features.size())
+        is_active = p[:, 0] > 0
+        px_ix = is_active.view(-1).nonzero().squeeze(1)  # flat pixel index, i.e. raster order within the frames
+        if len(px_ix) == 0:
+            return p_out.view(p.size()), feat_out.view(features.size(1), features.size(0),
+                                                       *features.shape[2:]).permute(1, 0, 2, 3)
+
+        p_px = p.view(-1)[px_ix]
+        f_px = feat_out[:, px_ix].t()  # n x C
+        n = len(px_ix)
+
+        """Candidate groups: connected components of the active pixels in the neighbour graph"""
+        groups = _connected_components(n, self._neighbor_edges(is_active))
+
+        """Consistency links between all pairs of pixels of a group"""
+        order = torch.argsort(groups)
+        sizes = torch.bincount(groups, minlength=n)
+        start = torch.cumsum(sizes, 0) - sizes
+
+        rep = sizes[groups[order]]
+        first = torch.repeat_interleave(order, rep)
+        offset = torch.arange(len(first)) - torch.repeat_interleave(torch.cumsum(rep, 0) - rep, rep)
+        second = order[start[groups[first]] + offset]
+
+        is_pair = first < second
+        first, second = first[is_pair], second[is_pair]
+
+        links = self._consistent(f_px[first, 1:4], f_px[second, 1:4])
+        labels = _connected_components(n, torch.stack([first[links], second[links]], 0))
+
+        """Aggregate probability and features per cluster"""
+        p_agg = self._aggregate_p(p_px, labels, n)
+        is_first = torch.arange(n) == labels  # the label is the smallest pixel index of the cluster
+        p_out[px_ix[is_first]] = p_agg[labels[is_first]].type(p_out.dtype)
+
+        p_sum = torch.zeros(n, dtype=p_px.dtype).index_add_(0, labels, p_px)
+        feat_av = torch.zeros_like(f_px).index_add_(0, labels, f_px * p_px.unsqueeze(1)) / p_sum.unsqueeze(1)
+        feat_out[:, px_ix] = feat_av[labels].t()
+
+        return p_out.view(p.size()), feat_out.view(features.size(1), features.size(0),
+                                                   *features.shape[2:]).permute(1, 0, 2, 3)
+
+    def _cluster_batch_parallel(self, p, features):
+        """
+        Cluster a batch of frames in the worker processes. Only the frames with difficult pixels are dispatched, split
+        in one chunk of consecutive frames per worker. Frames are clustered independently, i.e. the output is the same
+        as of _cluster_batch.
+
+        """
+        p_out = torch.zeros_like(p)
+        feat_out = features.clone()
+
+        frame_ix = (p > 0).flatten(1).any(1).nonzero().squeeze(1)
+        if len(frame_ix) == 0:
+            return p_out, feat_out
+
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.num_workers, mp_context=torch.multiprocessing.get_context('spawn'))
+            self._pool_finalizer = weakref.finalize(self, self._pool.shutdown)  # if not closed explicitly
+
+        n_chunks = min(self.num_workers, len(frame_ix))  # of (almost) equal size, as torch.tensor_split (torch >= 1.8)
+        chunks = frame_ix.split([len(frame_ix) // n_chunks + (i < len(frame_ix) % n_chunks) for i in range(n_chunks)])
+        futures = [self._pool.submit(_cluster_chunk, self, p[ix], features[ix]) for ix in chunks]
+
+        """Merge in order of the chunks"""
+        for ix, future in zip(chunks, futures):
+            p_out[ix], feat_out[ix] = future.result()
+
+        return p_out, feat_out
+
+    def close(self):
+        """Shuts down the worker processes, they are started again on the next use."""
+        if self._pool is not None:
+            self._pool_finalizer()
+            self._pool, self._pool_finalizer = None, None
+
+    def __getstate__(self):  # the pool is not pickled (e.g. for the workers), but started again on use
+        state = self.__dict__.copy()
+        state['_pool'], state['_pool_finalizer'] = None, None
+        return state
+
+    @staticmethod
+    def _neighbor_edges(is_active: torch.BoolTensor) -> torch.LongTensor:
+        """
+        Edges (2 x E) between active pixels in the 3 x 3 neighbourhood of each other, including diagonals independent
+        of the neighbour kernel (which only decides what is an easy case). Pixels are indexed by their rank in raster
+        order.
+        """
+        ix = torch.full(is_active.size(), -1, dtype=torch.long)
+        ix[is_active] = torch.arange(int(is_active.sum()))
+        ix = torch.nn.functional.pad(ix, [1, 1, 1, 1], value=-1)
+
+        h, w = is_active.shape[-2:]
+        center = ix[:, 1:-1, 1:-1]
+
+        edges = []
+        for dy, dx in ((0, 1), (1, -1), (1, 0), (1, 1)):  # half of the neighbourhood, the graph is undirected
+            nb = ix[:, 1 + dy:1 + dy + h, 1 + dx:1 + dx + w]
+            is_edge = (center >= 0) * (nb >= 0)
+            edges.append(torch.stack([center[is_edge], nb[is_edge]], 0))
+
+        return torch.cat(edges, 1)
+
+    def _consistent(self, xyz_a: torch.Tensor, xyz_b: torch.Tensor) -> torch.BoolTensor:
+        """Element-wise consistency of two sets of coordinates, i.e. whether they would be clustered."""
+        matcher = self._matcher
+        is_cons = torch.ones(xyz_a.size(0), dtype=torch.bool)
+
+        dist_lat = (xyz_a[:, :2] - xyz_b[:, :2]).norm(dim=1)
+        dist_ax = (xyz_a[:, 2] - xyz_b[:, 2]).abs()
+        dist_vol = (xyz_a - xyz_b).norm(dim=1)
+
+        if matcher.dist_lat is not None:
+            is_cons *= dist_lat <= matcher.dist_lat
+        if matcher.dist_ax is not None:
+            is_cons *= dist_ax <= matcher.dist_ax
+        if matcher.dist_vol is not None:
+            is_cons *= dist_vol <= matcher.dist_vol
+
+        """Clustering distance (the linkage threshold at or above which clusters are not merged)"""
+        if self.match_dims == 2:
+            cluster_th, dist = matcher.dist_lat, dist_lat
+        elif self.match_dims == 3:
+            cluster_th, dist = matcher.dist_vol, dist_vol
+        else:
+            raise ValueError
+
+        if cluster_th is not None:
+            is_cons *= dist < cluster_th
+
+        return is_cons
+
+    def _aggregate_p(self, p: torch.Tensor, labels: torch.LongTensor, n: int) -> torch.Tensor:
+        """
+        Aggregated probability per cluster. The binomial aggregations are computed in log space from the product of
+        the counter probabilities, pixels with probability 1 are accounted separately.
+        """
+        if self.p_aggregation == 'sum':
+            return torch.zeros(n, dtype=p.dtype).index_add_(0, labels, p)
+
+        if self.p_aggregation == 'max':
+            return _scatter_extreme(torch.zeros(n, dtype=p.dtype), labels, p, largest=True)
+
+        p = p.double()
+        is_one = p >= 1
+        log_q = torch.where(is_one, torch.zeros_like(p), torch.log1p(-torch.where(is_one, torch.zeros_like(p), p)))
+
+        log_q_sum = torch.zeros(n, dtype=p.dtype).index_add_(0, labels, log_q)  # log prod(1 - p) without the ones
+        n_one = torch.zeros(n, dtype=torch.long).index_add_(0, labels, is_one.long())
+
+        if self.p_aggregation == 'pbinom_cdf':  # at least one
+            p_agg = torch.where(n_one == 0, -torch.expm1(log_q_sum), torch.ones_like(log_q_sum))
+
+        elif self.p_aggregation == 'pbinom_pdf':  # exactly one
+            p_single = torch.zeros(n, dtype=p.dtype).index_add_(
+                0, labels, torch.where(is_one, torch.zeros_like(p), p * torch.exp(log_q_sum[labels] - log_q)))
+            p_agg = torch.where(n_one == 0, p_single, torch.where(n_one == 1, torch.exp(log_q_sum),
+                                                                  torch.zeros_like(p_single)))
+        else:
+            raise ValueError
+
+        return p_agg.float()
 
     def _forward_raw_impl(self, p, features):
         """
@@ -559,7 +813,7 @@ class ConsistencyPostprocessing(PostProcessing):
             if self.num_workers == 0:
                 p_out_diff, feat_out_diff = self._cluster_batch(p_diff.cpu(), feat_diff.cpu())
             else:
-                raise NotImplementedError
+                p_out_diff, feat_out_diff = self._cluster_batch_parallel(p_diff.cpu(), feat_diff.cpu())
 
             """Add the easy ones."""
             p_out[is_easy] = p_easy[is_easy].cpu()
@@ -648,3 +902,73 @@ class ConsistencyPostprocessing(PostProcessing):
         return EmitterSet(xyz=feature_list[:, 1:4], phot=feature_list[:, 0], frame_ix=frame_ix,
                           prob=prob_final, bg=feature_list[:, 4],
                           xy_unit=self.xy_unit, px_size=self.px_size)
+
+
+@functools.lru_cache()
+def _nms_filter(device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """3x3 filter of the NMS (centre and the 4 adjacent pixels), cached per device and dtype."""
+    diag = 0.  # 1/np.sqrt(2)
+    return torch.tensor([[diag, 1., diag], [1, 1, 1], [diag, 1, diag]], dtype=dtype, device=device).view(1, 1, 3, 3)
+
+
+def _cluster_chunk(post: ConsistencyPostprocessing, p: torch.Tensor, features: torch.Tensor):
+    """Clusters a chunk of frames in a worker process."""
+    return post._cluster_batch(p, features)
+
+
+def _connected_components(n: int, edges: torch.LongTensor) -> torch.LongTensor:
+    """
+    Connected components of an undirected graph by label propagation with pointer jumping.
+
+    Args:
+        n: number of nodes
+        edges: edges (2 x E)
+
+    Returns:
+        label per node, i.e. the smallest node index of its component
+
+    """
+    labels = torch.arange(n)
+    src = torch.cat([edges[0], edges[1]])
+    dst = torch.cat([edges[1], edges[0]])
+
+    while True:
+        labels_new = torch.min(labels, _scatter_extreme(labels, dst, labels[src], largest=False))
+        labels_new = labels_new[labels_new]  # pointer jumping
+
+        if (labels_new == labels).all():
+            return labels
+
+        labels = labels_new
+
+
+def _scatter_extreme(out: torch.Tensor, index: torch.LongTensor, src: torch.Tensor, largest: bool) -> torch.Tensor:
+    """
+    Minimum (maximum) of src per index, written into a copy of out. Entries of out without src keep their value.
+    Works on torch versions without scatter_reduce by sorting by index and value.
+
+    Args:
+        out: initial values
+        index: target index per src element
+        src: values
+        largest: maximum instead of minimum
+
+    Returns:
+        copy of out with the reduced values
+
+    """
+    out = out.clone()
+    if len(index) == 0:
+        return out
+
+    order = torch.from_numpy(np.lexsort((src.cpu().numpy(), index.cpu().numpy()))).to(index.device)
+    index_sorted = index[order]
+
+    is_edge = torch.ones_like(index_sorted, dtype=torch.bool)
+    if largest:  # last of each index
+        is_edge[:-1] = index_sorted[1:] != index_sorted[:-1]
+    else:  # first of each index
+        is_edge[1:] = index_sorted[1:] != index_sorted[:-1]
+
+    out[index_sorted[is_edge]] = src[order[is_edge]].type(out.dtype)
+    return out
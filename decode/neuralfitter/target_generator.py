@@ -281,25 +281,20 @@ class ParameterListTarget(TargetGenerator):
         param_tar = torch.zeros((n_frames, self.n_max, 4))
         mask_tar = torch.zeros((n_frames, self.n_max)).bool()
 
-        if self.xy_unit == 'px':
-            xyz = em.xyz_px
-        elif self.xy_unit == 'nm':
-            xyz = em.xyz_nm
-        else:
+        if self.xy_unit not in ('px', 'nm'):
             raise NotImplementedError
 
         """Set number of active elements per frame"""
-        for i in range(n_frames):
-            n_emitter = len(em.get_subset_frame(i, i))
+        for i, em_frame in enumerate(em.split_in_frames(0, n_frames - 1)):
+            n_emitter = len(em_frame)
 
             if n_emitter > self.n_max:
                 raise ValueError("Number of actual emitters exceeds number of max. emitters.")
 
             mask_tar[i, :n_emitter] = 1
 
-            ix = em.frame_ix == i
-            param_tar[i, :n_emitter, 0] = em[ix].phot
-            param_tar[i, :n_emitter, 1:] = xyz[ix]
+            param_tar[i, :n_emitter, 0] = em_frame.phot
+            param_tar[i, :n_emitter, 1:] = em_frame.xyz_px if self.xy_unit == 'px' else em_frame.xyz_nm
 
         return self._postprocess_output(param_tar), self._postprocess_output(mask_tar), bg
 
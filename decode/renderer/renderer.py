@@ -1,6 +1,8 @@
 from abc import ABC
+from typing import Union
 import torch
 from ..generic import emitter
+from ..utils import emitter_io
 import math
 
 import numpy as np
@@ -56,12 +58,25 @@ class Renderer2D(Renderer):
     2D Renderer with constant gaussian.
 
     """
+    _attr = ('xyz', 'phot', 'frame_ix')  # attributes needed for rendering
 
-    def __init__(self, px_size, sigma_blur, xextent=None, yextent=None, clip_percentile=None):
+    def __init__(self, px_size, sigma_blur, xextent=None, yextent=None, clip_percentile=None, chunk_size: int = 1000):
+        """
+
+        Args:
+            px_size: pixel size of the rendered image
+            sigma_blur: sigma of the gaussian blur
+            xextent: extent in x, determined by the emitters if None
+            yextent: extent in y, determined by the emitters if None
+            clip_percentile: clip the histogram at this percentile
+            chunk_size: number of frames per chunk when rendering an out-of-core set (EmitterSetH5)
+
+        """
         super().__init__(xextent=xextent, yextent=yextent, px_size=px_size)
 
         self.sigma_blur = sigma_blur
         self.clip_percentile = clip_percentile
+        self.chunk_size = chunk_size
 
     def render(self, em, ax=None, cmap: str = 'gray'):
 
@@ -73,14 +88,31 @@ class Renderer2D(Renderer):
         ax = ax.imshow(np.transpose(hist), cmap=cmap)  # because imshow use different ordering
         return ax
 
-    def forward(self, em: emitter.EmitterSet) -> torch.Tensor:
+    def forward(self, em: Union[emitter.EmitterSet, emitter_io.EmitterSetH5]) -> torch.Tensor:
+        """
+        Forward emitterset through rendering and output rendered data.
+        Out-of-core sets are histogrammed chunk by chunk, i.e. never loaded as a whole.
 
-        if self.xextent is None:
-            self.xextent = (em.xyz_nm[:, 0].min(), em.xyz_nm[:, 0].max())
-        if self.yextent is None:
-            self.yextent = (em.xyz_nm[:, 1].min(), em.xyz_nm[:, 1].max())
+        Args:
+            em: emitter set
+
+        """
+
+        if isinstance(em, emitter_io.EmitterSetH5):
+            chunks = lambda: (em_c for em_c in em.iter_chunks(self.chunk_size, attributes=self._attr) if len(em_c))
+        else:
+            chunks = lambda: (em,)
 
-        hist = self._hist2d(em.xyz_nm[:, :2].numpy(), xextent=self.xextent, yextent=self.yextent, px_size=self.px_size)
+        if self.xextent is None or self.yextent is None:
+            xy_min, xy_max = self._xy_range(chunks())
+
+            if self.xextent is None:
+                self.xextent = (xy_min[0], xy_max[0])
+            if self.yextent is None:
+                self.yextent = (xy_min[1], xy_max[1])
+
+        hist = sum(self._hist2d(em_c.xyz_nm[:, :2].numpy(), xextent=self.xextent, yextent=self.yextent,
+                                px_size=self.px_size) for em_c in chunks())
 
         if self.clip_percentile is not None:
             hist = np.clip(hist, 0., np.percentile(hist, self.clip_percentile))
@@ -90,6 +122,17 @@ class Renderer2D(Renderer):
 
         return torch.from_numpy(hist)
 
+    @staticmethod
+    def _xy_range(chunks) -> tuple:
+        """Minimum and maximum of x and y (nm) in a single pass over the chunks."""
+        xy_min, xy_max = None, None
+        for em_c in chunks:
+            xy = em_c.xyz_nm[:, :2]
+            xy_min = xy.min(0).values if xy_min is None else torch.min(xy_min, xy.min(0).values)
+            xy_max = xy.max(0).values if xy_max is None else torch.max(xy_max, xy.max(0).values)
+
+        return xy_min, xy_max
+
     @staticmethod
     def _hist2d(xy: np.array, xextent, yextent, px_size) -> np.array:
 
@@ -1,3 +1,4 @@
+import math
 import pathlib
 
 import pytest
@@ -96,6 +97,37 @@ class TestInferenceDataset(TestDataset):
         return dataset
 
 
+class TestInferenceBatchDataset:
+
+    @pytest.fixture()
+    def frames(self):
+        return torch.rand((37, 16, 16))
+
+    @pytest.mark.parametrize("window", [1, 3, 5])
+    @pytest.mark.parametrize("batch_size", [1, 4, 64])
+    @pytest.mark.parametrize("pad", ['same', None])
+    def test_getitem(self, frames, window, batch_size, pad):
+        """Batches are the same as the collated samples of the InferenceDataset"""
+
+        class DummyFrameProc:
+            def forward(x: torch.Tensor):
+                return x.clamp(0., 0.5)
+
+        ds_ref = can.InferenceDataset(frames=frames, frame_proc=DummyFrameProc, frame_window=window)
+        ds = can.InferenceBatchDataset(frames=frames, frame_proc=DummyFrameProc, frame_window=window,
+                                       batch_size=batch_size, pad=pad)
+
+        ix_ref = torch.arange(len(frames)) if pad == 'same' else torch.arange(window // 2, len(frames) - window // 2)
+        batches = [ds[i] for i in range(len(ds))]
+
+        assert len(ds) == math.ceil(len(ix_ref) / batch_size)
+        assert batches[0].size() == torch.Size((min(batch_size, len(ix_ref)), window, 16, 16))
+        assert (torch.cat(batches, 0) == torch.stack([ds_ref[i] for i in ix_ref], 0)).all()
+
+        with pytest.raises(IndexError):
+            ds[len(ds)]
+
+
 class TestSMLMLiveDataset:
 
     @pytest.fixture()
@@ -190,6 +190,132 @@ class TestEmitterSet:
         assert em_split.__len__() == 1
         assert (em_split[0].frame_ix == 1).all()
 
+    @pytest.mark.parametrize("sorted", [True, False])
+    def test_get_subset_frame(self, sorted):
+
+        em = RandomEmitterSet(1000)
+        em.id = torch.arange(len(em))
+        em.frame_ix = torch.randint(-5, 50, (len(em),))
+        if sorted:
+            em = em.sort_by_frame()
+
+        for frame_start, frame_end in [(-10, 100), (-5, -5), (0, 10), (20, 19), (48, 60), (60, 70)]:
+            ix = (em.frame_ix >= frame_start) * (em.frame_ix <= frame_end)
+            assert em.get_subset_frame(frame_start, frame_end) == em[ix]
+
+        """Shifting the frame index of the subset must not alter the original set."""
+        frame_ix = em.frame_ix.clone()
+        em_sub = em.get_subset_frame(0, 10, 5)
+        assert (em_sub.frame_ix >= 5).all()
+        assert (em.frame_ix == frame_ix).all()
+
+        """The subset is a copy for sorted and unsorted sets"""
+        xyz = em.xyz.clone()
+        em.get_subset_frame(0, 10).xyz[:, 0] += 1.
+        assert (em.xyz == xyz).all()
+
+    def test_frame_index_invalidation(self):
+
+        em = RandomEmitterSet(100)
+        em.frame_ix = torch.arange(len(em))
+        assert len(em.get_subset_frame(0, 9)) == 10
+
+        """Replace frame index"""
+        em.frame_ix = torch.zeros_like(em.frame_ix)
+        assert len(em.get_subset_frame(0, 9)) == 100
+
+        """Modify frame index inplace"""
+        em.frame_ix[50:] = 20
+        assert len(em.get_subset_frame(0, 9)) == 50
+        assert len(em.split_in_frames(0, 20)[20]) == 50
+
+    def test_split_in_frames_independent(self):
+        """Splits are views into one sorted copy, i.e. inplace operations do not reach the set or the other splits"""
+
+        em = RandomEmitterSet(100)
+        em.frame_ix = torch.arange(len(em)) // 10
+        xyz = em.xyz.clone()
+
+        em_split = em.split_in_frames(0, 9)
+        assert em_split[3] == em[30:40]
+        assert em_split[4].xyz.data_ptr() == em_split[3].xyz[10:].data_ptr()
+
+        em_split[3].xyz += 1.
+        assert (em.xyz == xyz).all()
+        assert (em_split[4].xyz == xyz[40:50]).all()
+
+    def test_slice_independent(self):
+
+        em = RandomEmitterSet(100, px_size=(100., 100.))
+        em_slice = em[20:40]
+
+        assert em_slice == em[torch.arange(20, 40)]
+        assert len(em[90:200]) == 10
+        assert len(em[40:20]) == 0
+
+        xyz = em.xyz.clone()
+        em_slice.xyz += 1.
+        assert (em.xyz == xyz).all()
+
+    def test_view(self):
+
+        em = RandomEmitterSet(100, px_size=(100., 100.))
+        em.xyz_sig = torch.rand_like(em.xyz)
+        em_view = em.view(20, 40)
+
+        """Attributes are materialised lazily and share memory with the original set."""
+        assert 'xyz' not in em_view.__dict__
+        assert em_view.xyz.data_ptr() == em.xyz[20:].data_ptr()
+        assert 'xyz' in em_view.__dict__ and 'phot' not in em_view.__dict__
+
+        assert len(em_view) == 20
+        assert em_view == em[torch.arange(20, 40)]
+        assert em_view.eq_attr(em)
+        assert len(em.view(90, 200)) == 10
+        assert len(em.view(-5, None)) == 5
+        assert em.view(10, 40).view(10, 30) == em_view
+
+        """Indexing does not return a view"""
+        assert '_view' not in em[20:40].__dict__
+
+        """Assignment leaves the original set untouched"""
+        xyz = em.xyz.clone()
+        em_view.xyz = torch.zeros_like(em_view.xyz)
+        assert (em.xyz == xyz).all()
+
+    def test_optional_attributes(self):
+
+        em = CoordinateOnlyEmitter(torch.rand(20, 3), xy_unit='px')
+        assert set(em._get_data().keys()) == {'xyz', 'phot', 'frame_ix', 'id', 'prob', 'bg'}
+        assert em.to_dict()['xyz_sig'] is None
+
+        """Subset, clone and views do not allocate the optional attributes"""
+        for em_out in (em[em.xyz[:, 0] > 0.5], em.clone(), em[5:10], em.split_in_frames(0, 0)[0]):
+            assert 'xyz_sig' not in em_out._get_data()
+
+        """Not set is equivalent to nan"""
+        em_nan = em.clone()
+        em_nan.phot_cr = float('nan') * torch.ones(20)
+        assert em == em_nan
+        em_nan.phot_cr[0] = 1.
+        assert em != em_nan
+
+        """Access allocates nan"""
+        assert em[5:10].xyz_sig.size() == torch.Size([5, 3])
+        assert torch.isnan(em.xyz_sig).all()
+        assert 'xyz_sig' in em._get_data()
+
+    def test_cat_optional_attributes(self):
+
+        em_a = RandomEmitterSet(10)
+        em_b = RandomEmitterSet(5)
+        em_b.phot_sig = torch.rand(5)
+
+        em = EmitterSet.cat([em_a, em_b])
+        assert 'phot_sig' in em._get_data() and 'xyz_sig' not in em._get_data()
+        assert torch.isnan(em.phot_sig[:10]).all()
+        assert (em.phot_sig[10:] == em_b.phot_sig).all()
+
     def test_cat_emittersets(self):
 
         sets = [RandomEmitterSet(50), RandomEmitterSet(20)]
@@ -265,10 +391,11 @@ class TestEmitterSet:
         with pytest.raises(ValueError):
             EmitterSet(xyz, phot, frame_ix)
 
-    def test_save_load(self):
+    @pytest.mark.parametrize("suffix", ['.pickle', '.h5'])
+    def test_save_load(self, suffix):
 
         random_em = RandomEmitterSet(1000)
-        file = Path(deepsmlm_root + 'decode/test/assets/dummy_emitter_save.pickle')
+        file = Path(deepsmlm_root + 'decode/test/assets/dummy_emitter_save' + suffix)
 
         with RMAfterTest(file):
             random_em.save(file)
@@ -278,6 +405,25 @@ class TestEmitterSet:
             random_em_load = EmitterSet.load(file)
             assert random_em == random_em_load, "Reloaded emitterset is not equivalent to inital one."
 
+    def test_save_load_h5_order(self):
+        """HDF5 stores the emitters sorted by frame, emitters of the same frame remain in order"""
+
+        em = RandomEmitterSet(5)
+        em.frame_ix = torch.tensor([3, 1, 2, 0, 1])
+        file = Path(deepsmlm_root + 'decode/test/assets/dummy_emitter_save.h5')
+
+        with RMAfterTest(file):
+            em.save(file)
+            em_load = EmitterSet.load(file)
+
+        perm = torch.tensor([3, 1, 4, 2, 0])
+        assert (em_load.frame_ix == torch.tensor([0, 1, 1, 2, 3])).all()
+        assert em_load == em[perm]
+
+        with RMAfterTest(file):
+            EmptyEmitterSet(xy_unit='px').save(file)
+            assert len(EmitterSet.load(file)) == 0
+
     @pytest.mark.parametrize("em_a,em_b,expct", [(CoordinateOnlyEmitter(torch.tensor([[0., 1., 2.]])),
                                                   CoordinateOnlyEmitter(torch.tensor([[0., 1., 2.]])),
                                                   True),
@@ -301,6 +447,64 @@ def test_empty_emitterset():
     assert 0 == len(em)
 
 
+class TestEmitterSetBuilder:
+
+    def test_extend_as_cat(self):
+
+        sets = [RandomEmitterSet(n, px_size=(100., 100.)) for n in (50, 0, 20, 1, 300)]
+        for em in sets:
+            em.xyz_sig = torch.rand_like(em.xyz)
+            em.id = torch.randint_like(em.id, 1000)
+
+        em_builder = emitter.EmitterSetBuilder().extend(sets, step_frame_ix=5).finalize()
+        em_cat = EmitterSet.cat(sets, step_frame_ix=5)
+
+        assert em_builder == em_cat
+        assert em_builder.eq_attr(em_cat)
+
+        em_builder = emitter.EmitterSetBuilder().extend(iter(sets), remap_frame_ix=torch.arange(5) * 2).finalize()
+        assert em_builder == EmitterSet.cat(sets, remap_frame_ix=torch.arange(5) * 2)
+
+    def test_growth(self):
+
+        builder = emitter.EmitterSetBuilder(xy_unit='px')
+        for i in range(100):
+            builder.append(RandomEmitterSet(i), frame_ix_shift=i)
+
+        assert len(builder) == sum(range(100))
+        assert builder._capacity < 2 * len(builder)
+
+        em = builder.finalize()
+        assert len(em) == len(builder)
+        assert (em.frame_ix.unique() == torch.arange(1, 100)).all()
+
+        """The spare capacity is trimmed"""
+        assert em.xyz.storage().size() <= 1.25 * em.xyz.numel()
+
+    def test_missing_columns(self):
+
+        builder = emitter.EmitterSetBuilder(xy_unit='px')
+        builder.append_columns(xyz=torch.rand(5, 3), phot=torch.rand(5), frame_ix=torch.zeros(5).long())
+        builder.append_columns(xyz=torch.rand(3, 3), phot=torch.rand(3), frame_ix=torch.zeros(3).long(),
+                               id=torch.arange(3), bg=torch.rand(3))
+
+        em = builder.finalize()
+        assert (em.id == torch.tensor([-1] * 5 + [0, 1, 2])).all()
+        assert torch.isnan(em.bg[:5]).all() and not torch.isnan(em.bg[5:]).any()
+        assert (em.prob == 1.).all()
+
+    def test_empty(self):
+        em = emitter.EmitterSetBuilder(xy_unit='nm').finalize()
+
+        assert len(em) == 0
+        assert em.xy_unit == 'nm'
+
+        builder = emitter.EmitterSetBuilder(xy_unit='nm')
+        builder.append(EmitterSet(xyz=torch.zeros(0, 3).double(), phot=torch.zeros(0).double(),
+                                  frame_ix=torch.zeros(0).long(), xy_unit='nm'))
+        assert builder.finalize().xyz.dtype == torch.double
+
+
 class TestLooseEmitterSet:
 
     def test_sanity(self):
@@ -0,0 +1,124 @@
+import functools
+import json
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+import tifffile
+import torch
+
+from decode.generic import emitter
+from decode.neuralfitter import fit
+from decode.neuralfitter.inference import autotune
+from decode.neuralfitter.models import SigmaMUNet
+from decode.test.asset_handler import RMAfterTest
+from decode.utils import param_io
+
+test_dir = Path(__file__).resolve().parent / 'assets'
+
+
+class TestFit:
+
+    @pytest.fixture(params=['NMS', 'LookUp'])
+    def fit_files(self, request):
+        """Parameter file, (untrained) model and frames of a small fit"""
+        param = param_io.load_reference()
+        param['Camera'].update({'baseline': 100., 'e_per_adu': 5., 'em_gain': 100., 'px_size': [100., 100.],
+                                'read_sigma': 58.8, 'spur_noise': 0.0015})
+        param['Scaling'].update({'input_scale': 50., 'input_offset': 20., 'bg_max': 100., 'phot_max': 5000.,
+                                 'z_max': 800.})
+        param['HyperParameter']['arch_param'].update({'initial_features': 8, 'inter_features': 8})
+        param['PostProcessing'] = request.param
+        param = param_io.RecursiveNamespace(**param)
+
+        model = SigmaMUNet.parse(param)
+
+        with RMAfterTest(test_dir / 'dummy_fit_param.yaml') as param_file, \
+                RMAfterTest(test_dir / 'dummy_fit_model.pt') as model_file, \
+                RMAfterTest(test_dir / 'dummy_fit_frames', recursive=True) as frames_dir:
+
+            param_io.ParamHandling().write_params(param_file, param)
+            torch.save(model.state_dict(), model_file)
+
+            frames_dir.mkdir()
+            for i in range(2):
+                tifffile.imwrite(frames_dir / f'frames_{i}.tif',
+                                 (torch.rand(7, 32, 32) * 1000 + 100).numpy().astype('uint16'))
+
+            yield param_file, model_file, frames_dir
+
+    def test_fit(self, fit_files):
+
+        param_file, model_file, frames_dir = fit_files
+
+        with RMAfterTest(test_dir / 'dummy_fit.h5') as file_out, \
+                RMAfterTest(test_dir / 'dummy_fit_report.json') as file_report:
+
+            rep = fit.fit(model_file, param_file, frames_dir, file_out, chunk_size=5, batch_size=4,
+                          raw_th=0.3, report_file=file_report)
+
+            em = emitter.EmitterSet.load(file_out)
+            with file_report.open() as f:
+                rep_file = json.load(f)
+
+        assert rep['frames'] == 14
+        assert rep['emitters'] == len(em)
+        assert rep == pytest.approx(rep_file)
+        assert rep['peak_rss_mb'] > 0
+        for k in ('frames_per_s', 'emitters_per_s', 't_load', 't_model', 't_post_proc', 't_write', 't_fit'):
+            assert k in rep
+        assert rep['frames_per_s'] == pytest.approx(14 / rep['t_fit'])
+        assert rep['t_fit'] <= rep['t_total']
+
+        if len(em) != 0:
+            assert 0 <= em.frame_ix.min() and em.frame_ix.max() < 14
+
+    def test_fit_batch_size_auto(self, fit_files, monkeypatch):
+        """Default batch size 'auto' is resolved by the autotuner before inference"""
+
+        param_file, model_file, frames_dir = fit_files
+        monkeypatch.setattr(autotune, 'InferAutotuner',
+                            functools.partial(autotune.InferAutotuner, batch_sizes=(2, 4), n_frames=8,
+                                              cache_file=None))
+
+        with RMAfterTest(test_dir / 'dummy_fit.h5') as file_out:
+            rep = fit.fit(model_file, param_file, frames_dir, file_out, raw_th=0.3)
+
+            em = emitter.EmitterSet.load(file_out)
+
+        assert rep['frames'] == 14
+        assert rep['emitters'] == len(em)
+
+    def test_fit_per_file(self, fit_files):
+
+        param_file, model_file, frames_dir = fit_files
+
+        with RMAfterTest(test_dir / 'dummy_fit_out', recursive=True) as dir_out:
+            rep = fit.fit(model_file, param_file, frames_dir, dir_out, per_file=True, format='csv', batch_size=4)
+
+            assert sorted(f.name for f in dir_out.iterdir()) == ['frames_0.csv', 'frames_1.csv']
+            n_em = sum(len(pd.read_csv(f)) for f in dir_out.iterdir() if f.stat().st_size > 0)
+
+        assert rep['frames'] == 14
+        assert rep['files'] == 2
+        assert rep['emitters'] == n_em
+
+    def test_main(self, fit_files, monkeypatch):
+
+        param_file, model_file, frames_dir = fit_files
+
+        with RMAfterTest(test_dir / 'dummy_fit.csv') as file_out:
+            monkeypatch.setattr(sys, 'argv', ['fit', '-m', str(model_file), '-p', str(param_file),
+                                              '-f', str(frames_dir), '-o', str(file_out), '-d', 'cpu', '-b', '4'])
+            fit.main()
+
+            assert file_out.is_file()
+
+    def test_output_sanity(self, fit_files):
+
+        param_file, model_file, frames_dir = fit_files
+
+        with RMAfterTest(test_dir / 'dummy_fit.txt'):
+            with pytest.raises(ValueError):
+                fit.fit(model_file, param_file, frames_dir, test_dir / 'dummy_fit.txt')
@@ -1,10 +1,26 @@
-import torch
+import concurrent.futures
+import copy
+import math
+import sys
+import weakref
+from pathlib import Path
+
+import pandas as pd
 import pytest
+import tifffile
+import torch
 
 from decode.generic import emitter
 from decode.generic.process import Identity
 from decode.neuralfitter.inference import inference
-from decode.neuralfitter import post_processing
+from decode.neuralfitter import coord_transform, post_processing, scale_transform
+from decode.evaluation.match_emittersets import GreedyHungarianMatching
+from decode.neuralfitter.inference import autotune, export, output_cache, precision, resumable, runtime, sharded
+from decode.neuralfitter.models import SigmaMUNet
+from decode.neuralfitter.utils import processing
+from decode.test.asset_handler import RMAfterTest
+
+test_dir = Path(__file__).resolve().parent / 'assets'
 
 
 class TestInfer:
@@ -45,3 +61,467 @@ class TestInfer:
         assert isinstance(out, torch.Tensor)
         assert out.size() == torch.Size((100, 1, 64, 64))
 
+
+
+class TestInferDummy:
+    """Inference with a small dummy model on the cpu"""
+
+    class _DummyPostProc:
+        """Emitter at the pixel of the maximum of each frame, photon count is the maximum"""
+
+        @staticmethod
+        def forward(x):
+            phot, ix = x[:, 0].flatten(1).max(1)
+            xyz = torch.stack([ix // x.size(-1), ix % x.size(-1), torch.zeros_like(ix)], 1).float()
+
+            return emitter.EmitterSet(xyz=xyz, phot=phot, frame_ix=torch.arange(x.size(0)), xy_unit='px')
+
+    @pytest.fixture(params=[True, False], ids=['batch_windows', 'sample_windows'])
+    def infer(self, request):
+        model = torch.nn.Conv2d(5, 1, kernel_size=3, padding=1)
+
+        return inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=self._DummyPostProc(),
+                               device='cpu', batch_size=4, num_workers=0, pin_memory=False,
+                               batch_windows=request.param)
+
+    def test_batch_windows(self, infer):
+
+        frames = torch.rand((37, 16, 16))
+        em = infer.forward(frames)
+
+        infer.batch_windows = not infer.batch_windows
+        self.assert_em_equal(infer.forward(frames), em)
+
+    @pytest.mark.parametrize("n,chunk_size", [(37, 10), (37, 1), (10, 37), (4, 2)])
+    def test_forward_stream(self, infer, n, chunk_size):
+
+        frames = torch.rand((n, 16, 16))
+        em_ref = infer.forward(frames)
+
+        """Chunks of the whole stack"""
+        out = list(infer.forward_stream(frames, chunk_size=chunk_size))
+        assert len(out) == math.ceil(n / chunk_size)
+        self.assert_em_equal(emitter.EmitterSet.cat(out), em_ref)
+
+        """Blocks of arbitrary size"""
+        blocks = [frames[:3], frames[3:4], frames[4:]]
+        out = list(infer.forward_stream(blocks, chunk_size=chunk_size))
+        self.assert_em_equal(emitter.EmitterSet.cat(out), em_ref)
+
+    @pytest.mark.parametrize("workers", [0, 2])
+    def test_metrics(self, infer, workers):
+
+        infer.post_proc_workers = workers
+        infer.forward(torch.rand((37, 16, 16)))
+
+        metrics = infer.metrics
+        assert metrics['frames'] == 37
+        assert metrics['batches'] == math.ceil(37 / 4)
+        assert all(metrics[k] > 0 for k in ('t_load', 't_model', 't_post_proc'))
+
+        infer.reset_metrics()
+        assert infer.metrics['frames'] == 0
+
+    @staticmethod
+    def assert_em_equal(em, em_ref):
+        """Equal up to numerical differences of the model for different batch compositions"""
+        assert (em.frame_ix == em_ref.frame_ix).all()
+        assert (em.xyz == em_ref.xyz).all()
+        assert torch.allclose(em.phot, em_ref.phot, atol=1e-6)
+
+    @pytest.mark.parametrize("pool", ['thread', 'process'])
+    @pytest.mark.parametrize("workers", [1, 3])
+    def test_forward_pipelined(self, infer, pool, workers):
+
+        frames = torch.rand((37, 16, 16))
+        em_ref = infer.forward(frames)
+
+        infer.post_proc_workers = workers
+        infer.post_proc_pool = pool
+
+        self.assert_em_equal(infer.forward(frames), em_ref)
+
+    def test_forward_sharded(self, infer):
+
+        frames = torch.rand((37, 16, 16))
+        em_ref = infer.forward(frames)
+
+        self.assert_em_equal(sharded.ShardedInfer(infer, n_shards=3, threads_per_shard=1).forward(frames), em_ref)
+
+    @pytest.mark.parametrize("n_shards", [1, 4, 40])
+    def test_forward_shard_files(self, infer, n_shards):
+
+        frames = torch.rand((37, 16, 16))
+        em_ref = infer.forward(frames)
+
+        shard_infer = sharded.ShardedInfer(infer, n_shards=n_shards, threads_per_shard=1)
+
+        with RMAfterTest(test_dir / 'dummy_shards', recursive=True) as shard_dir, RMAfterTest(test_dir / 'dummy_merged.h5') as file:
+            for i in reversed(range(n_shards)):
+                with pytest.raises(ValueError):  # not yet complete
+                    sharded.ShardedInfer.merge(shard_dir, n_shards)
+
+                shard_infer.forward_shard(frames, i, shard_dir)
+
+            self.assert_em_equal(sharded.ShardedInfer.merge(shard_dir, n_shards), em_ref)
+
+            sharded.ShardedInfer.merge(shard_dir, n_shards, file=file)
+            self.assert_em_equal(emitter.EmitterSet.load(file), em_ref)
+
+    def test_shard_ranges(self):
+        assert sharded.shard_ranges(10, 3) == [(0, 3), (3, 6), (6, 10)]
+        assert sharded.shard_ranges(2, 4) == [(0, 1), (1, 2)]
+
+        with pytest.raises(ValueError):
+            sharded.shard_ranges(10, 0)
+
+    def test_autotune(self, infer):
+
+        frames = torch.rand((16, 16, 16))
+        em_ref = infer.forward(frames)
+        n_threads = torch.get_num_threads()
+
+        with RMAfterTest(test_dir / 'dummy_autotune.json') as file:
+            try:
+                tuner = autotune.InferAutotuner(batch_sizes=(2, 8), threads=(1, 2), workers=(0,), n_frames=8,
+                                                cache_file=file)
+                config = tuner.tune(infer, frames)
+
+                assert config['batch_size'] in (2, 8) and config['threads'] in (1, 2)
+                assert (infer.batch_size, infer.num_workers) == (config['batch_size'], 0)
+                assert len(tuner.benchmarks) == 1 + 2 + 2 + 1  # warm-up and per parameter candidates
+                self.assert_em_equal(infer.forward(frames), em_ref)
+
+                """Cached"""
+                tuner = autotune.InferAutotuner(batch_sizes=(2, 8), threads=(1, 2), workers=(0,), n_frames=8,
+                                                cache_file=file)
+                assert tuner.tune(infer, frames) == config
+                assert len(tuner.benchmarks) == 0
+
+                """Other settings of the inference are tuned separately"""
+                infer.channels_last = True
+                tuner.tune(infer, frames)
+                assert len(tuner.benchmarks) != 0
+                infer.channels_last = False
+
+                """Memory cap rules out the large batch size"""
+                tuner.memory_cap = 5 * 16 * 16 * 4 * 4
+                assert tuner.tune(infer, frames, force=True)['batch_size'] == 2
+
+            finally:
+                torch.set_num_threads(n_threads)
+
+    @pytest.mark.parametrize("precision,channels_last", [
+        ('fp32', True),
+        pytest.param('bf16', False, marks=pytest.mark.skipif(not hasattr(torch, 'autocast'), reason="No autocast.")),
+        pytest.param('bf16', True, marks=pytest.mark.skipif(not hasattr(torch, 'autocast'), reason="No autocast."))])
+    def test_forward_precision(self, precision, channels_last):
+
+        model = torch.nn.Sequential(torch.nn.Conv2d(5, 8, 3, padding=1), torch.nn.ReLU(),
+                                    torch.nn.Conv2d(8, 2, 3, padding=1))
+        frames = torch.rand((10, 16, 16))
+
+        infer = inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=Identity(), device='cpu',
+                                batch_size=4, num_workers=0, pin_memory=False, forward_cat='frames')
+        out_ref = infer.forward(frames)
+
+        infer.precision, infer.channels_last = precision, channels_last
+        out = infer.forward(frames)
+
+        assert out.dtype == torch.float32
+        assert torch.allclose(out, out_ref, atol=1e-5 if precision == 'fp32' else 5e-2)
+
+        with pytest.raises(ValueError):
+            inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=Identity(), device='cpu',
+                            precision='fp8')
+
+    class _DummyPostProcNm(_DummyPostProc):
+        """With pixel size and background for the evaluation"""
+
+        @staticmethod
+        def forward(x):
+            em = TestInferDummy._DummyPostProc.forward(x)
+            em.px_size = torch.tensor([100., 100.])
+            em.bg = torch.ones_like(em.phot)
+
+            return em
+
+    @pytest.mark.skipif(not hasattr(torch, 'autocast'), reason="bf16 requires autocast (torch >= 1.10).")
+    def test_check_accuracy(self, infer):
+
+        infer.post_proc = self._DummyPostProcNm()
+        infer_bf16 = copy.copy(infer)
+        infer_bf16.precision = 'bf16'
+
+        frames = torch.rand((20, 16, 16))
+        em_tar = infer.forward(frames)
+        em_tar.xyz_cr, em_tar.phot_cr, em_tar.bg_cr = torch.ones_like(em_tar.xyz), torch.ones_like(em_tar.phot), \
+            torch.ones_like(em_tar.phot)
+
+        matcher = GreedyHungarianMatching(match_dims=2, dist_lat=2.)
+
+        out = precision.check_accuracy(infer, infer_bf16, frames, em_tar, matcher)
+        assert out.eval_ref.jac == 1.
+        assert out.passed == (out.eval.jac >= 0.99)
+
+        assert precision.check_accuracy(infer, infer, frames, em_tar, matcher).passed
+
+    def test_forward_resumable(self, infer):
+
+        frames = torch.rand((37, 16, 16))
+        em_ref = infer.forward(frames)
+
+        calls = []
+
+        class _CrashingPostProc(self._DummyPostProc):  # no state, which would be part of the manifest
+            def forward(self, x):
+                calls.append(len(x))
+                if len(calls) == 5:
+                    raise RuntimeError("Preempted.")
+                return super().forward(x)
+
+        with RMAfterTest(test_dir / 'dummy_resumable', recursive=True) as out_dir:
+            infer.post_proc = _CrashingPostProc()
+            with pytest.raises(RuntimeError):  # 4 batches, i.e. the first two chunks are done
+                resumable.ResumableInfer(infer, out_dir, chunk_size=8).forward(frames)
+
+            assert len(list(out_dir.glob('chunk_*.h5'))) == 2
+
+            """Restart skips the completed chunks"""
+            calls.append(None)  # no crash anymore
+            em = resumable.ResumableInfer(infer, out_dir, chunk_size=8).forward(frames)
+            assert sum(calls[6:]) == 37 - 16
+
+            self.assert_em_equal(em, em_ref)
+            self.assert_em_equal(resumable.ResumableInfer(infer, out_dir, chunk_size=8).merge(), em_ref)
+
+            """Different fit"""
+            with pytest.raises(ValueError):
+                resumable.ResumableInfer(infer, out_dir, chunk_size=10).forward(frames)
+
+            infer.model = torch.nn.Conv2d(5, 1, kernel_size=3, padding=1)
+            with pytest.raises(ValueError):
+                resumable.ResumableInfer(infer, out_dir, chunk_size=8).forward(frames)
+
+    def test_resumable_params(self):
+        """The worker pool of a post-processing, which is started on its first forward, is not part of the manifest"""
+
+        post_proc = post_processing.ConsistencyPostprocessing(raw_th=0.1, em_th=0.5, xy_unit='px', img_shape=(32, 32),
+                                                              lat_th=0.5, num_workers=2)
+        params = resumable._params(processing.TransformSequence([post_proc]))
+
+        post_proc._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # as started by the first forward
+        post_proc._pool_finalizer = weakref.finalize(post_proc, post_proc._pool.shutdown)
+        try:
+            assert post_proc._pool is not None
+            assert resumable._params(processing.TransformSequence([post_proc])) == params
+        finally:
+            post_proc.close()
+
+    def test_pool_sanity(self):
+        with pytest.raises(ValueError):
+            inference.Infer(model=None, ch_in=3, frame_proc=None, post_proc=None, device='cpu', post_proc_pool='gpu')
+
+    @pytest.mark.parametrize("tile_size", [(16, 12), (8, 100), (37, 45)])
+    def test_forward_tiled(self, tile_size):
+
+        model = torch.nn.Sequential(torch.nn.Conv2d(5, 8, 3, padding=1), torch.nn.ReLU(),
+                                    torch.nn.Conv2d(8, 2, 3, padding=1))  # receptive field of 2 px on each side
+
+        infer = inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=Identity(), device='cpu',
+                                batch_size=4, num_workers=0, pin_memory=False, forward_cat='frames')
+        infer_tiled = inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=Identity(), device='cpu',
+                                      batch_size=4, num_workers=0, pin_memory=False, forward_cat='frames',
+                                      tile_size=tile_size, tile_overlap=2)
+
+        frames = torch.rand((10, 37, 45))
+
+        assert torch.allclose(infer_tiled.forward(frames), infer.forward(frames), atol=1e-6)
+
+        with pytest.raises(ValueError):
+            inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=Identity(), device='cpu',
+                            tile_size=(4, 16), tile_overlap=2)
+
+    @pytest.mark.parametrize("batch_windows", [True, False])
+    def test_forward_tiled_bounded(self, batch_windows):
+        """With tiling, a batch holds as many frames as cover batch_size tiles, the frame index remains global"""
+
+        model = torch.nn.Conv2d(5, 1, kernel_size=3, padding=1)
+
+        infer = inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=self._DummyPostProc(), device='cpu',
+                                batch_size=4, num_workers=0, pin_memory=False, batch_windows=batch_windows)
+        infer_tiled = inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=self._DummyPostProc(),
+                                      device='cpu', batch_size=4, num_workers=0, pin_memory=False,
+                                      batch_windows=batch_windows, tile_size=(20, 24), tile_overlap=2)
+
+        frames = torch.rand((10, 40, 48))
+
+        em, em_tiled = infer.forward(frames), infer_tiled.forward(frames)
+
+        assert infer_tiled.metrics['batches'] == 10  # a frame has 9 tiles, i.e. one frame per batch
+        assert (em_tiled.frame_ix == em.frame_ix).all()
+        assert torch.allclose(em_tiled.phot, em.phot, atol=1e-6)
+
+    @pytest.mark.parametrize("tile_size,batch_size,n_tiles", [((20, 24), 4, [4, 4, 1] * 10),  # 9 tiles per frame
+                                                              ((24, 28), 8, [8] * 5),  # 4 tiles per frame
+                                                              ((24, 28), 6, [4] * 10)])
+    def test_forward_tiled_batches(self, tile_size, batch_size, n_tiles):
+        """Tiles are forwarded across tile positions and frames, batch_size tiles at a time"""
+
+        model = torch.nn.Conv2d(5, 1, kernel_size=3, padding=1)
+        tiles_per_forward = []
+        model.register_forward_hook(lambda m, x, y: tiles_per_forward.append(len(x[0])))
+
+        infer = inference.Infer(model=model, ch_in=5, frame_proc=None, post_proc=Identity(), device='cpu',
+                                batch_size=batch_size, num_workers=0, pin_memory=False, forward_cat='frames',
+                                tile_size=tile_size, tile_overlap=2)
+
+        frames = torch.rand((10, 40, 48))
+        out = infer.forward(frames)
+
+        assert tiles_per_forward == n_tiles
+
+        infer.tile_size = None
+        assert torch.allclose(out, infer.forward(frames), atol=1e-6)
+
+
+class TestOutputCache:
+
+    @pytest.fixture()
+    def infer(self):
+        class DummyModel(torch.nn.Module):  # detection probability and 4 features
+            def __init__(self):
+                super().__init__()
+                self.conv = torch.nn.Conv2d(3, 5, 3, padding=1)
+
+            def forward(self, x):
+                x = self.conv(x)
+                return torch.cat([torch.sigmoid(4 * x[:, [0]]), x[:, 1:]], 1)
+
+        return inference.Infer(model=DummyModel(), ch_in=3, frame_proc=None, post_proc=None, device='cpu',
+                               batch_size=4, num_workers=0, pin_memory=False)
+
+    @pytest.mark.parametrize("post_proc", [
+        post_processing.LookUpPostProcessing(raw_th=0.3, xy_unit='px', photxyz_sigma_mapping=None),
+        post_processing.NMSPostProcessing(raw_th=0.3, xy_unit='px', photxyz_sigma_mapping=None)])
+    def test_from_cache(self, infer, post_proc):
+
+        frames = torch.rand((21, 16, 16))
+        infer.post_proc = post_proc
+        em_ref = infer.forward(frames)
+
+        with RMAfterTest(test_dir / 'dummy_output_cache.h5') as file:
+            with output_cache.OutputCacheWriter(file, min_p=0.2) as cache:
+                infer.output_cache = cache
+                infer.forward(frames)
+
+            cache = output_cache.OutputCache(file)
+            assert len(cache) == 21
+            assert cache.shape == (5, 16, 16)
+
+            em = post_proc.from_cache(file, batch_size=5)
+
+        assert len(em) >= 1
+        assert em == em_ref
+
+    def test_cache_empty(self):
+
+        with RMAfterTest(test_dir / 'dummy_output_cache.h5') as file:
+            with output_cache.OutputCacheWriter(file):
+                pass
+
+            cache = output_cache.OutputCache(file)
+            assert len(cache) == 0 and cache.shape is None
+            with pytest.raises(ValueError, match="no model output"):
+                cache.get_frames(0, 1)
+
+            em = post_processing.LookUpPostProcessing(raw_th=0.3, xy_unit='px').from_cache(file)
+            assert len(em) == 0
+
+    def test_from_cache_footprint(self, infer):
+        """The bg mean filter of the consistency post-processing looks further than the stored neighbourhood"""
+
+        post_proc = post_processing.ConsistencyPostprocessing(raw_th=0.3, em_th=0.6, xy_unit='px', img_shape=(16, 16),
+                                                              lat_th=1.)
+
+        with RMAfterTest(test_dir / 'dummy_output_cache.h5') as file:
+            with output_cache.OutputCacheWriter(file, min_p=0.2) as cache:
+                infer.output_cache = cache
+                infer.forward(torch.rand((5, 16, 16)))
+
+            with pytest.raises(ValueError, match="neighbourhood"):
+                post_proc.from_cache(file)
+
+
+class TestExport:
+
+    @pytest.fixture()
+    def fit_setup(self):
+        model = SigmaMUNet(3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8)
+        torch.nn.init.constant_(model.mt_heads[0].out_conv.bias, 0.)  # such that there are detections
+
+        frame_proc = scale_transform.AmplitudeRescale(scale=10., offset=1.)
+        post_proc = processing.TransformSequence([
+            scale_transform.InverseParamListRescale(phot_max=1000., z_max=500., bg_max=100.),
+            coord_transform.Offset2Coordinate((-0.5, 31.5), (-0.5, 31.5), (32, 32)),
+            post_processing.LookUpPostProcessing(raw_th=0.5, xy_unit='px')])
+
+        return model, frame_proc, post_proc
+
+    @pytest.mark.parametrize("fmt,suffix", [('torchscript', '.pt'), ('onnx', '.onnx')])
+    def test_export_runtime(self, fit_setup, fmt, suffix):
+
+        model, frame_proc, post_proc = fit_setup
+        frames = torch.rand(20, 32, 32) * 100
+
+        infer = inference.Infer(model, ch_in=3, frame_proc=frame_proc, post_proc=post_proc, device='cpu',
+                                batch_size=8, num_workers=0, pin_memory=False)
+        em = infer.forward(frames)
+        assert len(em) >= 1
+
+        with RMAfterTest(test_dir / f'dummy_export{suffix}') as file, \
+                RMAfterTest(runtime.meta_file(test_dir / f'dummy_export{suffix}')):
+
+            export.export(file, model, 3, frame_proc, post_proc, frame_size=(32, 32), format=fmt)
+            assert file.is_file()
+
+            if fmt == 'onnx':
+                pytest.importorskip('onnxruntime')
+
+            rt = runtime.Runtime(file)
+            out = list(rt.forward_stream(frames, chunk_size=7))
+
+        assert len(out) == 3
+        frame_ix, features = torch.cat([o[0] for o in out]), torch.cat([o[1] for o in out])
+
+        assert rt.columns[:5] == ['prob', 'phot', 'x', 'y', 'z']
+        assert (frame_ix == em.frame_ix).all()
+        assert torch.allclose(features[:, 2:5], em.xyz, atol=1e-4)
+        assert torch.allclose(features[:, 1], em.phot, atol=1e-2)
+
+    def test_runtime_main(self, fit_setup, monkeypatch):
+
+        model, frame_proc, post_proc = fit_setup
+        frames = torch.rand(10, 32, 32) * 100
+
+        with RMAfterTest(test_dir / 'dummy_export.pt') as file, RMAfterTest(runtime.meta_file(file)), \
+                RMAfterTest(test_dir / 'dummy_frames.tif') as file_frames, \
+                RMAfterTest(test_dir / 'dummy_emitters.csv') as file_out:
+
+            export.export(file, model, 3, frame_proc, post_proc, frame_size=(32, 32))
+            tifffile.imwrite(file_frames, frames.numpy())
+
+            monkeypatch.setattr(sys, 'argv', ['runtime', str(file), str(file_frames), str(file_out), '-c', '4'])
+            runtime.main()
+
+            out = pd.read_csv(file_out)
+
+        assert list(out.columns)[:3] == ['frame_ix', 'prob', 'phot']
+        assert (out['frame_ix'].values == sorted(out['frame_ix'].values)).all()
+
+    def test_export_sanity(self, fit_setup):
+
+        model, frame_proc, _ = fit_setup
+        with pytest.raises(ValueError):
+            export.FitModule(model, 3, frame_proc,
+                             post_processing.NMSPostProcessing(raw_th=0.5, xy_unit='px'))
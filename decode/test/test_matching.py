@@ -222,3 +222,76 @@ class TestGreedyMatching(TestMatcherABC):
 
         """Assert"""
         assert len(tp) / len(em_tar) == pytest.approx(0.7, abs=0.1)
+
+    @pytest.mark.parametrize("match_dims,dist_lat,dist_ax,dist_vol", [(2, 250., None, None),
+                                                                      (3, 250., 500., None),
+                                                                      (3, None, None, 300.),
+                                                                      (2, None, 200., None)])
+    def test_forward_framewise(self, match_dims, dist_lat, dist_ax, dist_vol):
+        """Batched matching must be identical to matching frame by frame with the greedy kernel"""
+
+        """Setup"""
+        matcher = match_em.GreedyHungarianMatching(match_dims=match_dims, dist_lat=dist_lat, dist_ax=dist_ax,
+                                                   dist_vol=dist_vol)
+
+        xyz_out = torch.rand(500, 3) * torch.tensor([3200., 3200., 800.])
+        xyz_tar = torch.rand(400, 3) * torch.tensor([3200., 3200., 800.])
+        xyz_tar[:20] = xyz_tar[20:40]  # ties
+        em_out = decode.generic.emitter.EmitterSet(xyz_out, torch.rand(500), torch.randint(20, size=(500,)),
+                                                   xy_unit='nm')
+        em_tar = decode.generic.emitter.EmitterSet(xyz_tar, torch.rand(400), torch.randint(20, size=(400,)),
+                                                   id=torch.arange(400), xy_unit='nm')
+
+        """Run"""
+        tp, fp, fn, tp_match = matcher.forward(em_out, em_tar)
+
+        """Reference"""
+        ref = {k: [] for k in ('tp', 'fp', 'fn', 'tp_match')}
+        for out_f, tar_f in zip(em_out.split_in_frames(0, 19), em_tar.split_in_frames(0, 19)):
+            filter_mask = matcher.filter(out_f.xyz_nm, tar_f.xyz_nm)
+            tp_ix, tp_match_ix, tp_ix_bool, tp_match_ix_bool = matcher._match_kernel(out_f.xyz_nm, tar_f.xyz_nm,
+                                                                                     filter_mask)
+            ref['tp'].append(out_f[tp_ix])
+            ref['tp_match'].append(tar_f[tp_match_ix])
+            ref['fp'].append(out_f[~tp_ix_bool])
+            ref['fn'].append(tar_f[~tp_match_ix_bool])
+
+        """Assert"""
+        for k, em in zip(('tp', 'fp', 'fn', 'tp_match'), (tp, fp, fn, tp_match)):
+            em_ref = decode.generic.emitter.EmitterSet.cat(ref[k])
+
+            assert len(em) == len(em_ref)
+            assert (em.xyz == em_ref.xyz).all()
+            assert (em.frame_ix == em_ref.frame_ix).all()
+
+        assert (tp.id == tp_match.id).all()
+        assert (tp_match.id == decode.generic.emitter.EmitterSet.cat(ref['tp_match']).id).all()
+
+    @pytest.mark.parametrize("match_dims,dist_lat,dist_ax,dist_vol", [(2, 250., None, None),
+                                                                      (3, 250., 500., None),
+                                                                      (3, None, None, 300.)])
+    def test_count_subsets(self, match_dims, dist_lat, dist_ax, dist_vol):
+        """Counts of subsets of the output must be the same as of matching each subset"""
+
+        """Setup"""
+        matcher = match_em.GreedyHungarianMatching(match_dims=match_dims, dist_lat=dist_lat, dist_ax=dist_ax,
+                                                   dist_vol=dist_vol)
+
+        xyz_out = torch.rand(500, 3) * torch.tensor([3200., 3200., 800.])
+        xyz_tar = torch.rand(400, 3) * torch.tensor([3200., 3200., 800.])
+        em_out = decode.generic.emitter.EmitterSet(xyz_out, torch.rand(500), torch.randint(20, size=(500,)),
+                                                   xy_unit='nm')
+        em_tar = decode.generic.emitter.EmitterSet(xyz_tar, torch.rand(400), torch.randint(20, size=(400,)),
+                                                   xy_unit='nm')
+
+        subsets = [em_out.phot >= th for th in (0., 0.3, 0.7, 1.1)]
+
+        """Run"""
+        counts = matcher.count_subsets(em_out, em_tar, subsets)
+
+        """Assert"""
+        assert len(counts) == len(subsets)
+        for (n_tp, n_fp, n_fn), is_sub in zip(counts, subsets):
+            tp, fp, fn, _ = matcher.forward(em_out[is_sub], em_tar)
+
+            assert (n_tp, n_fp, n_fn) == (len(tp), len(fp), len(fn))
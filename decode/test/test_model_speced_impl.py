@@ -1,8 +1,9 @@
+import numpy as np
 import pytest
 import torch
 import copy
 
-from decode.neuralfitter.models import model_speced_impl as model_impl
+from decode.neuralfitter.models import model_speced_impl as model_impl, quantization
 
 
 class TestSigmaMUNet:
@@ -43,3 +44,46 @@ class TestSigmaMUNet:
         for mod, mod_old in zip(model.named_parameters(), model_old.named_parameters()):
             if mod[0][-6:] == 'weight':
                 assert (mod[1] != mod_old[1]).all()
+
+    def test_quantize(self, model):
+
+        model.eval()
+        x = torch.rand((2, 3, 64, 64))
+        model_q = model.quantize([torch.rand((4, 3, 64, 64)) for _ in range(2)])
+
+        with torch.no_grad():
+            out, out_q = model.forward(x), model_q.forward(x)
+
+        assert out_q.size() == out.size()
+        assert (out_q - out).abs().mean() < 0.1  # loose, the weights are random
+
+        """Original model untouched"""
+        assert isinstance(model.mt_heads[0].out_conv, torch.nn.Conv2d)
+
+        with pytest.raises(ValueError):
+            model.quantize([])
+
+    @pytest.mark.parametrize("activation", [torch.nn.ReLU(), torch.nn.ELU()])
+    def test_quantize_whole(self, activation):
+        """Quantized as a whole, i.e. quantize / dequantize only at the boundaries and around float modules"""
+
+        model = model_impl.SigmaMUNet(3, depth_shared=2, depth_union=2, initial_features=16, inter_features=16,
+                                      activation=activation).eval()
+        model_q = model.quantize([torch.rand((4, 3, 32, 32))])
+
+        quant = [n for n, m in model_q.named_modules() if isinstance(m, torch.nn.quantized.Quantize)]
+        float_modules = [n for n, m in model_q.named_modules() if isinstance(m, quantization.FloatModule)]
+        assert sorted(quant) == sorted(['quant'] + [f'{n}.quant' for n in float_modules])
+
+        if isinstance(activation, torch.nn.ReLU):  # fused
+            assert len(float_modules) == 0
+            assert isinstance(model_q.unet_shared.encoder[0][0], torch.nn.intrinsic.quantized.ConvReLU2d)
+        else:
+            assert len(float_modules) > 0
+
+        with torch.no_grad():
+            x = torch.rand((2, 3, 32, 32))
+            y, y_q = model(x), model_q(x)
+
+        # the int8 error of the (untrained) model depends on the random weights, the output must correlate nonetheless
+        assert np.corrcoef(y.flatten().numpy(), y_q.flatten().numpy())[0, 1] > 0.9
@@ -1,8 +1,12 @@
+import pickle
+
 import pytest
 import torch
 
+from decode.evaluation import match_emittersets
 from decode.generic import emitter, test_utils
 from decode.neuralfitter import post_processing
+from decode.neuralfitter.utils.probability import binom_pdiverse
 
 
 class TestPostProcessingAbstract:
@@ -127,6 +131,56 @@ class TestLookUpPostProcessing(TestPostProcessingAbstract):
 
         assert test_utils.tens_almeq(emitter_out.phot_sig, torch.tensor([10., 1/0.6]))
 
+    def test_sweep(self, post):
+
+        """Setup"""
+        x = torch.rand(4, 10, 32, 32)
+        x[:, 0] = x[:, 0] ** 3
+        x[0, 0, 3:6, 3:6] = 0.  # zero pixel between two pixels below threshold
+        x[0, 0, 3, 4] = 0.3
+        x[0, 0, 5, 4] = 0.3
+
+        thresholds = [0.5, 0.05, 0.3, 0.31, 0.9]
+
+        """Run"""
+        em_sweep = post.sweep(x, thresholds)
+
+        """Assert (same as forward)"""
+        assert len(em_sweep) == len(thresholds)
+        for th, em in zip(thresholds, em_sweep):
+            post.raw_th = th
+            em_ref = post.forward(x.clone())
+
+            assert len(em) == len(em_ref)
+            assert (em.frame_ix == em_ref.frame_ix).all()
+            assert (em.prob == em_ref.prob).all()
+            assert (em.xyz == em_ref.xyz).all()
+            assert (em.xyz_sig == em_ref.xyz_sig).all()
+
+    def test_sweep_counts(self, post):
+
+        x = torch.rand(4, 10, 32, 32)
+        x[:, 0] = x[:, 0] ** 3
+        x[:, 2:5] = torch.rand(4, 3, 32, 32) * 32
+        post.px_size = (1., 1.)
+        em_tar = emitter.RandomEmitterSet(100, extent=32, xy_unit='px', px_size=(1., 1.))
+        em_tar.frame_ix = torch.randint(4, size=(100,))
+
+        matcher = match_emittersets.GreedyHungarianMatching(match_dims=2, dist_lat=2.)
+        thresholds = [0.6, 0.2, 0.05, 1.1]
+        counts = post.sweep(x, thresholds, em_tar=em_tar, matcher=matcher)
+
+        assert pickle.loads(pickle.dumps(counts)) == counts
+        for c, th, em in zip(counts, thresholds, post.sweep(x, thresholds)):
+            assert c.th == th
+            tp, fp, fn, _ = matcher.forward(em, em_tar)
+            assert (c.tp, c.fp, c.fn) == (len(tp), len(fp), len(fn))
+            assert c.tp + c.fp == len(em)
+            assert c.tp + c.fn == len(em_tar)
+
+        with pytest.raises(ValueError):
+            post.sweep(x, [0.2], em_tar=em_tar)
+
 
 class TestNMSPostProcessing(TestLookUpPostProcessing):
 
@@ -155,6 +209,25 @@ class TestNMSPostProcessing(TestLookUpPostProcessing):
         assert test_utils.tens_almeq(p_out[0, 4:6, 4], torch.tensor(expct[0]))
         assert test_utils.tens_almeq(p_out[1, 6:8, 4], torch.tensor(expct[1]))
 
+    def test_forward_inplace(self, post):
+        """Model output must not be modified and the output must be the same as NMS followed by look-up"""
+
+        x = torch.rand(4, 10, 32, 32)
+        x[:, 0] = x[:, 0] ** 3
+        x_in = x.clone()
+
+        em = post.forward(x_in)
+
+        assert (x_in == x).all()
+
+        x[:, 0] = post._nms(x[:, 0], post.p_aggregation, post.raw_th, post._split_th)
+        em_ref = post_processing.LookUpPostProcessing.forward(post, x)
+
+        assert (em.frame_ix == em_ref.frame_ix).all()
+        assert (em.prob == em_ref.prob).all()
+        assert (em.xyz == em_ref.xyz).all()
+        assert (em.xyz_sig == em_ref.xyz_sig).all()
+
 
 class TestConsistentPostProcessing(TestPostProcessingAbstract):
 
@@ -193,7 +266,6 @@ class TestConsistentPostProcessing(TestPostProcessingAbstract):
 
         _ = post.forward(torch.cat((p, out), 1))
 
-    @pytest.mark.skip(reason="Implementation was not robust and was removed. Test can be used when new implementation is there.")
     def test_multi_worker(self, post):
 
         """Setup"""
@@ -217,11 +289,32 @@ class TestConsistentPostProcessing(TestPostProcessingAbstract):
 
         post.num_workers = 4
         em1 = post.forward(torch.cat((p, out), 1))
+        post.close()
 
         """Assert (equal outcome)"""
         for i in range(len(em0)):
             assert em0[i] == em1[i]
 
+    @pytest.mark.parametrize("num_workers", [1, 3])
+    def test_cluster_parallel(self, post, num_workers):
+
+        p = (torch.rand(7, 1, 32, 32) < 0.3).float() * torch.rand(7, 1, 32, 32)
+        p[[1, 4]] = 0.  # frames without difficult pixels
+        out = torch.rand(7, 5, 32, 32)
+
+        p_out, feat_out = post._cluster_batch(p, out)
+
+        post.num_workers = num_workers
+        p_out_par, feat_out_par = post._cluster_batch_parallel(p, out)
+        pool = post._pool
+        post.close()
+
+        assert (p_out_par == p_out).all()
+        assert (feat_out_par == feat_out).all()
+        assert post._pool is None
+        with pytest.raises(RuntimeError):  # workers are shut down
+            pool.submit(int)
+
     def test_easy_case(self, post):
         """
         Easy case, i.e. isolated active pixels.
@@ -290,6 +383,42 @@ class TestConsistentPostProcessing(TestPostProcessingAbstract):
         assert len(em_out.get_subset_frame(2, 2)) == 2
         assert (em_out.get_subset_frame(2, 2).prob == 0.7).all()
 
+    @pytest.mark.parametrize("p_aggregation", ['sum', 'max', 'pbinom_cdf', 'pbinom_pdf'])
+    def test_cluster_aggregation(self, post, p_aggregation):
+        """Chain of consistent pixels in one neighbour group, a pixel in the group that is not consistent and a
+        consistent group in another frame."""
+
+        post.p_aggregation = p_aggregation
+
+        """Setup"""
+        p = torch.zeros((2, 1, 32, 32))
+        out = torch.zeros((2, 5, 32, 32))
+        p[0, 0, 2, 2:6] = torch.tensor([0.3, 0.5, 0.6, 0.4])
+        p[1, 0, 7, 7] = 1.
+        p[1, 0, 8, 8] = 0.2
+
+        out[0, 1, 2, 2:6] = torch.tensor([10., 10.4, 10.8, 12.])  # chain of 0.4 steps, last one is separate
+        out[0, 0, 2, 2:6] = torch.tensor([1., 2., 3., 4.])
+
+        """Run"""
+        p_out, feat_out = post._cluster_batch(p, out)
+
+        """Assertions"""
+        p_clus = p[0, 0, 2, 2:5]
+        z = binom_pdiverse(p_clus)
+        expct = {'sum': p_clus.sum(), 'max': p_clus.max(), 'pbinom_cdf': z[1:].sum(), 'pbinom_pdf': z[1]}
+        z = binom_pdiverse(torch.tensor([1., 0.2]))
+        expct_1 = {'sum': 1.2, 'max': 1., 'pbinom_cdf': z[1:].sum(), 'pbinom_pdf': z[1]}
+
+        assert p_out[0, 0, 2, 2] == pytest.approx(expct[p_aggregation], abs=1e-6)
+        assert p_out[0, 0, 2, 5] == pytest.approx(0.4)
+        assert p_out[1, 0, 7, 7] == pytest.approx(expct_1[p_aggregation], abs=1e-6)
+        assert (p_out > 0).sum() == 3
+
+        feat_av = (out[0, :, 2, 2:5] * p_clus).sum(1) / p_clus.sum()
+        assert test_utils.tens_almeq(feat_out[0, :, 2, 2:5], feat_av.unsqueeze(1).repeat(1, 3), 1e-6)
+        assert test_utils.tens_almeq(feat_out[0, :, 2, 5], out[0, :, 2, 5])
+
     @pytest.mark.parametrize("x,expct", [(torch.ones((2, 6, 32, 32)), True),
                                          (torch.zeros((2, 6, 32, 32)), False),
                                          (torch.tensor([[0.5, 0., 0.], [0., 0., 0.]]).unsqueeze(0).unsqueeze(0), False)])
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import pytest
 
 import torch
@@ -7,6 +9,8 @@ import matplotlib.pyplot as plt
 from decode.generic import emitter
 from decode.renderer import renderer
 from decode.plot import PlotFrameCoord
+from decode.test.asset_handler import RMAfterTest
+from decode.utils import emitter_io
 
 
 class TestRenderer2D:
@@ -28,3 +32,24 @@ class TestRenderer2D:
 
         rend.render(em)
         plt.show()
+
+    def test_forward_chunks(self, monkeypatch):
+        """Chunk-wise rendering of an out-of-core set equals rendering of the set in memory"""
+
+        em = emitter.RandomEmitterSet(1000, extent=100, xy_unit='nm')
+        em.frame_ix = torch.randint(0, 50, (1000,))
+
+        rend_mem = renderer.Renderer2D(px_size=10., sigma_blur=None)
+        rend_ooc = renderer.Renderer2D(px_size=10., sigma_blur=None, chunk_size=7)
+
+        n_passes = []
+        iter_chunks = emitter_io.EmitterSetH5.iter_chunks
+        monkeypatch.setattr(emitter_io.EmitterSetH5, 'iter_chunks',
+                            lambda *args, **kwargs: n_passes.append(1) or iter_chunks(*args, **kwargs))
+
+        with RMAfterTest(Path(__file__).resolve().parent / 'assets' / 'dummy_emitter.h5') as file:
+            emitter_io.save_h5(file, em)
+            hist_ooc = rend_ooc.forward(emitter_io.EmitterSetH5(file))
+
+        assert (rend_mem.forward(em) == hist_ooc).all()
+        assert len(n_passes) == 2  # extent and histogram
@@ -0,0 +1,319 @@
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from decode.generic.emitter import EmitterSet, EmptyEmitterSet, RandomEmitterSet
+from decode.test.asset_handler import RMAfterTest
+from decode.utils import emitter_io
+
+test_dir = Path(__file__).resolve().parent / 'assets'
+csv_header = ['x', 'y', 'z', 'phot', 'frame_ix', 'id', 'prob', 'bg', 'phot_cr', 'bg_cr', 'phot_sig', 'bg_sig',
+              'xy_unit', 'x_cr', 'y_cr', 'z_cr', 'x_sig', 'y_sig', 'z_sig']
+
+
+def sort_stable(em):
+    """Emitters are stored stably sorted by frame, whereas EmitterSet.sort_by_frame does not guarantee stability"""
+    return em[torch.from_numpy(np.argsort(em.frame_ix.numpy(), kind='stable'))]
+
+
+class TestEmitterH5:
+
+    @pytest.fixture()
+    def em(self):
+        em = RandomEmitterSet(1000, px_size=(100., 120.))
+        em.frame_ix = torch.randint(-3, 50, (1000,))
+        em.xyz_sig = torch.rand_like(em.xyz)
+
+        return em
+
+    def test_save_load(self, em):
+
+        with RMAfterTest(test_dir / 'dummy_emitter.h5') as file:
+            emitter_io.save_h5(file, em, chunk_size=64)
+            em_dict = emitter_io.load_h5(file)
+
+        assert em_dict['xy_unit'] == 'px'
+        assert (em_dict['px_size'] == em.px_size).all()
+        assert 'phot_cr' not in em_dict  # optional attributes are only stored when present
+
+        """File is sorted by frame"""
+        em_reload = EmitterSet(**em_dict)
+        assert em_reload == sort_stable(em)
+
+    def test_save_load_empty(self):
+
+        with RMAfterTest(test_dir / 'dummy_emitter.h5') as file:
+            emitter_io.save_h5(file, EmptyEmitterSet(xy_unit='nm'))
+            em = EmitterSet(**emitter_io.load_h5(file))
+
+        assert len(em) == 0
+        assert em.xy_unit == 'nm'
+
+    @pytest.mark.parametrize("frame_range", [(-10, 100), (-3, -3), (0, 10), (20, 19), (49, 60), (60, 70)])
+    def test_frame_range(self, em, frame_range):
+
+        with RMAfterTest(test_dir / 'dummy_emitter.h5') as file:
+            emitter_io.save_h5(file, em)
+            em_dict = emitter_io.load_h5(file, attributes=['xyz', 'phot', 'frame_ix'], frame_range=frame_range)
+
+        assert set(em_dict.keys()) == {'xyz', 'phot', 'frame_ix', 'xy_unit', 'px_size'}
+
+        em_sub = sort_stable(em).get_subset_frame(*frame_range)
+        assert (em_dict['xyz'] == em_sub.xyz).all()
+        assert (em_dict['frame_ix'] == em_sub.frame_ix).all()
+
+    def test_writer_incremental(self, em):
+
+        em_split = em.split_in_frames(-3, 49)
+
+        with RMAfterTest(test_dir / 'dummy_emitter.h5') as file:
+            with emitter_io.EmitterWriterH5(file) as writer:
+                for em_frame in em_split[:10]:
+                    writer.append(em_frame)
+                writer.append(EmitterSet.cat(em_split[10:]))
+
+                with pytest.raises(ValueError):  # frames out of order
+                    writer.append(em_split[0])
+
+            em_reload = EmitterSet(**emitter_io.load_h5(file, frame_range=(5, 20)))
+
+        assert em_reload == sort_stable(em).get_subset_frame(5, 20)
+
+
+class TestEmitterSetH5:
+
+    @pytest.fixture()
+    def em(self):
+        em = RandomEmitterSet(5000, extent=64, px_size=(100., 120.))
+        em.frame_ix = torch.randint(0, 100, (5000,))
+        em.xyz_sig = torch.rand_like(em.xyz)
+
+        return sort_stable(em)
+
+    @pytest.fixture()
+    def em_file(self, em):
+        with RMAfterTest(test_dir / 'dummy_emitter.h5') as file:
+            emitter_io.save_h5(file, em, chunk_size=256)
+            yield emitter_io.EmitterSetH5(file)
+
+    def test_meta(self, em, em_file):
+
+        assert len(em_file) == len(em)
+        assert em_file.frame_range == (0, 99)
+        assert em_file.xy_unit == 'px'
+        assert (em_file.px_size == em.px_size).all()
+
+    def test_get_subset_frame(self, em, em_file):
+
+        assert em_file.get_subset_frame(10, 20, -10) == em.get_subset_frame(10, 20, -10)
+
+    @pytest.mark.parametrize("xy_unit", [None, 'nm'])
+    def test_iter_chunks(self, em, em_file, xy_unit):
+
+        chunks = list(em_file.iter_chunks(30, xy_unit=xy_unit))
+
+        assert len(chunks) == 4
+        assert chunks[-1].frame_ix.min() >= 90
+
+        em_cat = EmitterSet.cat(chunks)
+        if xy_unit is None:
+            assert em_cat == em
+        else:
+            assert em_cat.xy_unit == 'nm'
+            assert (em_cat.xyz == em.xyz_nm).all()
+            assert (em_cat.xyz_sig == em.xyz_sig_nm).all()
+
+    @pytest.mark.parametrize("dim", [None, 2])
+    def test_filter_by_sigma(self, em, em_file, dim, monkeypatch):
+
+        monkeypatch.setattr(emitter_io.EmitterSetH5, '_chunk_rows', 700)  # statistics over multiple chunks
+        monkeypatch.setattr(emitter_io.EmitterSetH5, '_hist_bins', 16)
+
+        with RMAfterTest(test_dir / 'dummy_emitter_filtered.h5') as file:
+            em_filt = em_file.filter_by_sigma(0.6, file, dim=dim, chunk_size=7)
+            em_filt = EmitterSet.cat(list(em_filt.iter_chunks(100)))
+
+        em_filt_ref = em.filter_by_sigma(0.6, dim=dim)
+        assert len(em_filt) == pytest.approx(len(em) * 0.6, abs=1)
+        assert em_filt == em_filt_ref
+
+    def test_filter_by_sigma_all(self, em, em_file):
+        """Fraction 1 writes the unfiltered set to the output file"""
+
+        with RMAfterTest(test_dir / 'dummy_emitter_filtered.h5') as file:
+            em_filt = em_file.filter_by_sigma(1., file, chunk_size=7)
+
+            assert em_filt.file == file
+            assert EmitterSet.cat(list(em_filt.iter_chunks(100))) == em
+
+    def test_filter_by_sigma_nan(self, em):
+        """NaN sigma values give a NaN percentile as in memory, i.e. no emitter passes"""
+
+        em.xyz_sig[::10] = float('nan')
+        with RMAfterTest(test_dir / 'dummy_emitter.h5') as file:
+            emitter_io.save_h5(file, em)
+
+            with RMAfterTest(test_dir / 'dummy_emitter_filtered.h5') as file_filt:
+                em_filt = emitter_io.EmitterSetH5(file).filter_by_sigma(0.6, file_filt)
+
+                assert len(em_filt) == 0
+                assert len(em.filter_by_sigma(0.6)) == 0
+
+    def test_percentile_rows(self, em_file, monkeypatch):
+
+        monkeypatch.setattr(emitter_io.EmitterSetH5, '_chunk_rows', 700)
+        monkeypatch.setattr(emitter_io.EmitterSetH5, '_hist_bins', 16)
+
+        for q in (0., 37.5, 60., 100.):
+            p = em_file._percentile_rows(lambda xyz_sig: xyz_sig[:, 1], 'xyz_sig', q)
+            assert p == pytest.approx(np.percentile(em_file.get_subset_frame(0, 99).xyz_sig[:, 1].numpy(), q))
+
+        assert np.isnan(em_file._percentile_rows(lambda xyz_sig: np.where(xyz_sig > 0.99, np.nan, xyz_sig), 'xyz_sig',
+                                                 60.))
+
+        with pytest.raises(ValueError, match="infinite"):
+            em_file._percentile_rows(lambda xyz_sig: np.where(xyz_sig > 0.99, np.inf, xyz_sig), 'xyz_sig', 60.)
+
+    def test_filter_by_sigma_sanity(self, em):
+
+        em.xyz_sig = None
+        with RMAfterTest(test_dir / 'dummy_emitter.h5') as file:
+            emitter_io.save_h5(file, em)
+
+            with pytest.raises(ValueError, match="xyz_sig"):
+                emitter_io.EmitterSetH5(file).filter_by_sigma(0.6, test_dir / 'dummy_emitter_filtered.h5')
+
+
+class TestEmitterCSV:
+
+    @pytest.fixture()
+    def em(self):
+        em = RandomEmitterSet(1000, xy_unit='nm')
+        em.frame_ix = torch.randint(0, 50, (1000,))
+        em.id = torch.arange(1000)
+        em.xyz_sig = torch.rand_like(em.xyz)
+
+        return em
+
+    def test_save_load(self, em):
+
+        with RMAfterTest(test_dir / 'dummy_emitter.csv') as file:
+            emitter_io.save_csv(file, em.to_dict())
+            em_dict = emitter_io.load_csv(file, mapping={'x': 'x', 'y': 'y', 'z': 'z', 'phot': 'phot',
+                                                         'frame_ix': 'frame_ix', 'id': 'id'}, chunk_size=64)
+            header = list(pd.read_csv(file, nrows=0).columns)
+
+        assert header == csv_header
+        assert EmitterSet(**em_dict, xy_unit='nm') == EmitterSet(em.xyz, em.phot, em.frame_ix, em.id, xy_unit='nm')
+
+    def test_header(self, em):
+        """Optional attributes which are not set are written as nan columns, i.e. the header is always the same"""
+
+        with RMAfterTest(test_dir / 'dummy_emitter.csv') as file:
+            emitter_io.save_csv(file, EmitterSet(em.xyz, em.phot, em.frame_ix, xy_unit='nm').to_dict())
+            data = pd.read_csv(file)
+
+        assert list(data.columns) == csv_header
+        assert data[['phot_cr', 'bg_cr', 'phot_sig', 'bg_sig', 'x_cr', 'y_cr', 'z_cr', 'x_sig', 'y_sig', 'z_sig']] \
+            .isna().all(axis=None)
+        assert (data['x'].to_numpy(dtype=np.float32) == em.xyz[:, 0].numpy()).all()
+
+    def test_writer_iter(self, em):
+
+        with RMAfterTest(test_dir / 'dummy_emitter.csv') as file:
+            with emitter_io.EmitterWriterCSV(file) as writer:
+                writer.append(em[:500])
+                writer.append(EmitterSet(em.xyz[500:], em.phot[500:], em.frame_ix[500:], xy_unit='nm'))
+
+                with pytest.raises(ValueError):  # attribute not in header
+                    writer.append_dict({**em[:10].to_dict(), 'dummy': torch.rand(10)})
+
+            chunks = list(emitter_io.iter_csv(file, chunk_size=100))
+
+        assert len(chunks) > 1  # streamed
+        assert EmitterSet(**emitter_io._cat_dicts(chunks), xy_unit='nm') == \
+               EmitterSet(em.xyz, em.phot, em.frame_ix, xy_unit='nm')
+
+    def test_load_empty(self):
+
+        with RMAfterTest(test_dir / 'dummy_emitter.csv') as file:
+            with emitter_io.EmitterWriterCSV(file):  # no emitters, i.e. not even a header
+                pass
+            assert len(EmitterSet(**emitter_io.load_csv(file), xy_unit='px')) == 0
+
+            emitter_io.save_csv(file, EmptyEmitterSet(xy_unit='px').to_dict())
+            assert len(EmitterSet(**emitter_io.load_csv(file), xy_unit='px')) == 0
+
+    @pytest.mark.parametrize("xy_unit", ['nm', None])
+    def test_pyarrow(self, em, xy_unit, monkeypatch):
+        """The pyarrow reader and writer give the same as the pandas ones"""
+        pytest.importorskip('pyarrow')
+
+        em.xy_unit = xy_unit
+        mapping = {'x': 'x', 'y': 'y', 'z': 'z', 'phot': 'phot', 'frame_ix': 'frame_ix', 'id': 'id'}
+
+        with RMAfterTest(test_dir / 'dummy_emitter_pa.csv') as file_pa, \
+                RMAfterTest(test_dir / 'dummy_emitter_pd.csv') as file_pd:
+
+            with emitter_io.EmitterWriterCSV(file_pa) as writer:
+                writer.append(em[:500])
+                writer.append(em[500:])
+            em_dict_pa = emitter_io.load_csv(file_pa, mapping=mapping, chunk_size=64)
+
+            with monkeypatch.context() as m:
+                m.setattr(emitter_io, 'pa_csv', None)
+                emitter_io.save_csv(file_pd, em.to_dict())
+                em_dict_pd = emitter_io.load_csv(file_pd, mapping=mapping, chunk_size=64)
+
+            data_pa, data_pd = pd.read_csv(file_pa), pd.read_csv(file_pd)
+
+        assert list(data_pa.columns) == list(data_pd.columns) == csv_header
+        assert data_pa['xy_unit'].equals(data_pd['xy_unit'])
+        pd.testing.assert_frame_equal(data_pa, data_pd, check_dtype=False)  # pyarrow writes 1. as 1
+        assert EmitterSet(**em_dict_pa, xy_unit='nm') == EmitterSet(**em_dict_pd, xy_unit='nm')
+        assert EmitterSet(**em_dict_pa, xy_unit='nm') == EmitterSet(em.xyz, em.phot, em.frame_ix, em.id,
+                                                                    xy_unit='nm')
+
+    def test_pyarrow_types(self, monkeypatch):
+        """Integer looking and empty columns of the first block do not fix the column types of the pyarrow reader"""
+        pytest.importorskip('pyarrow')
+
+        with RMAfterTest(test_dir / 'dummy_emitter.csv') as file:
+            with file.open('w') as f:
+                f.write('x,y,z,phot,frame_ix\n')
+                f.writelines(f'{i},{i},,{i},{i // 10}\n' for i in range(200))
+                f.writelines(f'{i}.5,{i}.25,1.5,{i}.5,{i // 10}\n' for i in range(200, 400))
+
+            em_dict_pa = emitter_io.load_csv(file, chunk_size=64)
+            with monkeypatch.context() as m:
+                m.setattr(emitter_io, 'pa_csv', None)
+                em_dict_pd = emitter_io.load_csv(file, chunk_size=64)
+
+        for k in ('xyz', 'phot', 'frame_ix'):
+            np.testing.assert_array_equal(em_dict_pa[k].numpy(), em_dict_pd[k].numpy())
+        assert torch.isnan(em_dict_pa['xyz'][:200, 2]).all() and (em_dict_pa['xyz'][200:, 2] == 1.5).all()
+
+
+def test_smap():
+
+    xyz = torch.rand(1000, 3).double() * 100
+    frame_ix = torch.randint(1, 50, (1000,))
+
+    with RMAfterTest(test_dir / 'dummy_smap.mat') as file:
+        with h5py.File(file, 'w') as f:
+            loc = f.create_group('saveloc/loc')
+            for k, v in {'xnm': xyz[:, 0], 'ynm': xyz[:, 1], 'znm': xyz[:, 2], 'phot': torch.rand(1000).double(),
+                         'frame': frame_ix.double(), 'bg': torch.rand(1000).double()}.items():
+                loc.create_dataset(k, data=v.numpy()[None])
+
+        em_dict = emitter_io.load_smap(file, chunk_size=300)
+        chunks = list(emitter_io.iter_smap(file, chunk_size=300))
+
+    assert len(chunks) == 4
+    assert (em_dict['xyz'] == xyz).all()
+    assert (em_dict['frame_ix'] == frame_ix - 1).all()
+    assert em_dict['bg'].dtype == torch.float
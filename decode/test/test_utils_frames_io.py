@@ -0,0 +1,154 @@
+import gc
+import pickle
+import time
+from pathlib import Path
+
+import pytest
+import tifffile
+import torch
+
+from decode.neuralfitter import dataset
+from decode.test.asset_handler import RMAfterTest
+from decode.utils import frames_io
+
+test_dir = Path(__file__).resolve().parent / 'assets'
+
+
+class TestFrameStack:
+
+    @pytest.fixture()
+    def frames(self):
+        return torch.randint(0, 2 ** 16, (50, 32, 40), dtype=torch.int32).short()
+
+    @pytest.mark.parametrize("compression", [None, 'zlib'])
+    def test_getitem(self, frames, compression):
+
+        with RMAfterTest(test_dir / 'dummy_stack.tif') as file:
+            tifffile.imwrite(file, frames.numpy(), compression=compression)
+
+            frames_ref = frames_io.load_tif(file)
+            stack = frames_io.FrameStack(file)
+
+            assert len(stack) == 50
+            assert stack.size() == torch.Size((50, 32, 40))
+            assert stack.dim() == 3
+
+            assert stack[3].size() == torch.Size((32, 40))
+            assert (stack[3] == frames_ref[3]).all()
+            assert (stack[-1] == frames_ref[-1]).all()
+            assert (stack[10:20:3] == frames_ref[10:20:3]).all()
+            assert (stack[torch.tensor([5, 0, 5, 49])] == frames_ref[torch.tensor([5, 0, 5, 49])]).all()
+            assert stack[:].dtype == torch.float32
+
+            with pytest.raises(IndexError):
+                stack[50]
+
+            stack.close()
+
+    @pytest.mark.parametrize("compression", [None, 'zlib'])
+    def test_getitem_4d(self, frames, compression):
+        """Leading dimensions of a series are flattened to frames"""
+
+        frames = frames.view(5, 10, 32, 40)
+        with RMAfterTest(test_dir / 'dummy_stack.tif') as file:
+            tifffile.imwrite(file, frames.numpy(), compression=compression)
+            stack = frames_io.FrameStack(file)
+
+            assert stack.size() == torch.Size((50, 32, 40))
+            assert (stack[[13, 49]] == frames.view(-1, 32, 40)[[13, 49]].float()).all()
+
+            stack.close()
+
+    def test_folder(self, frames):
+
+        with RMAfterTest(test_dir / 'dummy_stack', recursive=True) as folder:
+            folder.mkdir()
+            tifffile.imwrite(folder / 'stack_0.tif', frames[:20].numpy())
+            tifffile.imwrite(folder / 'stack_1.tif', frames[20:21].numpy())
+            tifffile.imwrite(folder / 'stack_2.tif', frames[21:].numpy(), compression='zlib')
+
+            stack = frames_io.FrameStack(folder)
+
+            assert len(stack) == 50
+            assert (stack[:] == frames.float()).all()
+            assert (stack[[49, 20, 19, 0]] == frames[[49, 20, 19, 0]].float()).all()
+
+            """Handles are opened again after pickling (e.g. dataloader workers)"""
+            stack_unpickled = pickle.loads(pickle.dumps(stack))
+            assert (stack_unpickled[18:22] == frames[18:22].float()).all()
+
+            stack.close()
+            stack_unpickled.close()
+
+    def test_inference_dataset(self, frames):
+
+        with RMAfterTest(test_dir / 'dummy_stack.tif') as file:
+            tifffile.imwrite(file, frames.numpy())
+
+            ds_lazy = dataset.InferenceDataset(frames=frames_io.FrameStack(file), frame_proc=None, frame_window=3)
+            ds = dataset.InferenceDataset(frames=frames.float(), frame_proc=None, frame_window=3)
+
+            assert len(ds_lazy) == len(ds)
+            for ix in (0, 25, 49):
+                assert (ds_lazy[ix] == ds[ix]).all()
+
+
+class TestBatchFileLoader:
+
+    @pytest.fixture()
+    def folder(self):
+        with RMAfterTest(test_dir / 'dummy_batch', recursive=True) as folder:
+            folder.mkdir()
+            for i in range(6):
+                tifffile.imwrite(folder / f'fov_{i}.tif', torch.full((5, 16, 16), i, dtype=torch.int16).numpy())
+            tifffile.imwrite(folder / 'fov_excluded.tif', torch.zeros((5, 16, 16), dtype=torch.int16).numpy())
+
+            yield folder
+
+    @pytest.mark.parametrize("prefetch,num_threads", [(0, 1), (1, 1), (3, 2), (10, 4)])
+    def test_iter(self, folder, prefetch, num_threads):
+
+        def slow_loader(file):  # later files load faster, order must be kept nonetheless
+            time.sleep(0.01 * (6 - int(file.stem[-1])))
+            return frames_io.load_tif(file)
+
+        loader = frames_io.BatchFileLoader(folder, file_loader=slow_loader, exclude_pattern='*excluded*',
+                                           prefetch=prefetch, num_threads=num_threads)
+
+        out = list(loader)
+
+        assert len(out) == 6
+        for i, (frames, file) in enumerate(out):
+            assert file.name == f'fov_{i}.tif'
+            assert (frames == i).all()
+
+        assert loader.metrics['files'] == 6
+        assert loader.metrics['t_load'] >= 0.01 * sum(range(1, 7))
+        assert loader._executor is None
+
+    def test_close_early(self, folder):
+        """Leaving the iteration early stops the reader threads, also without explicit close"""
+
+        loader = frames_io.BatchFileLoader(folder, exclude_pattern='*excluded*', prefetch=3)
+        with loader:
+            for i, (frames, file) in enumerate(loader):
+                if i == 1:
+                    break
+            executor = loader._executor
+
+        assert loader._executor is None
+        with pytest.raises(RuntimeError):  # shut down
+            executor.submit(print)
+
+        """Iteration can be continued after close"""
+        assert [(frames == i).all().item() for i, (frames, _) in enumerate(loader, 2)] == [True] * 4
+
+        """Without close, the threads are stopped once the loader is garbage collected"""
+        loader = frames_io.BatchFileLoader(folder, exclude_pattern='*excluded*', prefetch=3)
+        next(loader)
+        executor = loader._executor
+        del loader
+        gc.collect()
+
+        with pytest.raises(RuntimeError):
+            executor.submit(print)
@@ -1,11 +1,20 @@
 import copy
 import pathlib
+from typing import Iterator, Optional, Sequence, Tuple
 
 import h5py
 import numpy as np
 import pandas as pd
 import torch
 
+from decode.generic import emitter
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # optional, multithreaded csv parsing and fast writing
+    pa = pa_csv = None
+
 
 challenge_mapping = {'x': 'xnano',
                      'y': 'ynano',
@@ -17,107 +26,686 @@ challenge_mapping = {'x': 'xnano',
 deepstorm3d_mapping = copy.deepcopy(challenge_mapping)
 deepstorm3d_mapping['phot'] = 'intensity'
 
+h5_format = 'decode_emitter'
+h5_version = 1  # increase when the layout changes, the loader rejects files of newer versions
+h5_default_val = {'id': -1, 'prob': 1.}  # fill value of attributes missing in some parts, nan for all others
+_csv_optional = ('xyz_cr', 'phot_cr', 'bg_cr', 'xyz_sig', 'phot_sig', 'bg_sig')  # written as nan to csv if not set
+
 
-def load_csv(file: (str, pathlib.Path), mapping: (None, dict) = None, **pd_csv_args) -> dict:
+def load_csv(file: (str, pathlib.Path), mapping: (None, dict) = None, chunk_size: int = 100000,
+             **pd_csv_args) -> dict:
     """
     Loads a CSV file which does provide a header.
 
     Args:
         file: path to file
         mapping: mapping dictionary with keys ('x', 'y', 'z', 'phot', 'id', 'frame_ix')
+        chunk_size: number of rows that are parsed at once (see iter_csv)
         pd_csv_args: additional keyword arguments to be parsed to the pandas csv reader
 
     Returns:
         dict: dictionary which can readily be converted to an EmitterSet by EmitterSet(**out_dict)
     """
+    return _cat_dicts(list(iter_csv(file, mapping=mapping, chunk_size=chunk_size, **pd_csv_args)))
+
+
+def iter_csv(file: (str, pathlib.Path), mapping: (None, dict) = None, chunk_size: int = 100000,
+             **pd_csv_args) -> Iterator[dict]:
+    """
+    Streaming reader of a CSV file which does provide a header. Yields the emitters chunk by chunk, so that memory
+    stays bounded by the chunk size. If pyarrow is installed (and no pandas arguments are given), the file is parsed
+    by the multithreaded pyarrow reader, the chunks are then blocks of the file of about chunk_size rows.
+
+    Args:
+        file: path to file
+        mapping: mapping dictionary with keys ('x', 'y', 'z', 'phot', 'id', 'frame_ix')
+        chunk_size: number of rows per chunk
+        pd_csv_args: additional keyword arguments to be parsed to the pandas csv reader
+
+    Returns:
+        iterator of dictionaries which can readily be converted to an EmitterSet by EmitterSet(**out_dict)
+    """
     if mapping is None:
         mapping = {'x': 'x', 'y': 'y', 'z': 'z', 'phot': 'phot', 'frame_ix': 'frame_ix'}
 
-    chunks = pd.read_csv(file, chunksize=100000, **pd_csv_args)
-    data = pd.concat(chunks)
+    if pathlib.Path(file).stat().st_size == 0:  # written without any emitters, i.e. not even a header
+        return
 
-    xyz = torch.stack((torch.from_numpy(data[mapping['x']].to_numpy()).float(),
-                       torch.from_numpy(data[mapping['y']].to_numpy()).float(),
-                       torch.from_numpy(data[mapping['z']].to_numpy()).float()), 1)
+    if pa_csv is not None and not pd_csv_args:
+        """Estimate the block size in bytes from the length of the first lines."""
+        with open(file, 'rb') as f:
+            f.readline()
+            row_bytes = max(len(f.readline()), 1)
 
-    phot = torch.from_numpy(data[mapping['phot']].to_numpy()).float()
-    frame_ix = torch.from_numpy(data[mapping['frame_ix']].to_numpy()).long()
+        """Column types as the pandas reader would infer them for the whole file, pyarrow infers from the first block"""
+        column_types = {mapping[k]: pa.int64() if k in ('frame_ix', 'id') else pa.float64() for k in mapping.keys()}
 
-    if 'id' in mapping.keys():
-        identifier = torch.from_numpy(data[mapping['id']].to_numpy()).long()
+        reader = pa_csv.open_csv(file, read_options=pa_csv.ReadOptions(use_threads=True,
+                                                                        block_size=row_bytes * chunk_size),
+                                 convert_options=pa_csv.ConvertOptions(column_types=column_types))
+        chunks = (batch.to_pandas() for batch in reader)
     else:
-        identifier = None
+        chunks = pd.read_csv(file, chunksize=chunk_size, **pd_csv_args)
 
-    return {'xyz': xyz, 'phot': phot, 'frame_ix': frame_ix, 'id': identifier}
+    for data in chunks:
+        def column(k, dtype):  # copy, since the arrays of the pyarrow reader are read-only
+            return torch.from_numpy(data[mapping[k]].to_numpy(dtype=dtype, copy=True))
+
+        yield {
+            'xyz': torch.stack([column(c, np.float32) for c in ('x', 'y', 'z')], 1),
+            'phot': column('phot', np.float32),
+            'frame_ix': column('frame_ix', np.int64),
+            'id': column('id', np.int64) if 'id' in mapping.keys() else None
+        }
 
 
 def save_csv(file: (str, pathlib.Path), data: dict):
-    def convert_dict_torch_numpy(data: dict) -> dict:
-        """Convert all torch tensors in dict to numpy."""
-        for k, v in data.items():
-            if isinstance(v, torch.Tensor):
-                data[k] = v.numpy()
-        return data
+    """
+    Saves an emitter dictionary (see EmitterSet.to_dict) as CSV file. Coordinates are split into x, y and z columns.
+
+    Args:
+        file: path to file
+        data: emitterset as dictionary
+
+    """
+    with EmitterWriterCSV(file) as writer:
+        writer.append_dict(data)
+
+
+class EmitterWriterCSV:
+    """
+    Writes emitters incrementally to a CSV file with the layout of save_csv. The header is defined by the first append.
+    If pyarrow is installed, its (much faster) CSV writer is used.
+
+    Example:
+        >>> with EmitterWriterCSV('fit.csv') as writer:
+        >>>     for em in emittersets:
+        >>>         writer.append(em)
+
+    """
+
+    def __init__(self, file: (str, pathlib.Path)):
+        """
+
+        Args:
+            file: path of the output file (will be overwritten)
+
+        """
+        self._file = open(file, 'wb') if pa_csv is not None else open(file, 'w', newline='')
+        self._columns = None
+        self._schema = None
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, em):
+        """
+        Append emitters.
+
+        Args:
+            em: EmitterSet
+
+        """
+        self.append_dict(em.to_dict())
 
-    def change_to_one_dim(data: dict) -> dict:
+    def append_dict(self, data: dict):
         """
-        Change xyz tensors to be one-dimensional.
+        Append emitters in their dictionary representation (see EmitterSet.to_dict).
 
         Args:
             data: emitterset as dictionary
 
         """
-        xyz = data.pop('xyz')
-        xyz_cr = data.pop('xyz_cr')
-        xyz_sig = data.pop('xyz_sig')
+        columns = self._flat_columns(data)
+
+        if self._columns is None:
+            self._columns = list(columns.keys())
+        elif set(columns.keys()) - set(self._columns):
+            raise ValueError(f"Attributes {set(columns.keys()) - set(self._columns)} are not in the header of the "
+                             f"file which was defined by the first append.")
+
+        """Columns not set in this part are written as their default."""
+        n = len(columns['x'])
+        columns = {k: columns[k] if k in columns else np.full(n, h5_default_val.get(k, np.nan))
+                   for k in self._columns}
+
+        if pa_csv is not None:
+            table = pa.Table.from_pydict({k: v if isinstance(v, np.ndarray) else self._pa_constant(v, n)
+                                          for k, v in columns.items()})
+            if self._writer is None:
+                self._schema = table.schema
+                self._writer = pa_csv.CSVWriter(self._file, self._schema)
+            self._writer.write_table(table.cast(self._schema) if table.schema != self._schema else table)
+
+        else:  # scalars (meta data) are broadcast by pandas
+            pd.DataFrame(columns, index=pd.RangeIndex(n), copy=False).to_csv(self._file, header=self._writer is None,
+                                                                             index=False)
+            self._writer = True
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        if pa_csv is not None and self._writer is not None:
+            self._writer.close()
+        self._file.close()
+
+    @staticmethod
+    def _flat_columns(data: dict) -> dict:
+        """
+        Columns of the CSV file without copying. Coordinates (and their Cramer-Rao bounds and sigmas) are split into
+        x, y and z. Optional attributes which are not set are written as nan, such that the header is always the same
+        (as of save_csv before the optional attributes were allocated lazily). Meta data (e.g. xy_unit) and nan
+        remain scalars and are broadcast to all rows when written.
+
+        """
+        def to_numpy(v):
+            return v.cpu().numpy() if isinstance(v, torch.Tensor) else v
 
-        data_one_dim = {'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2]}
-        data_one_dim.update(data)
-        data_one_dim.update({'x_cr': xyz_cr[:, 0], 'y_cr': xyz_cr[:, 1], 'z_cr': xyz_cr[:, 2]})
-        data_one_dim.update({'x_sig': xyz_sig[:, 0], 'y_sig': xyz_sig[:, 1], 'z_sig': xyz_sig[:, 2]})
+        columns = {c: to_numpy(data['xyz'][:, i]) for i, c in enumerate(('x', 'y', 'z'))}
 
-        return data_one_dim
+        for k, v in data.items():
+            if k in ('xyz', 'xyz_cr', 'xyz_sig', 'px_size'):
+                continue
+            columns[k] = np.nan if v is None and k in _csv_optional else to_numpy(v)
+
+        for k in ('xyz_cr', 'xyz_sig'):
+            suffix = k[len('xyz'):]
+            columns.update({c + suffix: to_numpy(data[k][:, i]) if data.get(k) is not None else np.nan
+                            for i, c in enumerate(('x', 'y', 'z'))})
 
-    """Change torch to numpy and convert 2D elements to 1D"""
-    data = copy.deepcopy(data)
-    data.pop('px_size')
-    data = change_to_one_dim(convert_dict_torch_numpy(data))
+        return columns
 
-    df = pd.DataFrame.from_dict(data)
-    df.to_csv(file, index=False)
+    @staticmethod
+    def _pa_constant(v, n: int):
+        """Column of a repeated scalar without a python list, None as string column (not null typed)."""
+        return pa.nulls(n, pa.string()) if v is None else pa.repeat(v, n)
 
 
-def load_smap(file: (str, pathlib.Path), mapping: (dict, None) = None) -> dict:
+def load_smap(file: (str, pathlib.Path), mapping: (dict, None) = None, chunk_size: int = 1000000) -> dict:
     """
 
     Args:
         file: .mat file
         mapping (optional): mapping of matlab fields to emitter. Keys must be x,y,z,phot,frame_ix,bg
-        **emitter_kwargs: additional arguments to be parsed to the emitter initialisation
+        chunk_size: number of localizations that are read at once (see iter_smap)
 
     Returns:
 
+    """
+    return _cat_dicts(list(iter_smap(file, mapping=mapping, chunk_size=chunk_size)))
+
+
+def iter_smap(file: (str, pathlib.Path), mapping: (dict, None) = None, chunk_size: int = 1000000) -> Iterator[dict]:
+    """
+    Streaming reader of an SMAP localization file. Yields the emitters chunk by chunk.
+
+    Args:
+        file: .mat file
+        mapping (optional): mapping of matlab fields to emitter. Keys must be x,y,z,phot,frame_ix,bg
+        chunk_size: number of localizations per chunk
+
+    Returns:
+        iterator of emitter dictionaries
+
     """
     if mapping is None:
         mapping = {'x': 'xnm', 'y': 'ynm', 'z': 'znm',
                    'phot': 'phot', 'frame_ix': 'frame', 'bg': 'bg'}
 
-    f = h5py.File(file, 'r')
+    with h5py.File(file, 'r') as f:
+        loc_dict = f['saveloc']['loc']
+        n = loc_dict[mapping['x']].shape[1]  # matlab column vectors are stored as 1 x N
+
+        for ix in range(0, n, chunk_size):
+            def read(k):
+                return torch.from_numpy(loc_dict[mapping[k]][0, ix:ix + chunk_size])
+
+            yield {
+                'xyz': torch.stack([read('x'), read('y'), read('z')], 1),
+                'phot': read('phot'),
+                'frame_ix': read('frame_ix').long() - 1,  # MATLAB starts at 1, python and all serious languages at 0
+                'bg': read('bg').float()
+            }
+
+
+def _cat_dicts(chunks: Sequence[dict]) -> dict:
+    """Concatenates the chunks of the streaming readers, an empty set if there are none (empty file)."""
+    if len(chunks) == 0:
+        return {'xyz': torch.zeros((0, 3)), 'phot': torch.zeros((0,)), 'frame_ix': torch.zeros((0,)).long(),
+                'id': None}
+
+    return {k: torch.cat([c[k] for c in chunks], 0) if chunks[0][k] is not None else None for k in chunks[0].keys()}
+
+
+class EmitterWriterH5:
+    """
+    Writes emitters incrementally to a columnar HDF5 file. Every attribute of the EmitterSet is stored as a chunked and
+    compressed dataset of its own, and the start offset of every frame is stored as index, such that single attributes
+    and frame ranges can be loaded without reading the rest of the file (see load_h5).
+
+    Emitters are stored sorted by frame, therefore they must be appended in order of their frame index, i.e. the frame
+    indices of an appended set must not be lower than the ones that were written before. Within an appended set the
+    order does not matter.
+
+    Layout:
+        attrs: format, version, xy_unit, px_size, n_emitters
+        data/<attribute>: one dataset per attribute of the EmitterSet that is set
+        index/frame_offsets: start offset of frames frame_low ... frame_high and end offset; attrs: frame_low
+
+    Example:
+        >>> with EmitterWriterH5('fit.h5') as writer:
+        >>>     for em in emittersets:  # in order of their frames
+        >>>         writer.append(em)
+
+    """
+
+    def __init__(self, file: (str, pathlib.Path), chunk_size: int = 2 ** 16, compression: Optional[str] = 'gzip',
+                 compression_opts: Optional[int] = 4):
+        """
+
+        Args:
+            file: path of the output file (will be overwritten)
+            chunk_size: number of emitters per chunk of the datasets
+            compression: h5py compression filter, None for no compression
+            compression_opts: options for compression filter
+
+        """
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_opts = compression_opts if compression is not None else None
+
+        self._file = h5py.File(file, 'w')
+        self._file.attrs['format'] = h5_format
+        self._file.attrs['version'] = h5_version
+        self._data = self._file.create_group('data')
+
+        self._n = 0
+        self._frame_counts = []  # list of (first frame, counts per frame) per append
+        self._frame_last = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self._n
+
+    def append(self, em):
+        """
+        Append emitters.
+
+        Args:
+            em: EmitterSet
+
+        """
+        em_dict = em.to_dict()
+        xy_unit, px_size = em_dict.pop('xy_unit'), em_dict.pop('px_size')
+
+        if xy_unit is not None and 'xy_unit' not in self._file.attrs:
+            self._file.attrs['xy_unit'] = xy_unit
+        if px_size is not None and 'px_size' not in self._file.attrs:
+            self._file.attrs['px_size'] = np.asarray(px_size, dtype=np.float64)
+
+        data = {k: v.cpu().numpy() for k, v in em_dict.items() if v is not None}
+        for k, v in data.items():  # also for empty sets, such that the attributes are present when loaded
+            if k not in self._data:
+                self._create_dataset(k, v)
+
+        if len(data['frame_ix']) == 0:
+            return
+
+        """Sort by frame (stable) and check that frames are in order"""
+        frame_ix = data['frame_ix']
+        if (frame_ix[1:] < frame_ix[:-1]).any():
+            perm = np.argsort(frame_ix, kind='stable')
+            data = {k: v[perm] for k, v in data.items()}
+            frame_ix = data['frame_ix']
+
+        if self._frame_last is not None and frame_ix[0] < self._frame_last:
+            raise ValueError(f"Emitters must be appended in order of their frame index. Frame {frame_ix[0]} is "
+                             f"lower than already written frame {self._frame_last}.")
+
+        """Write, missing attributes are taken care of by the fill value of the dataset"""
+        n_new = self._n + len(frame_ix)
+        for k, ds in self._data.items():
+            ds.resize(n_new, axis=0)
+            if k in data:
+                ds[self._n:n_new] = data[k]
+
+        self._frame_counts.append((int(frame_ix[0]), np.bincount(frame_ix - frame_ix[0])))
+        self._frame_last = int(frame_ix[-1])
+        self._n = n_new
+
+    def close(self):
+        """Writes the frame index and closes the file."""
+
+        if not self._file:  # already closed
+            return
+
+        if len(self._frame_counts) == 0:
+            frame_low, counts = 0, np.zeros(0, dtype=np.int64)
+        else:
+            frame_low = self._frame_counts[0][0]
+            counts = np.zeros(self._frame_last - frame_low + 1, dtype=np.int64)
+            for frame_first, c in self._frame_counts:
+                counts[frame_first - frame_low:frame_first - frame_low + len(c)] += c
+
+        offsets = self._file.create_dataset('index/frame_offsets', data=np.concatenate([[0], np.cumsum(counts)]))
+        offsets.attrs['frame_low'] = frame_low
+        self._file.attrs['n_emitters'] = self._n
+
+        self._file.close()
+
+    def _create_dataset(self, attr: str, val: np.ndarray):
+        ds = self._data.create_dataset(attr, shape=(self._n, *val.shape[1:]), maxshape=(None, *val.shape[1:]),
+                                       dtype=val.dtype, chunks=(self.chunk_size, *val.shape[1:]),
+                                       compression=self.compression, compression_opts=self.compression_opts,
+                                       fillvalue=h5_default_val.get(attr, np.nan if val.dtype.kind == 'f' else 0))
+        return ds
+
+
+def save_h5(file: (str, pathlib.Path), em, **writer_kwargs):
+    """
+    Saves an EmitterSet to the columnar HDF5 format (see EmitterWriterH5). The emitters are stored (stably) sorted by
+    their frame index, i.e. loading returns them in frame order.
+
+    Args:
+        file: path of the output file
+        em: EmitterSet
+        **writer_kwargs: additional arguments to the writer (chunk size, compression)
+
+    """
+    with EmitterWriterH5(file, **writer_kwargs) as writer:
+        writer.append(em)
+
+
+def load_h5(file: (str, pathlib.Path), attributes: Optional[Sequence[str]] = None,
+            frame_range: Optional[Tuple[int, int]] = None) -> dict:
+    """
+    Loads emitters from the columnar HDF5 format (see EmitterWriterH5). Only the requested attributes and frames are
+    read from disk.
+
+    Args:
+        file: path to file
+        attributes: attributes to load, all if None. Attributes not in the file are returned as None.
+        frame_range: lower and upper frame index (inclusive) of the emitters to load, all if None
+
+    Returns:
+        dict: dictionary which can readily be converted to an EmitterSet by EmitterSet(**out_dict) as long as the
+            attributes xyz, phot and frame_ix are loaded
+
+    """
+    with h5py.File(file, 'r') as f:
+        _check_h5(f, file)
+
+        if frame_range is None:
+            ix_low, ix_high = 0, int(f.attrs['n_emitters'])
+        else:
+            offsets = f['index/frame_offsets']
+            ix_low, ix_high = _frame_bounds_h5(offsets, int(offsets.attrs['frame_low']), *frame_range)
+
+        em_dict = _read_h5(f, attributes, ix_low, ix_high)
+
+    return em_dict
+
+
+def _check_h5(f: h5py.File, file):
+    if f.attrs.get('format') != h5_format:
+        raise ValueError(f"File {file} is not an emitter file of the expected format.")
+    if f.attrs['version'] > h5_version:
+        raise ValueError(f"File version {f.attrs['version']} is newer than the supported one ({h5_version}).")
+
+
+def _frame_bounds_h5(offsets, frame_low: int, frame_start: int, frame_end: int) -> Tuple[int, int]:
+    """Index range of the emitters between frame_start and frame_end (inclusive) by the frame offsets."""
+    n_frames = offsets.shape[0] - 1
+
+    ix_low = int(offsets[min(max(frame_start - frame_low, 0), n_frames)])
+    ix_high = int(offsets[min(max(frame_end + 1 - frame_low, 0), n_frames)])
+
+    return ix_low, max(ix_low, ix_high)
+
+
+def _read_h5(f: h5py.File, attributes: Optional[Sequence[str]], ix_low: int, ix_high: int) -> dict:
+    data = f['data']
+    attributes = list(data.keys()) if attributes is None else attributes
+
+    em_dict = {k: torch.from_numpy(data[k][ix_low:ix_high]) if k in data else None for k in attributes}
+    em_dict['xy_unit'] = f.attrs['xy_unit'] if 'xy_unit' in f.attrs else None
+    em_dict['px_size'] = torch.from_numpy(f.attrs['px_size']).float() if 'px_size' in f.attrs else None
+
+    return em_dict
+
+
+class EmitterSetH5:
+    """
+    Out-of-core set of emitters in the columnar HDF5 format (see EmitterWriterH5). The attributes stay on disk and are
+    only read by frame range or chunk by chunk, such that sets which are larger than memory can be processed.
+
+    Example:
+        >>> em_file = EmitterSetH5('fit.h5')
+        >>> for em in em_file.iter_chunks(1000, xy_unit='nm'):  # EmitterSets of 1000 frames each
+        >>>     ...
+
+    """
+    _chunk_rows = 2 ** 20  # number of emitters per read of the chunk-wise statistics
+    _hist_bins = 2 ** 16  # number of histogram bins of the chunk-wise percentile
+
+    def __init__(self, file: (str, pathlib.Path)):
+        """
+
+        Args:
+            file: path to file
+
+        """
+        self.file = pathlib.Path(file)
+
+        with h5py.File(self.file, 'r') as f:
+            _check_h5(f, self.file)
+
+            self.xy_unit = f.attrs['xy_unit'] if 'xy_unit' in f.attrs else None
+            self.px_size = torch.from_numpy(f.attrs['px_size']).float() if 'px_size' in f.attrs else None
+            self.attributes = tuple(f['data'].keys())
+
+            self._n = int(f.attrs['n_emitters'])
+            self._frame_offsets = f['index/frame_offsets'][:]  # one entry per frame, small compared to the emitters
+            self._frame_low = int(f['index/frame_offsets'].attrs['frame_low'])
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def frame_range(self) -> Tuple[int, int]:
+        """Lowest and highest frame index (inclusive)."""
+        return self._frame_low, self._frame_low + len(self._frame_offsets) - 2
+
+    def get_subset_frame(self, frame_start: int, frame_end: int, frame_ix_shift: Optional[int] = None,
+                         attributes: Optional[Sequence[str]] = None) -> emitter.EmitterSet:
+        """
+        Loads the emitters that are in the frame range as specified.
+
+        Args:
+            frame_start: lower frame index limit
+            frame_end: upper frame index limit (including)
+            frame_ix_shift: shift of the frame index of the output
+            attributes: attributes to load (must include xyz, phot and frame_ix), all if None
+
+        Returns:
+            EmitterSet in memory
+
+        """
+        with h5py.File(self.file, 'r') as f:
+            em = self._read_frames(f, frame_start, frame_end, attributes)
+
+        if frame_ix_shift and len(em) != 0:
+            em.frame_ix = em.frame_ix + frame_ix_shift
+
+        return em
+
+    def iter_chunks(self, n: int, xy_unit: Optional[str] = None,
+                    attributes: Optional[Sequence[str]] = None) -> Iterator[emitter.EmitterSet]:
+        """
+        Iterates over the set in chunks of frames.
+
+        Args:
+            n: number of frames per chunk
+            xy_unit: convert the coordinates (and their sigmas and Cramer-Rao bounds) of the chunks to this unit
+            attributes: attributes to load (must include xyz, phot and frame_ix), all if None
+
+        Returns:
+            iterator of EmitterSets in memory, in order of their frames
 
-    loc_dict = f['saveloc']['loc']
+        """
+        frame_low, frame_high = self.frame_range
+
+        with h5py.File(self.file, 'r') as f:
+            for frame_start in range(frame_low, frame_high + 1, n):
+                em = self._read_frames(f, frame_start, frame_start + n - 1, attributes)
+
+                yield em if xy_unit is None else self._convert_xy_unit(em, xy_unit)
+
+    def filter_by_sigma(self, fraction: float, file: (str, pathlib.Path), dim: Optional[int] = None,
+                        chunk_size: int = 1000, **writer_kwargs):
+        """
+        Filter by sigma values chunk by chunk. Same result as EmitterSet.filter_by_sigma on the whole set.
+        The statistics (variance of the sigma values and the percentile of the total variance) are computed in passes
+        over the xyz and xyz_sig attributes, the filtered emitters are written to a new file.
+
+        Args:
+            fraction: relative fraction of emitters remaining after filtering. Ranges from 0. to 1.
+            file: path of the output file
+            dim: 2 or 3 for taking into account z. If None, it will be autodetermined.
+            chunk_size: number of frames per chunk
+            **writer_kwargs: additional arguments to the writer (chunk size, compression)
+
+        Returns:
+            EmitterSetH5 of the output file
+
+        """
+        if fraction == 1. or len(self) == 0:
+            with EmitterWriterH5(file, **writer_kwargs) as writer:
+                if len(self) == 0:  # such that the attributes are present in the output file
+                    writer.append(self.get_subset_frame(*self.frame_range))
+
+                for em in self.iter_chunks(chunk_size):
+                    writer.append(em)
 
-    emitter_dict = {
-        'xyz': torch.cat([
-            torch.from_numpy(np.array(loc_dict[mapping['x']])).permute(1, 0),  # will always be 2D
-            torch.from_numpy(np.array(loc_dict[mapping['y']])).permute(1, 0),
-            torch.from_numpy(np.array(loc_dict[mapping['z']])).permute(1, 0)
-        ], 1),
+            return EmitterSetH5(file)
 
-        'phot': torch.from_numpy(np.array(loc_dict[mapping['phot']])).squeeze(),
-        'frame_ix': torch.from_numpy(np.array(loc_dict[mapping['frame_ix']])).squeeze().long(),
-        'bg': torch.from_numpy(np.array(loc_dict[mapping['bg']])).squeeze().float()
-    }
+        if 'xyz_sig' not in self.attributes:
+            raise ValueError(f"Filtering by sigma requires the attribute xyz_sig, which is not in {self.file}.")
 
-    emitter_dict['frame_ix'] -= 1  # MATLAB starts at 1, python and all serious languages at 0
+        """Variances of the sigma values (unbiased, as torch.var) by merging the chunk statistics"""
+        n, mean, m2, z_zero = 0, np.zeros(3), np.zeros(3), True
+        for xyz, xyz_sig in self._iter_rows('xyz', 'xyz_sig'):
+            xyz_sig = xyz_sig.astype(np.float64)
+            n_b, mean_b = len(xyz_sig), xyz_sig.mean(0)
+            m2_b = ((xyz_sig - mean_b) ** 2).sum(0)
 
-    return emitter_dict
+            delta = mean_b - mean
+            m2 = m2 + m2_b + delta ** 2 * n * n_b / (n + n_b)
+            mean = mean + delta * n_b / (n + n_b)
+            n += n_b
+            z_zero = z_zero and (xyz[:, 2] == 0).all()
+
+        var = m2 / (n - 1)
+        is_3d = (dim == 3) if dim is not None else not z_zero
+
+        max_s = self._percentile_rows(lambda xyz_sig: self._tot_var(xyz_sig, var, is_3d), 'xyz_sig', fraction * 100.)
+
+        with EmitterWriterH5(file, **writer_kwargs) as writer:
+            for em in self.iter_chunks(chunk_size):
+                tot_var = self._tot_var(em.xyz_sig.numpy(), var, is_3d)
+                writer.append(em[torch.from_numpy(tot_var < max_s)])
+
+        return EmitterSetH5(file)
+
+    def _read_frames(self, f: h5py.File, frame_start: int, frame_end: int,
+                     attributes: Optional[Sequence[str]]) -> emitter.EmitterSet:
+        ix_low, ix_high = _frame_bounds_h5(self._frame_offsets, self._frame_low, frame_start, frame_end)
+        return emitter.EmitterSet(**_read_h5(f, attributes, ix_low, ix_high))
+
+    def _iter_rows(self, *attributes: str) -> Iterator[tuple]:
+        """Iterates over the raw attributes in blocks of rows, irrespective of the frames."""
+        with h5py.File(self.file, 'r') as f:
+            data = f['data']
+            for ix in range(0, len(self), self._chunk_rows):
+                yield tuple(data[k][ix:ix + self._chunk_rows] for k in attributes)
+
+    def _percentile_rows(self, fn, attribute: str, q: float) -> float:
+        """
+        Exact percentile (linear interpolation as np.percentile) of fn(attribute) over all rows without holding the
+        values in memory. A histogram locates the ranks of interest, the values of the respective bins are then
+        collected and sorted. As np.percentile, the percentile is NaN if any value is NaN. Infinite values are not
+        supported.
+
+        """
+        v_min, v_max = np.inf, -np.inf
+        for a, in self._iter_rows(attribute):
+            v = fn(a)
+            if np.isnan(v).any():
+                return np.nan
+            if np.isinf(v).any():
+                raise ValueError(f"Percentile of infinite values of {attribute} is not supported.")
+
+            v_min, v_max = min(v_min, v.min()), max(v_max, v.max())
+
+        if v_min == v_max:
+            return v_min
+
+        rank = q / 100. * (len(self) - 1)
+        rank_low, rank_high = int(np.floor(rank)), min(int(np.floor(rank)) + 1, len(self) - 1)
+
+        edges = np.linspace(v_min, v_max, self._hist_bins + 1)
+        counts = sum(np.histogram(fn(a), bins=edges)[0] for a, in self._iter_rows(attribute))
+        counts_cum = np.cumsum(counts)
+        bin_low = int(np.searchsorted(counts_cum, rank_low, side='right'))
+        bin_high = int(np.searchsorted(counts_cum, rank_high, side='right'))
+
+        while True:  # widen the window in the (rare) case of values on the bin edges
+            lower, upper = edges[bin_low], edges[min(bin_high + 1, self._hist_bins)]
+
+            n_below, values = 0, []
+            for a, in self._iter_rows(attribute):
+                v = fn(a)
+                n_below += int((v < lower).sum())
+                values.append(v[(v >= lower) & (v <= upper)])
+            values = np.sort(np.concatenate(values))
+
+            if n_below <= rank_low and rank_high < n_below + len(values):
+                break
+            if bin_low == 0 and bin_high == self._hist_bins - 1:  # the window covers all values
+                raise ValueError(f"Failed to locate the percentile of {attribute}, the values changed between passes.")
+            bin_low, bin_high = max(bin_low - 1, 0), min(bin_high + 1, self._hist_bins - 1)
+
+        v_low, v_high = values[rank_low - n_below], values[rank_high - n_below]
+        return v_low + (v_high - v_low) * (rank - rank_low)
+
+    @staticmethod
+    def _tot_var(xyz_sig: np.ndarray, var: np.ndarray, is_3d: bool) -> np.ndarray:
+        var = var.astype(xyz_sig.dtype)  # same precision as the in memory computation
+        tot_var = xyz_sig[:, 0] ** 2 + (np.sqrt(var[0] / var[1]) * xyz_sig[:, 1]) ** 2
+
+        if is_3d:
+            tot_var += (np.sqrt(var[0] / var[2]) * xyz_sig[:, 2]) ** 2
+
+        return tot_var
+
+    @staticmethod
+    def _convert_xy_unit(em: emitter.EmitterSet, xy_unit: str) -> emitter.EmitterSet:
+        em_dict = em.to_dict()
+        em_dict['xyz'] = em._pxnm_conversion(em.xyz, in_unit=em.xy_unit, tar_unit=xy_unit)
+        if em_dict['xyz_cr'] is not None:
+            em_dict['xyz_cr'] = em._pxnm_conversion(em.xyz_cr, in_unit=em.xy_unit, tar_unit=xy_unit, power=2)
+        if em_dict['xyz_sig'] is not None:
+            em_dict['xyz_sig'] = em._pxnm_conversion(em.xyz_sig, in_unit=em.xy_unit, tar_unit=xy_unit)
+        em_dict['xy_unit'] = xy_unit
+
+        return emitter.EmitterSet(**em_dict, sanity_check=False)
@@ -1,5 +1,10 @@
+import collections
+import concurrent.futures
+import time
 import warnings
+import weakref
 
+import numpy as np
 import torch
 import pathlib
 import tifffile
@@ -49,25 +54,140 @@ def load_tif(file: (str, pathlib.Path)) -> torch.Tensor:
     return frames
 
 
+class FrameStack:
+    """
+    Lazy stack of frames of a tif(f) file or of the files in a folder (concatenated along the frame axis in sorted
+    order). Only the frames that are indexed are read from disk and converted to float, i.e. it can be used in place of
+    the frame tensor of load_tif for stacks that do not fit into memory.
+    Uncompressed files are memory-mapped, all others are read page by page. Series of more than 3 dimensions (e.g.
+    T x C x H x W) are flattened to frames in the order of the pages.
+
+    Example:
+        >>> frames = FrameStack('acquisition.tif')
+        >>> frames[100:200]  # torch.Tensor of size 100 x H x W
+
+    """
+
+    def __init__(self, file: (str, pathlib.Path)):
+        """
+
+        Args:
+            file: path to the tiff / or folder
+
+        """
+        p = pathlib.Path(file)
+        self.files = sorted(p.glob('*.tif*')) if p.is_dir() else [p]
+
+        if len(self.files) == 0:
+            raise FileNotFoundError(f"No tif files found in {str(p)}.")
+
+        """Number of frames per file from the tiff meta data, nothing is read yet."""
+        n_frames, frame_shapes = [], set()
+        for f in self.files:
+            with tifffile.TiffFile(str(f)) as tif:
+                shape = tif.series[0].shape
+            n_frames.append(int(np.prod(shape[:-2])))  # 1 for a single frame
+            frame_shapes.add(tuple(shape[-2:]))
+
+        if len(frame_shapes) != 1:
+            raise ValueError(f"Frames of the files are of different size ({frame_shapes}).")
+
+        self._frame_shape = frame_shapes.pop()
+        self._offsets = np.cumsum([0] + n_frames)
+        self._handles = {}  # memory-maps or open tiff files, opened on first access
+
+    def __len__(self) -> int:
+        return int(self._offsets[-1])
+
+    def __getitem__(self, ix) -> torch.Tensor:
+        """
+        Reads frames by integer, slice or index array.
+
+        Returns:
+            torch.Tensor: float frames, H x W for integer index, N x H x W otherwise
+
+        """
+        if isinstance(ix, (int, np.integer)):
+            return self[[ix]][0]
+
+        if isinstance(ix, slice):
+            ix = np.arange(*ix.indices(len(self)))
+        else:
+            ix = np.asarray(ix, dtype=np.int64).reshape(-1)
+            ix = np.where(ix < 0, ix + len(self), ix)
+
+        if ((ix < 0) | (ix >= len(self))).any():
+            raise IndexError(f"Frame index out of range for stack of {len(self)} frames.")
+
+        out = np.empty((len(ix), *self._frame_shape), dtype=np.float32)
+        file_ix = np.searchsorted(self._offsets, ix, side='right') - 1
+
+        for i in np.unique(file_ix):
+            is_file = file_ix == i
+            out[is_file] = self._read(i, ix[is_file] - self._offsets[i])
+
+        return torch.from_numpy(out)
+
+    def __getstate__(self):  # handles are not pickled (e.g. for dataloader workers), but opened again
+        state = self.__dict__.copy()
+        state['_handles'] = {}
+        return state
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size((len(self), *self._frame_shape))
+
+    def size(self, dim: int = None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def dim(self) -> int:
+        return 3
+
+    def close(self):
+        for h in self._handles.values():
+            if isinstance(h, tifffile.TiffFile):
+                h.close()
+        self._handles = {}
+
+    def _read(self, i: int, ix: np.ndarray) -> np.ndarray:
+        """Reads frames of the i-th file by their index within the file."""
+        if i not in self._handles:
+            try:
+                self._handles[i] = tifffile.memmap(str(self.files[i]), mode='r').reshape(-1, *self._frame_shape)
+            except ValueError:  # not memory-mappable, e.g. compressed
+                self._handles[i] = tifffile.TiffFile(str(self.files[i]))
+
+        h = self._handles[i]
+        if isinstance(h, np.ndarray):
+            return h[ix]
+
+        return np.stack([h.pages[int(j)].asarray() for j in ix], 0)
+
+
 class BatchFileLoader:
 
     def __init__(self, par_folder: Union[str, pathlib.Path],
                  file_suffix: str = '.tif',
                  file_loader: Union[None, Callable] = None,
-                 exclude_pattern: Union[None, str] = None):
+                 exclude_pattern: Union[None, str] = None,
+                 prefetch: int = 0,
+                 num_threads: int = 1):
         """
         Iterates through parent folder and returns the loaded frames as well as the filename in their iterator
 
         Example:
-            >>> batch_loader = BatchFileLoader('dummy_folder')
-            >>> for frame, file in batch_loader:
-            >>>     out = model.forward(frame)
+            >>> with BatchFileLoader('dummy_folder', prefetch=2) as batch_loader:
+            >>>     for frame, file in batch_loader:
+            >>>         out = model.forward(frame)
 
         Args:
             par_folder: parent folder in which the files are
             file_suffix: suffix to search for
             exclude_pattern: specifies excluded patterns via regex string. If that pattern is found anywhere (!) in the
             files path, the file will be ingored.
+            prefetch: number of files that are loaded ahead in background threads while the current one is processed.
+            0 loads each file synchronously when it is requested.
+            num_threads: number of reader threads when prefetching
 
         """
 
@@ -75,17 +195,34 @@ class BatchFileLoader:
         if not self.par_folder.is_dir():
             raise FileExistsError(f"Path {str(self.par_folder)} is either not a directory or does not exist.")
 
-        self.files = list(self.par_folder.rglob('*' + file_suffix))
+        self.files = sorted(self.par_folder.rglob('*' + file_suffix))
         self.file_loader = file_loader if file_loader is not None else load_tif
-        self._exclude_pattern = exclude_pattern if isinstance(exclude_pattern, (list, tuple)) else [exclude_pattern]
+        self._exclude_pattern = exclude_pattern if isinstance(exclude_pattern, (list, tuple, type(None))) \
+            else [exclude_pattern]
 
         self.remove_by_exclude()
 
+        self.prefetch = prefetch
+        self.num_threads = num_threads
+
+        self.t_load = []  # time to read and decode each file (s)
+        self.t_wait = []  # time the caller waited for each file (s), i.e. load time that was not hidden by prefetching
+
         self._n = -1
+        self._n_submit = 0
+        self._executor = None
+        self._executor_finalizer = None
+        self._queue = collections.deque()  # futures of the files being loaded, in order
 
     def __len__(self) -> int:
         return len(self.files)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def __iter__(self):
         return self
 
@@ -98,10 +235,59 @@ class BatchFileLoader:
 
         """
         if self._n >= len(self) - 1:
+            self.close()
             raise StopIteration
 
         self._n += 1
-        return self.file_loader(self.files[self._n]), self.files[self._n]
+        t0 = time.perf_counter()
+
+        if self.prefetch == 0:
+            frames, t_load = self._load(self.files[self._n])
+
+        else:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
+                self._executor_finalizer = weakref.finalize(self, _shutdown_prefetch, self._executor,
+                                                            self._queue)  # if not closed explicitly
+
+            """Keep the current and the next prefetch files in the queue, the queue is bounded by that."""
+            while self._n_submit <= min(self._n + self.prefetch, len(self) - 1):
+                self._queue.append(self._executor.submit(self._load, self.files[self._n_submit]))
+                self._n_submit += 1
+
+            frames, t_load = self._queue.popleft().result()
+
+        self.t_load.append(t_load)
+        self.t_wait.append(time.perf_counter() - t0)
+
+        return frames, self.files[self._n]
+
+    @property
+    def metrics(self) -> dict:
+        """
+        Summary of the load times in seconds (total read and decode time and the part of it the caller waited for).
+
+        """
+        return {'files': len(self.t_load), 't_load': sum(self.t_load), 't_wait': sum(self.t_wait)}
+
+    def close(self):
+        """
+        Stops the reader threads, files that are not yet loaded are cancelled and loaded ones are dropped. Called at the
+        end of the iteration and on exit of the context, i.e. also if the iteration is left early.
+
+        """
+        if self._executor is None:
+            return
+
+        self._executor_finalizer()
+        self._executor, self._executor_finalizer = None, None
+        self._n_submit = self._n + 1  # the dropped files are loaded again if the iteration is continued
+
+    def _load(self, file: pathlib.Path) -> Tuple[torch.Tensor, float]:
+        t0 = time.perf_counter()
+        frames = self.file_loader(file)
+
+        return frames, time.perf_counter() - t0
 
     def remove_by_exclude(self):
         """
@@ -116,4 +302,13 @@ class BatchFileLoader:
 
         for e in self._exclude_pattern:
             excludes = set(self.par_folder.rglob(e))
-            self.files = list(set(self.files) - excludes)
+            self.files = [f for f in self.files if f not in excludes]  # keeps the order
+
+
+def _shutdown_prefetch(executor: concurrent.futures.ThreadPoolExecutor, queue: collections.deque):
+    """Cancels the pending loads of a BatchFileLoader and stops its reader threads."""
+    for fut in queue:
+        fut.cancel()
+    queue.clear()
+
+    executor.shutdown(wait=True)
@@ -1,6 +1,24 @@
+import os
+import platform
+from typing import Union
+
 import torch
 
 
 def get_device_capability() -> str:
     capability = torch.cuda.get_device_capability()
     return f'{capability[0]}.{capability[1]}'
+
+
+def machine_signature(device: Union[str, torch.device] = 'cpu') -> str:
+    """
+    Signature of the machine, i.e. host, cpu and torch version, and the name of the device if it is a cuda device.
+    Meant as key for settings that are machine specific, e.g. tuned batch size and number of threads.
+
+    """
+    sig = f'{platform.node()}|{platform.machine()}|{platform.processor()}|{os.cpu_count()}|{torch.__version__}'
+
+    if torch.device(device).type == 'cuda':
+        sig += f'|{torch.cuda.get_device_name(device)}'
+
+    return sig
@@ -22,6 +22,21 @@ def hash_model(modelfile):
     return hasher.hexdigest()
 
 
+def hash_state_dict(model: torch.nn.Module) -> str:
+    """
+    Calculate hash of the weights of a model instance, e.g. if it was not loaded from a file.
+    """
+    hasher = hashlib.sha1()
+    for k, v in model.state_dict().items():
+        hasher.update(k.encode())
+        if torch.is_tensor(v) and not v.is_quantized:
+            hasher.update(v.detach().cpu().contiguous().numpy().tobytes())
+        else:  # e.g. packed parameters of quantized layers
+            hasher.update(repr(v).encode())
+
+    return hasher.hexdigest()
+
+
 class LoadSaveModel:
     def __init__(self, model_instance, output_file: (str, pathlib.Path), input_file=None, name_time_interval=(60 * 60),
                  better_th=1e-6, max_files=3, state_dict_update=None):
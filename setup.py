@@ -34,12 +34,19 @@ else:
         "tqdm",
         ]
 
+# development tools (linting), not needed to run decode; pip install -e .[dev]
+dev_requirements = [
+    "pycodestyle",
+    "pyflakes",
+    ]
+
 setup(
     name='decode',
     version='0.9.4',  # do not modify by hand set and sync with bumpversion
     packages=setuptools.find_packages(),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={'dev': dev_requirements},
     zip_safe=False,
     url='https://rieslab.de',
     license='GPL3',